@@ -0,0 +1,189 @@
+"""
+Module for screening the columns of a dataframe in one pass, before they are used as features:
+coercing them to numbers, counting missing values, and finding columns which are constant or
+repeat an earlier column, either by name or by content under another name.
+
+    screen = ColumnScreen(generated_df)
+    keep = screen.keep_columns(missing=True, constant=True, duplicates=True)
+    generated_df = screen.frame(keep)
+
+The columns are read a block of chunk_size columns at a time, as one float array, so only one
+block is ever copied at once no matter how wide the dataframe is.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger('mastml')
+
+class ColumnScreen(object):
+    """
+    Screens every column of df in one pass.
+
+    Args:
+        df (pd.DataFrame) : columns to screen, duplicate names allowed
+        coerce (bool) : whether columns which aren't numbers are coerced to numbers (unparseable
+            cells become missing), like pd.to_numeric(errors='coerce'). If False they are screened
+            as they are, and only count as numeric if they already were
+        chunk_size (int) : number of columns read into each block
+
+    Attributes, all with one entry per column position of df:
+        numeric (np.ndarray of bool) : whether the column holds numbers (after coercion)
+        n_missing (np.ndarray of int) : NaN / empty cells in the column
+        constant (np.ndarray of bool) : whether every non-missing value is the same
+        duplicate_of (np.ndarray of int) : position of the earlier column with the same name, or
+            otherwise with the same values, or -1
+    and empty_rows (np.ndarray of bool), whether every cell of a row is missing.
+    """
+
+    def __init__(self, df, coerce=True, chunk_size=256):
+        self.df = df
+        self.coerce = coerce
+        n_rows, n_columns = df.shape
+        self.numeric = np.zeros(n_columns, dtype=bool)
+        self.n_missing = np.zeros(n_columns, dtype=int)
+        self.constant = np.zeros(n_columns, dtype=bool)
+        self.duplicate_of = np.full(n_columns, -1)
+        self.empty_rows = np.ones(n_rows, dtype=bool)
+        self._coerced = dict() # position -> coerced values, for columns which weren't numbers
+
+        # two hashes of every column's contents, columns with different contents sharing both
+        # is (practically) never going to happen, but candidates are compared anyway
+        self._hashes = np.zeros((n_columns, 2), dtype=np.uint64)
+        self._weights = np.random.RandomState(0).randint(1, 2**62, size=(2, n_rows), dtype=np.int64).astype(np.uint64) | np.uint64(1)
+
+        for start in range(0, n_columns, chunk_size):
+            self._screen_block(np.arange(start, min(start + chunk_size, n_columns)))
+        if n_columns == 0:
+            self.empty_rows[:] = False
+        self._find_duplicates()
+
+    def _screen_block(self, positions):
+        block, numeric = self._read_block(positions)
+        self.numeric[positions] = numeric
+
+        missing = np.isnan(block)
+        self.n_missing[positions] = missing.sum(axis=0)
+        self.empty_rows &= missing.all(axis=1)
+        with np.errstate(invalid='ignore'):
+            # fmin/fmax skip NaN, and are NaN for columns of nothing but NaN
+            low, high = np.fmin.reduce(block, axis=0), np.fmax.reduce(block, axis=0)
+            self.constant[positions] = (low == high) | np.isnan(low)
+
+        # canonical bits for NaN and -0.0, so equal columns always hash the same
+        block[missing] = np.nan
+        block += 0.0
+        bits = np.ascontiguousarray(block).view(np.uint64)
+        for i, weights in enumerate(self._weights):
+            self._hashes[positions, i] = (bits * weights[:, None]).sum(axis=0)
+
+        for j, position in enumerate(positions):
+            if not numeric[j]:
+                # unparseable, so screened as python objects instead of the NaN block
+                column = self.df.iloc[:, position]
+                self.n_missing[position] = column.isna().sum()
+                self.empty_rows &= column.isna().values
+                self.constant[position] = column.nunique(dropna=True) <= 1
+                self._hashes[position] = [pd.util.hash_pandas_object(column, index=False).sum(), 0]
+
+    def _read_block(self, positions):
+        " Float copy of the columns at positions, and whether each one holds numbers "
+        block = np.empty((self.df.shape[0], len(positions)), order='F')
+        numeric = np.ones(len(positions), dtype=bool)
+        for j, position in enumerate(positions):
+            column = self.df.iloc[:, position]
+            if not (pd.api.types.is_numeric_dtype(column) or pd.api.types.is_bool_dtype(column)):
+                if not self.coerce:
+                    numeric[j] = False
+                    block[:, j] = np.nan
+                    continue
+                column = pd.to_numeric(column, errors='coerce')
+                self._coerced[position] = column.values
+            block[:, j] = np.asarray(column, dtype=float)
+        return block, numeric
+
+    def _find_duplicates(self):
+        first_by_name = dict()
+        first_by_hash = dict()
+        for position, name in enumerate(self.df.columns):
+            if name in first_by_name:
+                self.duplicate_of[position] = first_by_name[name]
+                continue
+            first_by_name[name] = position
+            key = (self.numeric[position],) + tuple(self._hashes[position])
+            for candidate in first_by_hash.setdefault(key, []):
+                if self._equal(candidate, position):
+                    self.duplicate_of[position] = candidate
+                    break
+            else:
+                first_by_hash[key].append(position)
+
+    def _equal(self, i, j):
+        a, b = self._values(i), self._values(j)
+        if not self.numeric[i]:
+            return pd.Series(a).equals(pd.Series(b))
+        a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+        return bool(((a == b) | (np.isnan(a) & np.isnan(b))).all())
+
+    def _values(self, position):
+        if position in self._coerced:
+            return self._coerced[position]
+        return self.df.iloc[:, position].values
+
+    def keep_columns(self, missing=True, constant=True, duplicates=True, drop_empty_rows=False, exempt=()):
+        """
+        Mask of the columns to keep: without any missing values (if missing), which aren't
+        constant (if constant) or the same as an earlier column, by name or by values (if
+        duplicates). With drop_empty_rows, cells of rows which are totally empty don't count as
+        missing. Columns named in exempt are only checked for repeated names.
+        """
+        keep = np.ones(len(self.numeric), dtype=bool)
+        if missing:
+            keep &= self.n_missing - (self.empty_rows.sum() if drop_empty_rows else 0) == 0
+        if constant:
+            keep &= ~self.constant
+        exempt = np.asarray(self.df.columns.isin(list(exempt)))
+        keep |= exempt
+        if duplicates:
+            keep &= ~np.asarray(self.df.columns.duplicated())
+            keep &= exempt | (self.duplicate_of == -1)
+        return keep
+
+    def report(self, keep=None):
+        " Dataframe describing every column, one row per column position "
+        names = np.asarray(self.df.columns, dtype=object)
+        report = pd.DataFrame({'numeric': self.numeric,
+                               'n_missing': self.n_missing,
+                               'constant': self.constant,
+                               'duplicate_of': [names[i] if i >= 0 else None for i in self.duplicate_of]},
+                              index=self.df.columns)
+        if keep is not None:
+            report['keep'] = keep
+        return report
+
+    def frame(self, keep, drop_empty_rows=False):
+        " The kept columns of df, coerced to numbers where they were coerced "
+        rows = ~self.empty_rows if drop_empty_rows else slice(None)
+        positions = np.flatnonzero(keep)
+        df = self.df.iloc[rows, positions]
+        if any(position in self._coerced for position in positions):
+            columns = [pd.Series(self._coerced[position][rows], index=df.index, name=df.columns[j])
+                       if position in self._coerced else df.iloc[:, j]
+                       for j, position in enumerate(positions)]
+            df = pd.concat(columns, axis=1)
+        return df
+
+    def log_dropped(self, keep, what='columns'):
+        " Warns about the columns not kept, by the first reason each was dropped for "
+        dropped = ~np.asarray(keep)
+        total = len(dropped)
+        for reason, mask in [('due to missing values', self.n_missing > 0),
+                             ('for being constant', self.constant),
+                             ('for repeating other columns', np.ones(total, dtype=bool))]:
+            mask = mask & dropped
+            if mask.any():
+                log.warning(f'Dropping {mask.sum()}/{total} {what} {reason}')
+                log.debug(f'Dropped {what} {reason}: {list(self.df.columns[mask])}')
+                dropped &= ~mask
@@ -0,0 +1,117 @@
+"""
+Module for parsing composition strings (e.g. "Fe2O3") once and sharing the result between
+feature generators.
+
+Formulas are canonicalized, so "Fe2O3", "O3Fe2" and "Fe2 O3" share one parsed record, and
+every distinct formula string is only parsed once per process (up to CACHE_SIZE of them).
+pymatgen is only imported for formulas the simple parser can't handle, and element lookups.
+"""
+
+import re
+import logging
+from collections import namedtuple, OrderedDict
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger('mastml')
+
+# how many distinct formula strings (and parsed records) to remember
+CACHE_SIZE = 2**17
+
+# pymatgen ignores elements with amounts smaller than this
+AMOUNT_TOLERANCE = 1e-8
+
+ParsedComposition = namedtuple('ParsedComposition', ['formula', 'elements', 'amounts'])
+ParsedComposition.__doc__ = """
+Compact record of a parsed composition.
+    formula (str) : the canonical formula, elements ordered by atomic number (or as written if ordered)
+    elements (tuple of int) : element row indices (atomic number - 1), the same indexing
+        mastml.magpie_data.ElementPropertyTable uses
+    amounts (tuple of float) : amount of each element, same order as elements
+"""
+
+# Formulas made only of element symbols and amounts can be split with a regex instead of pymatgen
+_SIMPLE_FORMULA = re.compile(r'(?:[A-Z][a-z]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)?)+')
+_ELEMENT_AMOUNT = re.compile(r'([A-Z][a-z]?)([0-9]*\.?[0-9]*)')
+
+@lru_cache(maxsize=None)
+def element_index(symbol):
+    " Row index (atomic number - 1) of an element symbol, raises ValueError for unknown symbols "
+    from pymatgen import Element
+    return Element(str(symbol)).Z - 1
+
+@lru_cache(maxsize=None)
+def element_symbol(index):
+    from pymatgen import Element
+    return Element.from_Z(int(index) + 1).symbol
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _split_formula(formula):
+    " ((element index, amount), ...) in order of appearance in formula "
+    formula = formula.strip()
+    if not formula: # empty cells
+        return tuple()
+    if _SIMPLE_FORMULA.fullmatch(formula):
+        element_amounts = OrderedDict()
+        for symbol, amount in _ELEMENT_AMOUNT.findall(formula):
+            element_amounts[symbol] = element_amounts.get(symbol, 0) + (float(amount) if amount else 1.0)
+    else:
+        from pymatgen import Composition
+        element_amounts = Composition(formula).get_el_amt_dict()
+    return tuple((element_index(symbol), float(amount)) for symbol, amount in element_amounts.items()
+                 if abs(amount) >= AMOUNT_TOLERANCE)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _make_record(element_amounts):
+    formula = ''.join(f'{element_symbol(index)}{amount:.12g}' for index, amount in element_amounts)
+    elements = tuple(index for index, _ in element_amounts)
+    amounts = tuple(amount for _, amount in element_amounts)
+    return ParsedComposition(formula, elements, amounts)
+
+def parse_composition(formula, ordered=False):
+    """
+    Returns the ParsedComposition for formula.
+    By default elements are in canonical order (by atomic number) and equal compositions share
+    one record. With ordered=True elements stay in the order they were written, for features
+    that depend on that order.
+    """
+    element_amounts = _split_formula(str(formula))
+    if not ordered:
+        element_amounts = tuple(sorted(element_amounts))
+    return _make_record(element_amounts)
+
+def clear_cache():
+    _split_formula.cache_clear()
+    _make_record.cache_clear()
+
+class CompositionIndex(object):
+    """
+    Parses a column of formulas, once per distinct formula.
+
+    Attributes:
+        compositions (list of ParsedComposition) : one per distinct composition, in order of first appearance
+        formulas (list of str) : the first formula string in the column for each of self.compositions
+        row_to_unique (numpy int array) : for each row, its index into self.compositions
+    """
+    def __init__(self, formulas, ordered=False):
+        formulas = pd.Series(np.asarray(formulas, dtype=object)).fillna('')
+        codes, unique_formulas = pd.factorize(formulas)
+
+        record_numbers = dict()
+        self.compositions = list()
+        self.formulas = list()
+        formula_to_unique = np.empty(len(unique_formulas), dtype=int)
+        for i, formula in enumerate(unique_formulas):
+            record = parse_composition(formula, ordered)
+            if record.formula not in record_numbers:
+                record_numbers[record.formula] = len(self.compositions)
+                self.compositions.append(record)
+                self.formulas.append(formula)
+            formula_to_unique[i] = record_numbers[record.formula]
+        self.row_to_unique = formula_to_unique[codes]
+        log.debug(f'Parsed {len(formulas)} formulas, {len(self.compositions)} distinct compositions')
+
+    def __len__(self):
+        return len(self.compositions)
@@ -5,8 +5,9 @@ Module for handling, parsing, and checking configuration files
 from sklearn.metrics import make_scorer
 from configobj import ConfigObj
 import logging
+import os
 
-from . import metrics, utils
+from . import metrics, utils, stage_cache
 from .legos.model_finder import check_models_mixed
 from .legos import feature_selectors, model_finder
 
@@ -80,7 +81,8 @@ def parse_conf_file(filepath):
 
     def check_general_setup_settings_are_valid():
         all_settings =  ['input_features', 'target_feature', 'metrics',
-                         'randomizer', 'validation_columns', 'not_input_features', 'grouping_feature']
+                         'randomizer', 'validation_columns', 'not_input_features', 'grouping_feature',
+                         'n_jobs', 'cache_dir', 'cache_max_size']
         for name in GS:
             if name not in all_settings:
                 raise utils.InvalidConfParameters(
@@ -129,6 +131,25 @@ def parse_conf_file(filepath):
             GS['randomizer'] = False
     set_randomizer_setting()
 
+    def set_n_jobs_setting():
+        # worker processes for normalizer/selector/model/splitter combos, -1 for one per core
+        n_jobs = fix_types(GS['n_jobs']) if 'n_jobs' in GS else 1
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        if type(n_jobs) is not int or n_jobs < 1:
+            raise utils.InvalidValue(f"[GeneralSetup] n_jobs must be a positive integer or -1, not {GS['n_jobs']}")
+        GS['n_jobs'] = n_jobs
+    set_n_jobs_setting()
+
+    def set_cache_settings():
+        # where normalizer, selector and model outputs are kept between runs, None to not keep them
+        GS['cache_dir'] = GS.get('cache_dir')
+        max_size = fix_types(GS['cache_max_size']) if 'cache_max_size' in GS else stage_cache.DEFAULT_MAX_SIZE
+        if type(max_size) not in (int, float) or max_size <= 0:
+            raise utils.InvalidValue(f"[GeneralSetup] cache_max_size must be a positive number of bytes, not {GS['cache_max_size']}")
+        GS['cache_max_size'] = max_size
+    set_cache_settings()
+
 
     def set_default_features():
         for name in ['input_features', 'target_feature']:
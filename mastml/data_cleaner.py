@@ -10,6 +10,8 @@ from sklearn.preprocessing import Imputer
 import os
 from scipy.linalg import orth
 
+from .column_screening import ColumnScreen
+
 log = logging.getLogger('mastml')
 
 def remove(df, axis):
@@ -18,9 +20,33 @@ def remove(df, axis):
     #df_nan = df[pd.isnull(df)]
     #nan_indices = df_nan.index
     #print(nan_indices)
+    if axis == 1:
+        return remove_columns(df)[0]
     df = df.dropna(axis=axis, how='any')
     return df
 
+def remove_columns(df, *subsets):
+    """
+    Removes every column of df with a missing value (NaN or None, which is what read_csv makes of
+    empty cells, but not strings of whitespace), screening df just once, and the same columns
+    from each of subsets (dataframes of some of df's columns, or None). This is what
+    df.dropna(axis=1) removes.
+    Returns df and the subsets with those columns removed.
+    """
+    screen = ColumnScreen(df, coerce=False)
+    keep = screen.keep_columns(missing=True, constant=False, duplicates=False)
+    screen.log_dropped(keep, 'columns')
+    # a name df has more than once can't say which of its columns a subset holds, so those are
+    # checked in the subset itself
+    unique = ~df.columns.duplicated(keep=False)
+    keep_by_name = dict(zip(df.columns[unique], keep[unique]))
+    def remove_from(subset):
+        subset_keep = [keep_by_name[name] if name in keep_by_name else not subset.iloc[:, j].isna().any()
+                       for j, name in enumerate(subset.columns)]
+        return subset.iloc[:, np.flatnonzero(subset_keep)]
+    subsets = [remove_from(subset) if subset is not None else None for subset in subsets]
+    return (screen.frame(keep), *subsets)
+
 def imputation(df, strategy, cols_to_leave_out=None):
     # Impute values to the missing places based on the median, mean, etc. of the data in the column
     if cols_to_leave_out is None:
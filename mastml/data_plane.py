@@ -0,0 +1,275 @@
+"""
+Module for publishing the frames every combo and split reads (X, y, X_noinput, grouping data)
+once, as read-only memory-mapped blocks which worker processes attach to by name:
+
+    with DataPlane() as plane:
+        X_handle = plane.publish('X', X)
+        ...
+        # in a worker, only the handle and the index arrays of a split are needed
+        train_X = X_handle.loc(train_indices)
+
+Blocks are written under /dev/shm where there is one, so they are shared memory rather than
+files on disk. A handle holds only the paths, dtypes and column/index metadata of its blocks, so
+it is cheap to send to another process, and attaching maps the blocks without reading them.
+
+Blocks live in memory until they are removed, so they are removed when the process exits or
+is sent SIGTERM (while the plane is open) as well, and the blocks of processes which died without
+removing theirs (killed outright, say) are removed by the next DataPlane made.
+
+Without worker processes there is nothing to share, and a DataPlane(shared=False) hands out
+handles to the data as it is, in memory, rather than writing a copy of it into blocks.
+"""
+
+import os
+import sys
+import glob
+import atexit
+import shutil
+import signal
+import logging
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger('mastml')
+
+class DataPlane(object):
+    """
+    Directory of published blocks, removed again by close() or on leaving a with block.
+
+    Args:
+        directory (str) : where to make the directory of blocks, defaults to /dev/shm if it
+            exists, or the temporary directory otherwise
+        shared (bool) : whether the data is published for other processes, if False handles
+            are to the data in this process and no blocks are written
+    """
+
+    def __init__(self, directory=None, shared=True):
+        self.pid = os.getpid()
+        self.shared = shared
+        self.handles = dict()
+        self.path = None
+        if not shared:
+            return
+        if directory is None and os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            directory = '/dev/shm'
+        _remove_stale(directory or tempfile.gettempdir())
+        # the pid in the name says whether the blocks are still in use, see _remove_stale
+        self.path = tempfile.mkdtemp(prefix=f'mastml_data_{self.pid}_', dir=directory)
+        atexit.register(self.close)
+        self._previous_sigterm = _exit_on_sigterm()
+
+    def publish(self, name, data):
+        """
+        Writes data (a DataFrame, Series or 1d array) into blocks, one per dtype, and returns
+        the FrameHandle workers attach to it with. Also kept as handles[name].
+        """
+        if name in self.handles:
+            raise ValueError(f'{name} is already published')
+        if not self.shared:
+            handle = LocalHandle(name, data)
+            self.handles[name] = handle
+            return handle
+        kind, df = _as_frame(data)
+
+        blocks = list()
+        # columns with the same dtype share a block, in fortran order like pandas keeps them, so
+        # frames sit on the blocks without a copy and models get the same arrays they did before
+        positions_by_dtype = dict()
+        for position, dtype in enumerate(df.dtypes):
+            positions_by_dtype.setdefault(_block_dtype(dtype), []).append(position)
+        for i, (dtype, positions) in enumerate(positions_by_dtype.items()):
+            values = df.iloc[:, positions]
+            path = os.path.join(self.path, f'{len(self.handles)}_{i}.npy')
+            if dtype == object:
+                # python objects (strings, or a mix of anything) can't be mapped, so they're
+                # pickled and every process reads its own copy, exactly as they were
+                np.save(path, values.values.astype(object), allow_pickle=True)
+                blocks.append((path, True, positions))
+                continue
+            block = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=values.shape, fortran_order=True)
+            block[:] = values.values
+            block.flush()
+            del block
+            blocks.append((path, False, positions))
+
+        handle = FrameHandle(name, kind, blocks, df.columns, df.index, df.dtypes.values,
+                             data.name if kind == 'series' else None)
+        self.handles[name] = handle
+        log.debug(f'Published {name} {df.shape} in {len(blocks)} blocks to {self.path}')
+        return handle
+
+    def close(self):
+        " Removes the blocks, any attached handles keep them mapped until they are done "
+        if os.getpid() != self.pid:
+            return # a forked copy, the blocks are the parent's
+        self.handles.clear()
+        if self.path is None:
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path = None
+        atexit.unregister(self.close)
+        _restore_sigterm(self._previous_sigterm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _remove_stale(directory):
+    " Removes the blocks in directory of DataPlanes whose process is gone "
+    for path in glob.glob(os.path.join(directory, 'mastml_data_*_*')):
+        try:
+            pid = int(os.path.basename(path).split('_')[2])
+        except ValueError:
+            continue
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            log.debug(f'Removing {path}, left by process {pid} which is gone')
+            shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass # alive, but someone else's
+
+def _exit_on_sigterm():
+    """
+    Makes SIGTERM exit like sys.exit(), unwinding with blocks and running atexit, which the
+    default handler doesn't. Handlers someone else set are left alone. Returns the handler
+    replaced, for _restore_sigterm, or None if there wasn't one.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return None
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _sigterm_exit)
+        return signal.SIG_DFL
+    return None
+
+def _restore_sigterm(previous):
+    " Puts back the handler _exit_on_sigterm replaced, unless someone has set another since "
+    if previous is None or threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is _sigterm_exit:
+        signal.signal(signal.SIGTERM, previous)
+
+def _sigterm_exit(signum, frame):
+    sys.exit(128 + signum)
+
+def _as_frame(data):
+    " (kind, data as a DataFrame) for a DataFrame, Series or 1d array "
+    kind = 'frame' if isinstance(data, pd.DataFrame) else 'series' if isinstance(data, pd.Series) else 'array'
+    if kind == 'array':
+        return kind, pd.DataFrame({0: np.asarray(data)})
+    if kind == 'series':
+        return kind, data.to_frame(name=0)
+    return kind, data
+
+def _block_dtype(dtype):
+    " Dtype of the block a column of dtype goes into, object for anything numpy can't map "
+    if isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM':
+        return dtype
+    return np.dtype(object)
+
+class FrameHandle(object):
+    """
+    A published frame, which can be attached to in any process which can see its blocks.
+
+    frame() gives the whole frame on top of the mapped blocks, and take()/loc() the rows at some
+    positions/index labels, copying only those rows.
+    """
+
+    def __init__(self, name, kind, blocks, columns, index, dtypes, series_name=None):
+        self.name = name
+        self.kind = kind
+        self.blocks = blocks # (path, whether it's pickled objects rather than mapped, column positions)
+        self.columns = columns
+        self.index = index
+        self.dtypes = dtypes
+        self.series_name = series_name
+        self._attached = None
+
+    @property
+    def shape(self):
+        return (len(self.index), len(self.columns))
+
+    def attach(self):
+        " The whole published data, on top of read-only maps of the blocks, made once per process "
+        if self._attached is None or self._attached[0] != os.getpid():
+            self._attached = (os.getpid(), self._read())
+        return self._attached[1]
+
+    def _read(self):
+        by_position = dict()
+        blocks = list()
+        for path, pickled, positions in self.blocks:
+            block = np.load(path, allow_pickle=True) if pickled else np.load(path, mmap_mode='r')
+            blocks.append(block)
+            for j, position in enumerate(positions):
+                by_position[position] = block[:, j]
+        if len(blocks) == 1 and blocks[0].dtype.kind != 'O':
+            # one block of every column in order, so the frame can sit right on top of it
+            df = pd.DataFrame(blocks[0], index=self.index, columns=self.columns, copy=False)
+        else:
+            df = pd.DataFrame(index=self.index)
+            if by_position:
+                df = pd.concat([pd.Series(by_position[position], index=self.index).astype(dtype)
+                                for position, dtype in enumerate(self.dtypes)], axis=1)
+            df.columns = self.columns
+        if self.kind == 'series':
+            return df.iloc[:, 0].rename(self.series_name)
+        if self.kind == 'array':
+            return df.iloc[:, 0].values
+        return df
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_attached'] = None # maps belong to the process that made them
+        return state
+
+    def frame(self):
+        " The whole frame (or series or array), a view of the blocks "
+        return self.attach()
+
+    def take(self, rows):
+        " The rows at positions rows, copied out of the blocks "
+        data = self.attach()
+        if self.kind == 'array':
+            return data[rows]
+        return data.take(rows)
+
+    def loc(self, labels):
+        " The rows with index labels "
+        rows = self.index.get_indexer(labels)
+        if (rows == -1).any():
+            raise KeyError(f'{np.asarray(labels)[rows == -1][:10]} not in the index of {self.name}')
+        return self.take(rows)
+
+    def reindex(self, labels):
+        " The rows with index labels, like loc but with missing rows for labels not in the index "
+        rows = self.index.get_indexer(labels)
+        if (rows == -1).any():
+            return self.take(rows[rows != -1]).reindex(labels)
+        return self.take(rows)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.name!r}, {self.kind}, shape={self.shape})'
+
+class LocalHandle(FrameHandle):
+    """
+    A FrameHandle to data in this process, as published by a DataPlane which isn't shared.
+    Forked processes see the data too, but sending it to any other process copies it.
+    """
+
+    def __init__(self, name, data):
+        kind, df = _as_frame(data)
+        super().__init__(name, kind, [], df.columns, df.index, df.dtypes.values,
+                         data.name if kind == 'series' else None)
+        self.data = np.asarray(data) if kind == 'array' else data
+
+    def attach(self):
+        return self.data
+
+    def __getstate__(self):
+        return self.__dict__.copy()
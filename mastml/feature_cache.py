@@ -0,0 +1,182 @@
+"""
+Module for caching generated features on disk, so reruns on a growing csv only have to
+generate features for the rows that are new, and so remote featurizers don't have to ask
+again for compositions they already have answers for.
+"""
+
+import os
+import glob
+import time
+import json
+import sqlite3
+import contextlib
+import hashlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger('mastml')
+
+class MagpieFeatureCache(object):
+    """
+    Persistent cache of computed Magpie features, keyed by canonical composition.
+
+    Lives in a subdirectory of cache_dir named after a hash of the magpie tables and of the
+    feature columns, so editing the tables or selecting other features starts a fresh cache. Each append() writes one chunk: a column-major .npy
+    matrix (opened memory-mapped, so lookups only read the rows they need) and a .npy of its
+    composition keys. Chunks are merged into one once there are more than max_chunks.
+
+    Args:
+        cache_dir (str) : directory to keep caches in, created if needed
+        table (ElementPropertyTable) : the table the features are computed from
+        columns (list of str) : names of the feature columns cached for each composition
+        max_chunks (int) : merge chunks after this many appends
+    """
+
+    version = 1 # bump when the way cached features are computed changes
+
+    def __init__(self, cache_dir, table, columns, max_chunks=32):
+        columns_digest = hashlib.sha1('\n'.join(columns).encode()).hexdigest()[:8]
+        self.path = os.path.join(os.path.abspath(cache_dir),
+                                 f'magpie_v{self.version}_{table.digest}_{columns_digest}')
+        os.makedirs(self.path, exist_ok=True)
+        self.n_columns = len(columns)
+        self.max_chunks = max_chunks
+        self._load()
+
+    def _chunk_names(self):
+        return sorted(path[:-len('.keys.npy')] for path in glob.glob(os.path.join(self.path, 'chunk_*.keys.npy')))
+
+    def _load(self):
+        self.chunks = list()
+        keys = list()
+        for name in self._chunk_names():
+            chunk_keys = np.load(name + '.keys.npy')
+            self.chunks.append(np.load(name + '.npy', mmap_mode='r'))
+            keys.append(pd.DataFrame({'key': chunk_keys, 'chunk': len(self.chunks) - 1,
+                                      'row': np.arange(len(chunk_keys))}))
+        if keys:
+            # if two runs cached the same composition, use the newest
+            self.index = pd.concat(keys, ignore_index=True).drop_duplicates('key', keep='last').set_index('key')
+        else:
+            self.index = pd.DataFrame({'chunk': [], 'row': []}, dtype=int, index=pd.Index([], name='key'))
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, keys):
+        """
+        Returns (values, found) for a list of keys, where values is a (len(keys) x n_columns)
+        array that is NaN wherever found is False.
+        """
+        values = np.full((len(keys), self.n_columns), np.nan)
+        positions = self.index.index.get_indexer(keys)
+        found = positions >= 0
+        locations = self.index.iloc[positions[found]]
+        found_numbers = np.flatnonzero(found)
+        for chunk_number, rows in locations.groupby('chunk')['row']:
+            in_chunk = found_numbers[(locations['chunk'] == chunk_number).values]
+            values[in_chunk] = self.chunks[int(chunk_number)][rows.values]
+        return values, found
+
+    def append(self, keys, values):
+        " Stores values (len(keys) x n_columns) for keys as a new chunk "
+        if len(keys) == 0:
+            return
+        values = np.asfortranarray(values, dtype=float)
+        assert values.shape == (len(keys), self.n_columns)
+        name = self._new_chunk_name()
+        # write the matrix first, a chunk only counts once its keys file exists
+        self._save_atomic(name + '.npy', values)
+        self._save_atomic(name + '.keys.npy', np.asarray(keys, dtype=str))
+        log.debug(f'Cached Magpie features for {len(keys)} new compositions in {self.path}')
+
+        if len(self._chunk_names()) > self.max_chunks:
+            self._merge_chunks()
+        self._load()
+
+    def _merge_chunks(self):
+        names = self._chunk_names()
+        self._load()
+        keys = self.index.index.values
+        values, _ = self.lookup(keys)
+        self.chunks = list()
+        merged = self._new_chunk_name()
+        self._save_atomic(merged + '.npy', np.asfortranarray(values))
+        self._save_atomic(merged + '.keys.npy', np.asarray(keys, dtype=str))
+        for name in names:
+            os.remove(name + '.keys.npy')
+            os.remove(name + '.npy')
+
+    def _new_chunk_name(self):
+        # names sort oldest first, which is the order _load reads chunks in
+        return os.path.join(self.path, 'chunk_%020d_%d' % (int(time.time() * 1e9), os.getpid()))
+
+    @staticmethod
+    def _save_atomic(path, array):
+        temp_path = path + f'.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(temp_path, path)
+
+class ResponseCache(object):
+    """
+    Persistent cache of the per-composition responses of a remote featurizer (e.g. the
+    condensed property dict from Materials Project), in an SQLite file.
+
+    Entries are keyed by provider, canonical formula and a hash of the list of properties the
+    provider was asked for, so asking for other properties never returns stale answers.
+    Responses must be json serializable, and come back from lookup() as json decodes them.
+
+    Args:
+        path (str) : SQLite file to keep responses in, created if needed
+        provider (str) : name of the remote source, e.g. 'MaterialsProject'
+        properties (list of str) : properties asked for, part of every key
+        ttl (float) : seconds until a response expires, None to keep them forever
+    """
+
+    def __init__(self, path, provider, properties, ttl=None):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.provider = provider
+        self.properties = hashlib.sha1('\n'.join(properties).encode()).hexdigest()[:16]
+        self.ttl = ttl
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS responses (provider TEXT, formula TEXT, '
+                               'properties TEXT, fetched REAL, response TEXT, '
+                               'PRIMARY KEY (provider, formula, properties))')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # a connection per call, so the cache can be shared between threads and processes
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            with connection: # commits, or rolls back on errors
+                yield connection
+        finally:
+            connection.close()
+
+    def lookup(self, formulas):
+        " Returns the cached response for each formula, or None where there isn't a fresh one "
+        oldest = -float('inf') if self.ttl is None else time.time() - self.ttl
+        found = dict()
+        with self._connect() as connection:
+            # sqlite limits how many parameters one statement can have
+            for start in range(0, len(formulas), 500):
+                batch = list(formulas[start:start+500])
+                rows = connection.execute(
+                    f'SELECT formula, response FROM responses WHERE provider = ? AND properties = ? '
+                    f'AND fetched >= ? AND formula IN ({",".join("?" * len(batch))})',
+                    [self.provider, self.properties, oldest] + batch)
+                found.update((formula, json.loads(response)) for formula, response in rows)
+        return [found.get(formula) for formula in formulas]
+
+    def store(self, formulas, responses):
+        " Saves one response per formula, replacing older ones "
+        now = time.time()
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                   [(self.provider, formula, self.properties, now, json.dumps(response))
+                                    for formula, response in zip(formulas, responses)])
+        log.debug(f'Cached {len(formulas)} {self.provider} responses in {self.path}')
@@ -0,0 +1,170 @@
+"""
+Module for running only the [FeatureGeneration] section of a conf file on a csv, without
+the rest of the mastml pipeline.
+
+The csv is streamed in chunks of rows, and generated features are appended to the output
+csv chunk by chunk, so files much larger than memory can be featurized:
+
+    python -m mastml.featurize settings.conf candidates.csv -o candidates_features.csv --chunksize 50000
+"""
+
+import argparse
+import os
+import pickle
+import logging
+from tempfile import TemporaryDirectory
+
+import pandas as pd
+
+from . import conf_parser, utils
+from .column_screening import ColumnScreen
+from .legos import feature_generators, util_legos
+from .mastml import _instantiate
+
+log = logging.getLogger('mastml')
+
+def featurize(conf_path, data_path, out_path, chunksize=100000, features_only=False):
+    """
+    Streams data_path through every [FeatureGeneration] lego in conf_path and writes the input
+    columns (unless features_only) plus the generated features to out_path.
+
+    Generators are fit on the first chunk. Generators which clean their features (see
+    feature_generators.clean_dataframe) are cleaned once over the whole file rather than chunk by
+    chunk, so the output is the same for any chunksize: every chunk is generated into a temporary
+    directory next to out_path, and only once the columns to keep are known is out_path written.
+    Returns the number of rows written.
+    """
+    if os.path.splitext(data_path)[1] != '.csv':
+        raise utils.FiletypeError(f"Only .csv files can be streamed: '{data_path}'")
+    if not os.path.isfile(data_path):
+        raise utils.FileNotFoundError(f"No such file: {data_path}")
+
+    conf = conf_parser.parse_conf_file(conf_path)
+    generators = _instantiate(conf['FeatureGeneration'],
+                              feature_generators.name_to_constructor,
+                              'featuregenerator')
+    log.debug(f'generators: \n{generators}')
+    transforms = [instance for _, instance in generators]
+    screens = list()
+    for instance in transforms:
+        if 'clean' in instance.get_params() and instance.get_params()['clean']:
+            instance.set_params(clean=False)
+            screens.append(_MissingScreen())
+        else:
+            screens.append(None)
+    # generators run concurrently, and their columns are concatenated in conf order
+    union = util_legos.DataFrameFeatureUnion(transforms)
+
+    with TemporaryDirectory(prefix='featurize_', dir=os.path.dirname(os.path.abspath(out_path))) as scratch:
+        n_chunks = n_generated = 0
+        for chunk_number, chunk in enumerate(pd.read_csv(data_path, chunksize=chunksize)):
+            # generators line their output up by row position, like a freshly loaded csv
+            chunk = chunk.reset_index(drop=True)
+            if chunk_number == 0:
+                union.fit(chunk)
+            frames = union.transform_each(chunk)
+            for screen, frame in zip(screens, frames):
+                if screen is not None:
+                    screen.add(frame)
+            with open(os.path.join(scratch, f'{chunk_number}.pkl'), 'wb') as f:
+                pickle.dump((chunk, frames), f, protocol=pickle.HIGHEST_PROTOCOL)
+            n_chunks += 1
+            n_generated += len(chunk)
+            log.info(f'Generated features for {n_generated} rows...')
+
+        n_rows = 0
+        for chunk_number in range(n_chunks):
+            with open(os.path.join(scratch, f'{chunk_number}.pkl'), 'rb') as f:
+                chunk, frames = pickle.load(f)
+            frames = [frame if screen is None else screen.frame(frame) for screen, frame in zip(screens, frames)]
+            generated = pd.concat(frames, axis=1)
+            generated = generated.loc[:, ~generated.columns.duplicated()]
+            if not features_only:
+                # like mastml_run, keep the input column when names clash
+                generated = pd.concat([chunk, generated.drop(columns=generated.columns.intersection(chunk.columns))], axis=1)
+            generated.to_csv(out_path, mode='w' if chunk_number == 0 else 'a',
+                             header=(chunk_number == 0), index=False)
+            n_rows += len(chunk)
+            log.info(f'Featurized {n_rows} rows...')
+
+    return n_rows
+
+class _MissingScreen(object):
+    """
+    clean_dataframe, over the frames a generator makes for every chunk rather than one frame:
+    empty rows are left empty, and columns with a missing value in any other row of any chunk
+    are dropped. Columns a chunk doesn't make at all count as missing in that chunk.
+    """
+
+    def __init__(self):
+        self.columns = list() # in the order they were first made
+        self.missing = set()
+        self.seen_rows = False # whether any chunk so far had a row which wasn't empty
+
+    def add(self, frame):
+        screen = ColumnScreen(frame)
+        n_missing = screen.n_missing - screen.empty_rows.sum()
+        known = set(self.columns)
+        for position, name in enumerate(frame.columns):
+            if name not in known:
+                known.add(name)
+                self.columns.append(name)
+                if self.seen_rows: # earlier chunks didn't make it
+                    self.missing.add(name)
+            if n_missing[position] > 0 or pd.api.types.is_bool_dtype(frame.dtypes.iloc[position]):
+                self.missing.add(name) # clean_dataframe drops bools too
+        if not screen.empty_rows.all():
+            self.missing.update(known.difference(frame.columns))
+            self.seen_rows = True
+
+    def keep(self):
+        return [name for name in self.columns if name not in self.missing]
+
+    def frame(self, frame):
+        " The kept columns of frame, as numbers "
+        frame = frame.loc[:, ~frame.columns.duplicated()].reindex(columns=self.keep())
+        strings = frame.columns[[not pd.api.types.is_numeric_dtype(dtype) for dtype in frame.dtypes]]
+        if len(strings) > 0:
+            frame[strings] = frame[strings].apply(pd.to_numeric, errors='coerce')
+        return frame
+
+def main(conf_path, data_path, out_path, chunksize=100000, features_only=False, verbosity=0):
+    " Sets up logging and error catching, then featurizes "
+    utils.activate_logging(os.path.dirname(out_path), (conf_path, data_path, out_path),
+                           to_file=False, verbosity=verbosity)
+    try:
+        featurize(conf_path, data_path, out_path, chunksize, features_only)
+    except utils.MastError as e:
+        # catch user errors, log and print, but don't raise and show them that nasty stack
+        log.error(str(e))
+    return out_path
+
+def get_commandline_args():
+    parser = argparse.ArgumentParser(description='MAterials Science Toolkit - Machine Learning: '
+                                                 'feature generation only')
+    parser.add_argument('conf_path', type=str, help='path to mastml .conf file')
+    parser.add_argument('data_path', type=str, help='path to csv file')
+    parser.add_argument('-o', action="store", dest='out_path', default='generated_features.csv',
+                        help='csv file to write features to. Defaults to generated_features.csv')
+    parser.add_argument('--chunksize', type=int, default=100000,
+                        help='number of csv rows to featurize at a time. Defaults to 100000')
+    parser.add_argument('--features-only', action='store_true',
+                        help='only write generated features, not the input columns')
+    parser.add_argument('-v', '--verbosity', action="count",
+                        help="include this flag for more verbose output")
+    parser.add_argument('-q', '--quietness', action="count",
+                       help="include this flag to hide [DEBUG] printouts, or twice to hide [INFO]")
+
+    args = parser.parse_args()
+    verbosity = (args.verbosity if args.verbosity else 0)\
+            - (args.quietness if args.quietness else 0)
+    return (os.path.abspath(args.conf_path),
+            os.path.abspath(args.data_path),
+            os.path.abspath(args.out_path),
+            args.chunksize,
+            args.features_only,
+            verbosity)
+
+if __name__ == '__main__':
+    conf_path, data_path, out_path, chunksize, features_only, verbosity = get_commandline_args()
+    main(conf_path, data_path, out_path, chunksize, features_only, verbosity)
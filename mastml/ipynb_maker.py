@@ -9,8 +9,6 @@ import os
 import textwrap
 from pandas import DataFrame, Series
 
-import nbformat
-
 from . import plot_helper # TODO: fix cyclic import
 
 def ipynb_maker(plot_func):
@@ -98,6 +96,7 @@ def ipynb_maker(plot_func):
                     display(Image(filename=plot_path))
             """)
 
+        import nbformat # slow to import, so only once a notebook is written
         nb = nbformat.v4.new_notebook()
         readme_cell = nbformat.v4.new_markdown_cell(readme)
         text_cells = [header, func_strings, plot_func_string, args_block, main]
@@ -4,56 +4,123 @@ All classes here assume dataframe input and guarantee dataframe output
 (So no numpy arrays)
 """
 
+import itertools
+import inspect
 import multiprocessing
+import concurrent.futures
+import threading
+import random
+import time
 import os
 import logging
 
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.preprocessing import PolynomialFeatures as SklearnPolynomialFeatures
 
-import pymatgen
-from pymatgen import Element, Composition
-from pymatgen.ext.matproj import MPRester
-from citrination_client import CitrinationClient, PifQuery, SystemQuery, ChemicalFieldQuery, ChemicalFilter
-# trouble? try: `pip install citrination_client=="2.1.0"`
-
-# locate path to directory containing AtomicNumber.table, AtomicRadii.table AtomicVolume.table, etc
-# (needs to do it the hard way becuase python -m sets cwd to wherever python is ran from)
-import mastml
 from mastml import utils
+from mastml.magpie_data import MAGPIE_DATA_PATH, ElementPropertyTable
+from mastml.column_screening import ColumnScreen
+from mastml.compositions import CompositionIndex, parse_composition, element_index, element_symbol
+from mastml.feature_cache import MagpieFeatureCache, ResponseCache
+from mastml.materials_project_mirror import MaterialsProjectMirror
+from . import util_legos
+
 log = logging.getLogger('mastml')
-print('mastml dir: ', mastml.__path__)
-MAGPIE_DATA_PATH = os.path.join(mastml.__path__[0], '../magpie/')
 
 class PolynomialFeatures(BaseEstimator, TransformerMixin):
-    def __init__(self, features=None, degree=2, interaction_only=False, include_bias=True):
+    """
+    Wraps sklearn's PolynomialFeatures, transforming chunk_size rows at a time into one
+    preallocated output of dtype (e.g. float32), or a sparse frame with sparse=True.
+    With variance_threshold, generated terms whose variance on the fitting data is not above
+    it are left out, without ever holding every generated term for every row.
+    """
+    bound = util_legos.CPU_BOUND
+
+    def __init__(self, features=None, degree=2, interaction_only=False, include_bias=True,
+                 dtype='float64', sparse=False, chunk_size=10000, variance_threshold=None):
         self.features = features
+        self.degree = degree
+        self.interaction_only = interaction_only
+        self.include_bias = include_bias
+        self.dtype = dtype
+        self.sparse = sparse
+        self.chunk_size = chunk_size
+        self.variance_threshold = variance_threshold
         self.SPF = SklearnPolynomialFeatures(degree, interaction_only, include_bias)
+
     def fit(self, df, y=None):
         if self.features is None:
             self.features = df.columns
         array = df[self.features].values
         self.SPF.fit(array)
+        self.keep = np.ones(self.SPF.n_output_features_, dtype=bool)
+        if self.variance_threshold is not None:
+            self.keep = self._get_variances(array) > self.variance_threshold
+            log.info(f'PolynomialFeatures keeping {self.keep.sum()}/{len(self.keep)} terms with variance '
+                     f'above {self.variance_threshold}')
         return self
+
     def transform(self, df):
         array = df[self.features].values
-        new_features = self.SPF.get_feature_names(self.features)
-        return pd.DataFrame(self.SPF.transform(array), columns=new_features)
+        new_features = [name for name, keep in zip(self.SPF.get_feature_names(self.features), self.keep) if keep]
+        dtype = np.dtype(self.dtype)
+        log.info(f'PolynomialFeatures generating {len(array)} x {len(new_features)} features, '
+                 f'{len(array) * len(new_features) * dtype.itemsize / 2**20:.1f} MB before sparsity')
+
+        chunks = self._iter_chunks(array)
+        if self.sparse:
+            blocks = [scipy.sparse.csr_matrix(chunk.astype(dtype)) for chunk in chunks]
+            matrix = (scipy.sparse.vstack(blocks, format='csr') if blocks
+                      else scipy.sparse.csr_matrix((0, len(new_features)), dtype=dtype))
+            return _sparse_frame(matrix, df.index, new_features)
+        generated = np.empty((len(array), len(new_features)), dtype=dtype, order='F')
+        start = 0
+        for chunk in chunks:
+            generated[start:start+len(chunk)] = chunk
+            start += len(chunk)
+        return pd.DataFrame(generated, index=df.index, columns=new_features, copy=False)
+
+    def _iter_chunks(self, array):
+        " The kept generated terms of chunk_size rows of array at a time "
+        for start in range(0, len(array), self.chunk_size):
+            yield self.SPF.transform(array[start:start+self.chunk_size])[:, self.keep]
+
+    def _get_variances(self, array):
+        " Variance of every generated term over array, merging chunk statistics (Chan et al.) "
+        count = 0
+        mean = np.zeros(self.SPF.n_output_features_)
+        squares = np.zeros(self.SPF.n_output_features_) # sum of squared differences from mean
+        for start in range(0, len(array), self.chunk_size):
+            chunk = self.SPF.transform(array[start:start+self.chunk_size]).astype(float)
+            chunk_mean = chunk.mean(axis=0)
+            chunk_squares = ((chunk - chunk_mean)**2).sum(axis=0)
+            delta = chunk_mean - mean
+            total = count + len(chunk)
+            mean += delta * len(chunk) / total
+            squares += chunk_squares + delta**2 * count * len(chunk) / total
+            count = total
+        return squares / max(count, 1)
 
 class ContainsElement(BaseEstimator, TransformerMixin):
     """
     Returns a new dataframe with a row containing 1 or 0 depending on if composition feature has
     element in it. The new column's name is saved in self.new_column_name, which you'll need.
+    With all_elements=True there is one has_<element> column for every element in any of the
+    compositions instead, and with sparse=True those columns are kept sparse.
     """
+    bound = util_legos.CPU_BOUND
 
-    def __init__(self, composition_feature, element, new_name, all_elements=False):
+
+    def __init__(self, composition_feature, element, new_name, all_elements=False, sparse=False):
         self.composition_feature = composition_feature
         self.element = element
         self.new_column_name = new_name #f'has_{self.element}'
         self.all_elements = all_elements
+        self.sparse = sparse
 
     def fit(self, df, y=None):
         return self
@@ -74,50 +141,109 @@ class ContainsElement(BaseEstimator, TransformerMixin):
         something crazy like "contains {element}" and "does not contain {element}" if you really
         wanted.
         """
-        comp = pymatgen.Composition(comp)
-        count = comp[self.element]
-        return int(count != 0)
+        comp = parse_composition(comp)
+        return int(element_index(self.element) in comp.elements)
 
     def _contains_all_elements(self, compositions):
-        elements = list()
-        df_trans = pd.DataFrame()
-        for comp in compositions.values:
-            comp = pymatgen.Composition(comp)
-            for element in comp.elements:
-                if element not in elements:
-                    elements.append(element)
-        for element in elements:
-            self.element = element
-            self.new_column_name = "has_"+str(self.element)
-            has_element = compositions.apply(self._contains_element)
-            df_trans[self.new_column_name] = has_element
-        return df_trans
+        """
+        Parses each distinct composition once into a sparse (rows x elements) presence matrix,
+        with elements in order of first appearance, and returns it as has_<element> columns.
+        """
+        composition_index = CompositionIndex(compositions.values, ordered=True)
+        n_elements = np.array([len(comp.elements) for comp in composition_index.compositions], dtype=int)
+        element_indices = np.fromiter(itertools.chain.from_iterable(comp.elements for comp in composition_index.compositions),
+                                      dtype=int, count=n_elements.sum())
+        elements = pd.unique(element_indices)
+        element_to_column = np.zeros(elements.max(initial=-1) + 1, dtype=int)
+        element_to_column[elements] = np.arange(len(elements))
+
+        presence = scipy.sparse.csr_matrix(
+            (np.ones(len(element_indices), dtype=int),
+             (np.repeat(np.arange(len(n_elements)), n_elements), element_to_column[element_indices])),
+            shape=(len(n_elements), len(elements)))
+        presence = presence[composition_index.row_to_unique]
+        columns = ['has_' + element_symbol(element) for element in elements]
+
+        if not self.sparse:
+            return pd.DataFrame(presence.toarray(), index=compositions.index, columns=columns)
+        return _sparse_frame(presence, compositions.index, columns)
 
 class Magpie(BaseEstimator, TransformerMixin):
-    " Wraps MagpieFeatureGeneration "
-    def __init__(self, composition_feature):
+    """
+    Wraps MagpieFeatureGeneration
+    properties and statistics restrict generation to those elemental properties (magpie table
+    names, e.g. AtomicNumber) and statistics (composition_average, arithmetic_average,
+    max_value, min_value, difference), and only those are computed. Both default to all of them.
+    site_features=False skips the SiteN_ features.
+    dtype (e.g. float32) is the dtype the features are generated in.
+    If cache_dir is given, features are cached there between runs and only compositions
+    which aren't in the cache yet are computed.
+    With n_jobs > 1 (or -1 for all cores), distinct compositions are split into chunks of
+    chunk_size and computed in that many processes.
+    clean=False returns the features as generated, without dropping empty rows and columns
+    with missing values (see clean_dataframe).
+    """
+    bound = util_legos.CPU_BOUND
+
+    def __init__(self, composition_feature, cache_dir=None, n_jobs=1, chunk_size=10000,
+                 properties=None, statistics=None, site_features=True, dtype='float64', clean=True):
         self.composition_feature = composition_feature
+        self.cache_dir = cache_dir
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.properties = properties
+        self.statistics = statistics
+        self.site_features = site_features
+        self.dtype = dtype
+        self.clean = clean
 
     def fit(self, df, y=None):
         self.original_features = df.columns
         return self
 
     def transform(self, df):
-        mfg = MagpieFeatureGeneration(df, self.composition_feature)
-        df = mfg.generate_magpie_features()
+        mfg = MagpieFeatureGeneration(df, self.composition_feature, cache_dir=self.cache_dir,
+                                      n_jobs=self.n_jobs, chunk_size=self.chunk_size,
+                                      properties=self.properties, statistics=self.statistics,
+                                      site_features=self.site_features)
+        df = mfg.generate_magpie_features(dtype=self.dtype)
 
-        df = df.drop(self.original_features, axis=1)
         # delete missing values, generation makes a lot of garbage.
-        df = clean_dataframe(df)
-        df = df.select_dtypes(['number']).dropna(axis=1)
+        if self.clean:
+            df = clean_dataframe(df)
         assert self.composition_feature not in df.columns
         return df
 
 class MaterialsProject(BaseEstimator, TransformerMixin):
-    " Wraps MaterialsProjectFeatureGeneration "
-    def __init__(self, composition_feature, api_key):
+    """
+    Wraps MaterialsProjectFeatureGeneration, dtype (e.g. float32) is the dtype the features are generated in.
+    Up to n_jobs compositions are queried at once. endpoint overrides the Materials Project
+    REST url, e.g. for a local mirror or test server.
+    If cache_dir is given, responses are cached there (for cache_ttl seconds, or forever) and
+    only compositions without a cached response are queried. offline=True only uses the cache.
+    mirror is the path of a local Materials Project mirror (see mastml.materials_project_mirror)
+    to look compositions up in instead of querying Materials Project, cache_dir and offline
+    aren't used with one.
+    rate_limit caps queries per second, and failed queries are retried up to max_retries times.
+    clean=False returns the features as generated, like for Magpie.
+    """
+    bound = util_legos.IO_BOUND
+
+    def __init__(self, composition_feature, api_key=None, dtype='float64', n_jobs=8, endpoint=None,
+                 cache_dir=None, cache_ttl=None, offline=False, mirror=None, rate_limit=None, max_retries=3,
+                 clean=True):
         self.composition_feature = composition_feature
         self.api_key = api_key
+        self.dtype = dtype
+        self.n_jobs = n_jobs
+        self.endpoint = endpoint
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.offline = offline
+        self.mirror = mirror
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.clean = clean
 
     def fit(self, df, y=None):
         self.original_features = df.columns
@@ -125,20 +251,42 @@ class MaterialsProject(BaseEstimator, TransformerMixin):
 
     def transform(self, df):
         # make materials project api call (uses internet)
-        mpg = MaterialsProjectFeatureGeneration(df.copy(), self.api_key, self.composition_feature)
-        df = mpg.generate_materialsproject_features()
+        mpg = MaterialsProjectFeatureGeneration(df, self.api_key, self.composition_feature,
+                                                n_jobs=self.n_jobs, endpoint=self.endpoint,
+                                                cache_dir=self.cache_dir, cache_ttl=self.cache_ttl,
+                                                offline=self.offline, mirror=self.mirror,
+                                                rate_limit=self.rate_limit, max_retries=self.max_retries)
+        df = mpg.generate_materialsproject_features(dtype=self.dtype)
 
-        df = df.drop(self.original_features, axis=1)
         # delete missing values, generation makes a lot of garbage.
-        df = clean_dataframe(df)
+        if self.clean:
+            df = clean_dataframe(df)
         assert self.composition_feature not in df.columns
         return df
 
 class Citrine(BaseEstimator, TransformerMixin):
-    " Wraps CitrineFeatureGeneration "
-    def __init__(self, composition_feature, api_key):
+    """
+    Wraps CitrineFeatureGeneration, dtype (e.g. float32) is the dtype the features are generated in.
+    Up to n_jobs compositions are searched at once, at most rate_limit per second if given, and
+    failed searches are retried up to max_retries times.
+    If cache_dir is given, responses are cached there (for cache_ttl seconds, or forever) and
+    only compositions without a cached response are searched. offline=True only uses the cache.
+    clean=False returns the features as generated, like for Magpie.
+    """
+    bound = util_legos.IO_BOUND
+
+    def __init__(self, composition_feature, api_key, dtype='float64', n_jobs=8, cache_dir=None, cache_ttl=None,
+                 offline=False, rate_limit=None, max_retries=3, clean=True):
         self.composition_feature = composition_feature
         self.api_key = api_key
+        self.dtype = dtype
+        self.n_jobs = n_jobs
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.offline = offline
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.clean = clean
 
     def fit(self, df, y=None):
         self.original_features = df.columns
@@ -146,17 +294,20 @@ class Citrine(BaseEstimator, TransformerMixin):
 
     def transform(self, df):
         # make citrine api call (uses internet)
-        cfg = CitrineFeatureGeneration(df.copy(), self.api_key, self.composition_feature)
-        df = cfg.generate_citrine_features()
+        cfg = CitrineFeatureGeneration(df, self.api_key, self.composition_feature, n_jobs=self.n_jobs,
+                                       cache_dir=self.cache_dir, cache_ttl=self.cache_ttl, offline=self.offline,
+                                       rate_limit=self.rate_limit, max_retries=self.max_retries)
+        df = cfg.generate_citrine_features(dtype=self.dtype)
 
-        df = df.drop(self.original_features, axis=1)
         # delete missing values, generation makes a lot of garbage.
-        df = clean_dataframe(df)
+        if self.clean:
+            df = clean_dataframe(df)
         assert self.composition_feature not in df.columns
         return df
 
 class NoGenerate(BaseEstimator, TransformerMixin):
     " Returns same input "
+    bound = util_legos.CPU_BOUND
     def __init__(self):
         pass
     def fit(self, X, y=None):
@@ -176,204 +327,466 @@ name_to_constructor = {
 
 def clean_dataframe(df):
     """ Delete missing values or non-numerics """
-    df = df.apply(pd.to_numeric, errors='coerce') # convert non-number to NaN
-
-    # warn on empty rows
-    before_count = df.shape[0]
-    df = df.dropna(axis=0, how='all')
-    lost_count = before_count - df.shape[0]
+    # non-numbers become NaN, then totally empty rows and columns with any empty cells are dropped
+    screen = ColumnScreen(df)
+    lost_count = screen.empty_rows.sum()
     if lost_count > 0:
-        log.warning(f'Dropping {lost_count}/{before_count} rows for being totally empty')
+        log.warning(f'Dropping {lost_count}/{df.shape[0]} rows for being totally empty')
+    keep = screen.keep_columns(missing=True, constant=False, duplicates=False, drop_empty_rows=True)
+    screen.log_dropped(keep, 'generated columns')
+    # only numbers are kept, and pd.to_numeric leaves bools as they are
+    booleans = np.array([pd.api.types.is_bool_dtype(dtype) for dtype in df.dtypes], dtype=bool)
+    if (keep & booleans).any():
+        log.warning(f'Dropping {(keep & booleans).sum()}/{len(keep)} generated columns for not being numbers')
+    return screen.frame(keep & ~booleans, drop_empty_rows=True)
+
+def _sparse_frame(matrix, index, columns):
+    " DataFrame of sparse columns, zero filled, from a scipy sparse matrix "
+    if hasattr(pd.DataFrame, 'sparse'): # pandas >= 0.25
+        # column by column, DataFrame.sparse.from_spmatrix doesn't fill with 0 on every version
+        matrix = matrix.tocsc()
+        frame = pd.DataFrame({j: pd.arrays.SparseArray.from_spmatrix(matrix[:, j]) for j in range(matrix.shape[1])},
+                             index=index)
+        frame.columns = columns
+        return frame
+    return pd.SparseDataFrame(matrix, index=index, columns=columns, default_fill_value=0)
+
+class FeatureFrameBuilder(object):
+    """
+    Collects blocks of generated features (2d arrays and their column names) and assembles
+    them into one DataFrame at the end, allocated once, instead of concatenating a growing
+    frame for every block.
 
-    # drop columns with any empty cells
-    before_count = df.shape[1]
-    df = df.select_dtypes(['number']).dropna(axis=1)
-    lost_count = before_count - df.shape[1]
-    if lost_count > 0:
-        log.warning(f'Dropping {lost_count}/{before_count} generated columns due to missing values')
-    return df
+    Args:
+        index (pandas Index) : index of the frame to build
+        dtype (numpy dtype or str) : dtype of the whole frame, e.g. float32 to halve its size
+    """
+    def __init__(self, index, dtype='float64'):
+        self.index = index
+        self.dtype = np.dtype(dtype)
+        self.blocks = list()
 
-class MagpieFeatureGeneration(object):
+    def add(self, values, columns, rows=None):
+        """
+        Adds a block of values with one column per name in columns. If rows is given, values
+        has one row per distinct input (e.g. composition) and rows[i] is the row of values
+        for row i of the frame, otherwise values has one row per row of the frame.
+        """
+        values = np.asarray(values)
+        columns = list(columns)
+        n_rows = len(self.index) if rows is None else len(rows)
+        if n_rows != len(self.index) or values.ndim != 2 or values.shape[1] != len(columns):
+            raise ValueError(f'Block of shape {values.shape} with {len(columns)} columns does not fit '
+                             f'a frame of {len(self.index)} rows')
+        self.blocks.append((values, columns, rows))
+
+    def add_records(self, records, rows=None):
+        """
+        Adds a block made from a list of dicts of column name -> value, like the ones remote
+        generators get back. Anything that isn't a number becomes NaN.
+        """
+        frame = pd.DataFrame(list(records))
+        frame = frame.apply(pd.to_numeric, errors='coerce')
+        self.add(frame.values, frame.columns, rows)
+
+    def build(self):
+        " One DataFrame of every block, side by side in the order they were added "
+        n_columns = sum(len(columns) for _, columns, _ in self.blocks)
+        # column-major, which pandas keeps as one block without copying it again
+        data = np.empty((len(self.index), n_columns), dtype=self.dtype, order='F')
+        start = 0
+        for values, columns, rows in self.blocks:
+            data[:, start:start+len(columns)] = values if rows is None else values[rows]
+            start += len(columns)
+        columns = [column for _, block_columns, _ in self.blocks for column in block_columns]
+        return pd.DataFrame(data, index=self.index, columns=columns, copy=False)
+
+class TokenBucket(object):
+    " Lets through rate requests per second on average, and bursts of up to burst at once "
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        " Blocks until a token is free and takes it "
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class RequestScheduler(object):
+    """
+    Sends the requests of one remote provider, shared by every generator querying it (get one
+    with get_scheduler).
 
-    def __init__(self, dataframe, composition_feature):
-        self.dataframe = dataframe
-        self.composition_feature = composition_feature
+    At most max_concurrency requests are in flight at once, and with rate_limit set at most
+    rate_limit are started per second (in bursts of up to burst). Requests failing with one of
+    retry_on are retried up to max_retries times after exponential backoff with full jitter
+    (a random wait up to backoff * 2**attempt seconds, capped at max_backoff). A request for a
+    key already in flight waits for that request instead of sending its own.
+
+    self.stats counts requests sent, coalesced requests, retries, errors, response cache
+    hits and misses (reported by fetch_responses) and total request latency in seconds.
+    """
+    def __init__(self, provider, max_concurrency=8, rate_limit=None, burst=1, max_retries=3,
+                 backoff=0.5, max_backoff=30, retry_on=(OSError,)):
+        self.provider = provider
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = tuple(retry_on)
+        self.settings = dict(max_concurrency=max_concurrency, rate_limit=rate_limit, burst=burst,
+                             max_retries=max_retries, backoff=backoff, max_backoff=max_backoff,
+                             retry_on=self.retry_on)
+        self.stats = dict(requests=0, coalesced=0, retries=0, errors=0, cache_hits=0, cache_misses=0, latency=0.)
+        self._semaphore = threading.BoundedSemaphore(max(max_concurrency, 1))
+        self._bucket = None if rate_limit is None else TokenBucket(rate_limit, burst)
+        self._in_flight = dict() # key -> Future of the request being sent for it
+        self._lock = threading.Lock()
+
+    def request(self, key, fetch, *args):
+        " Returns fetch(*args), sharing the answer with any other request for key sent meanwhile "
+        with self._lock:
+            future = self._in_flight.get(key)
+            sending = future is None
+            if sending:
+                future = self._in_flight[key] = concurrent.futures.Future()
+            else:
+                self.stats['coalesced'] += 1
+        if not sending:
+            return future.result()
 
-    def generate_magpie_features(self):
-        compositions = []
-        composition_components = []
+        try:
+            result = self._send(fetch, args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def count_cache(self, hits, misses):
+        with self._lock:
+            self.stats['cache_hits'] += hits
+            self.stats['cache_misses'] += misses
+
+    def summary(self):
+        stats = self.stats
+        mean_latency = stats['latency'] / stats['requests'] if stats['requests'] else 0
+        return (f"{self.provider}: {stats['requests']} requests ({mean_latency:.3f} s mean latency), "
+                f"{stats['coalesced']} coalesced, {stats['retries']} retries, {stats['errors']} errors, "
+                f"{stats['cache_hits']} cache hits, {stats['cache_misses']} cache misses")
+
+    def _send(self, fetch, args):
+        for attempt in itertools.count():
+            with self._semaphore:
+                if self._bucket is not None:
+                    self._bucket.acquire()
+                start = time.perf_counter()
+                try:
+                    return fetch(*args)
+                except self.retry_on as e:
+                    if attempt >= self.max_retries:
+                        with self._lock:
+                            self.stats['errors'] += 1
+                        raise
+                    error = e
+                finally:
+                    with self._lock:
+                        self.stats['requests'] += 1
+                        self.stats['latency'] += time.perf_counter() - start
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+            log.debug(f'{self.provider} request failed ({error}), retrying in {delay:.2f} s')
+            with self._lock:
+                self.stats['retries'] += 1
+            time.sleep(delay)
+
+_schedulers = dict() # (provider, settings) -> RequestScheduler, filled by get_scheduler
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(provider, **settings):
+    """
+    Returns the RequestScheduler every generator of this process shares for provider and
+    settings (see RequestScheduler), making one if there isn't one yet. Generators asking for
+    different settings get schedulers of their own, rather than replacing each other's.
+    """
+    arguments = inspect.signature(RequestScheduler).bind(provider, **settings)
+    arguments.apply_defaults()
+    key = tuple((name, tuple(value) if name == 'retry_on' else value) for name, value in arguments.arguments.items())
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is None:
+            scheduler = _schedulers[key] = RequestScheduler(provider, **settings)
+        return scheduler
+
+def fetch_responses(fetch, queries, keys, provider, properties, cache_dir=None, cache_ttl=None,
+                    offline=False, n_jobs=1, rate_limit=None, max_retries=3, retry_on=(OSError,)):
+    """
+    Returns [fetch(query) for query in queries], for remote featurizers.
+
+    With cache_dir, responses are kept in an SQLite ResponseCache there keyed by provider, keys
+    (canonical formulas, one per query) and properties, and only queries without a fresh
+    cached response are fetched. With offline=True nothing is fetched at all, and missing
+    responses raise OfflineCacheMiss before anything else is done.
+    Fetches go through the provider's RequestScheduler, with n_jobs as its concurrency cap and
+    rate_limit, max_retries and retry_on as its other settings.
+    """
+    if offline and cache_dir is None:
+        raise utils.InvalidConfParameters(f'{provider} can only run offline with a cache_dir to read responses from')
+    if cache_dir is None:
+        responses = [None] * len(queries)
+    else:
+        cache = ResponseCache(os.path.join(cache_dir, 'remote_responses.sqlite'), provider, properties, cache_ttl)
+        responses = cache.lookup(keys)
+    missing = [i for i, response in enumerate(responses) if response is None]
+    if cache_dir is not None:
+        log.info(f'{provider} response cache has {len(queries) - len(missing)}/{len(queries)} compositions')
+
+    if offline and missing:
+        raise utils.OfflineCacheMiss(f'Running offline, but the {provider} cache in {cache_dir} has no responses '
+                                     f'for {len(missing)} compositions, like {[keys[i] for i in missing[:5]]}')
+    scheduler = get_scheduler(provider, max_concurrency=n_jobs, rate_limit=rate_limit,
+                              max_retries=max_retries, retry_on=retry_on)
+    if cache_dir is not None:
+        scheduler.count_cache(len(queries) - len(missing), len(missing))
+    if not missing:
+        return responses
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        fetched = list(executor.map(lambda i: scheduler.request(keys[i], fetch, queries[i]), missing))
+    for i, response in zip(missing, fetched):
+        responses[i] = response
+    if cache_dir is not None:
+        cache.store([keys[i] for i in missing], fetched)
+    log.info(scheduler.summary())
+    return responses
+
+# Suffixes of the computed (non site-specific) Magpie features, one column per elemental property each
+MAGPIE_STATISTICS = ["_composition_average", "_arithmetic_average", "_max_value", "_min_value", "_difference"]
 
-        # Replace empty composition fields with empty string instead of NaN
-        self.dataframe = self.dataframe.fillna('')
-        for column in self.dataframe.columns:
-            if self.composition_feature in column:
-                composition_components.append(self.dataframe[column].tolist())
+class MagpieFeatureGeneration(object):
 
-        if len(composition_components) < 1:
+    def __init__(self, dataframe, composition_feature, cache_dir=None, n_jobs=1, chunk_size=10000,
+                 properties=None, statistics=None, site_features=True):
+        self.dataframe = dataframe
+        self.composition_feature = composition_feature
+        self.cache_dir = cache_dir
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.chunk_size = chunk_size
+        self.properties = properties
+        self.statistics = statistics
+        self.site_features = site_features
+
+    def generate_magpie_features(self, dtype='float64'):
+        """
+        Returns a dataframe of just the generated features, with the same index as
+        self.dataframe. Compositions split over several columns (every column with
+        composition_feature in its name) are joined together first.
+        """
+        composition_columns = [column for column in self.dataframe.columns if self.composition_feature in column]
+        if len(composition_columns) < 1:
             raise utils.MissingColumnError('Error! No column named "Material compositions" found in your input data file. To use this feature generation routine, you must supply a material composition for each data point')
 
-        row = 0
-        while row < len(composition_components[0]):
-            composition = ''
-            for composition_component in composition_components:
-                composition += str(composition_component[row])
-            compositions.append(composition)
-            row += 1
-
-        # Add the column of combined material compositions into the dataframe
-        self.dataframe[self.composition_feature] = compositions
-
-        # Assign each magpiedata feature set to appropriate composition name
-        magpiedata_dict_composition_average = {}
-        magpiedata_dict_arithmetic_average = {}
-        magpiedata_dict_max = {}
-        magpiedata_dict_min = {}
-        magpiedata_dict_difference = {}
-        magpiedata_dict_atomic_bysite = {}
-        for composition in compositions:
-            magpiedata_composition_average, magpiedata_arithmetic_average, magpiedata_max, magpiedata_min, magpiedata_difference = self._get_computed_magpie_features(composition=composition, data_path=MAGPIE_DATA_PATH)
-            magpiedata_atomic_notparsed = self._get_atomic_magpie_features(composition=composition, data_path=MAGPIE_DATA_PATH)
-
-            magpiedata_dict_composition_average[composition] = magpiedata_composition_average
-            magpiedata_dict_arithmetic_average[composition] = magpiedata_arithmetic_average
-            magpiedata_dict_max[composition] = magpiedata_max
-            magpiedata_dict_min[composition] = magpiedata_min
-            magpiedata_dict_difference[composition] = magpiedata_difference
-
-            # Add site-specific elemental features
-            count = 1
-            magpiedata_atomic_bysite = {}
-            for entry in magpiedata_atomic_notparsed:
-                for magpiefeature, featurevalue in magpiedata_atomic_notparsed[entry].items():
-                    magpiedata_atomic_bysite["Site"+str(count)+"_"+str(magpiefeature)] = featurevalue
-                count += 1
-
-            magpiedata_dict_atomic_bysite[composition] = magpiedata_atomic_bysite
-
-        magpiedata_dict_list = [magpiedata_dict_composition_average, magpiedata_dict_arithmetic_average,
-                                magpiedata_dict_max, magpiedata_dict_min, magpiedata_dict_difference, magpiedata_dict_atomic_bysite]
-
-        dataframe = self.dataframe
-        for magpiedata_dict in magpiedata_dict_list:
-            dataframe_magpie = pd.DataFrame.from_dict(data=magpiedata_dict, orient='index')
-            # Need to reorder compositions in new dataframe to match input dataframe
-            dataframe_magpie = dataframe_magpie.reindex(self.dataframe[self.composition_feature].tolist())
-            # Need to make compositions the first column, instead of the row names
-            dataframe_magpie.index.name = self.composition_feature
-            dataframe_magpie.reset_index(inplace=True)
-            # Need to delete duplicate column before merging dataframes
-            del dataframe_magpie[self.composition_feature]
-            # Merge magpie feature dataframe with originally supplied dataframe
-            dataframe = DataframeUtilities().merge_dataframe_columns(dataframe1=dataframe, dataframe2=dataframe_magpie)
-
-        return dataframe
+        # Empty composition fields count as empty strings instead of NaN
+        compositions = self.dataframe[composition_columns[0]].fillna('').astype(str)
+        for column in composition_columns[1:]:
+            compositions = compositions + self.dataframe[column].fillna('').astype(str)
+
+        # Every distinct composition is featurized once and then broadcast back to its rows
+        # (site features and max/min depend on the order elements are written in, so keep it)
+        table = ElementPropertyTable.load(MAGPIE_DATA_PATH)
+        property_names, statistics = self._get_selection(table)
+        composition_index = CompositionIndex(compositions.values, ordered=True)
+        row_to_unique = composition_index.row_to_unique
+
+        builder = FeatureFrameBuilder(self.dataframe.index, dtype)
+        computed = self._get_cached_computed_magpie_features(composition_index.compositions, table,
+                                                             property_names, statistics)
+        for suffix, values in computed:
+            builder.add(values, [name + suffix for name in property_names], rows=row_to_unique)
+
+        if self.site_features:
+            # Site-specific elemental features, Site1_ for the first element written and so on
+            property_values = table.values[:, table.property_index(property_names)]
+            sites = self._get_sites(composition_index.compositions)
+            site_values = property_values[sites]
+            site_values[sites < 0] = np.nan # compositions with fewer sites than the widest one
+            site_columns = [f'Site{site_number}_{name}' for site_number in range(1, sites.shape[1] + 1)
+                            for name in property_names]
+            builder.add(site_values.reshape(len(sites), -1), site_columns, rows=row_to_unique)
+
+        return builder.build()
+
+    def _get_selection(self, table):
+        """
+        Returns (property names, statistic suffixes) to generate, in table and MAGPIE_STATISTICS
+        order. Statistics may be given with or without the leading underscore.
+        """
+        def as_list(names):
+            return [names] if isinstance(names, str) else list(names)
 
-    def _get_computed_magpie_features(self, composition, data_path):
-        magpiedata_composition_average = {}
-        magpiedata_arithmetic_average = {}
-        magpiedata_max = {}
-        magpiedata_min = {}
-        magpiedata_difference = {}
-        magpiedata_atomic = self._get_atomic_magpie_features(composition=composition, data_path=data_path)
-        composition = Composition(composition)
-        element_list, atoms_per_formula_unit = self._get_element_list(composition=composition)
-
-        # Initialize feature values to all be 0, because need to dynamically update them with weighted values in next loop.
-        for magpie_feature in magpiedata_atomic[element_list[0]]:
-            magpiedata_composition_average[magpie_feature] = 0
-            magpiedata_arithmetic_average[magpie_feature] = 0
-            magpiedata_max[magpie_feature] = 0
-            magpiedata_min[magpie_feature] = 0
-            magpiedata_difference[magpie_feature] = 0
-
-        for element in magpiedata_atomic:
-            for magpie_feature, feature_value in magpiedata_atomic[element].items():
-                if feature_value is not 'NaN':
-                    # Composition average features
-                    magpiedata_composition_average[magpie_feature] += feature_value*float(composition[element])/atoms_per_formula_unit
-                    # Arithmetic average features
-                    magpiedata_arithmetic_average[magpie_feature] += feature_value/len(element_list)
-                    # Max features
-                    if magpiedata_max[magpie_feature] > 0:
-                        if feature_value > magpiedata_max[magpie_feature]:
-                            magpiedata_max[magpie_feature] = feature_value
-                    elif magpiedata_max[magpie_feature] == 0:
-                        magpiedata_max[magpie_feature] = feature_value
-                    # Min features
-                    if magpiedata_min[magpie_feature] > 0:
-                        if feature_value < magpiedata_min[magpie_feature]:
-                            magpiedata_min[magpie_feature] = feature_value
-                    elif magpiedata_min[magpie_feature] == 0:
-                        magpiedata_min[magpie_feature] = feature_value
-                    # Difference features (max - min)
-                    magpiedata_difference[magpie_feature] = magpiedata_max[magpie_feature] - magpiedata_min[magpie_feature]
-
-        # Change names of features to reflect each computed type of magpie feature (max, min, etc.)
-        magpiedata_composition_average_renamed = {}
-        magpiedata_arithmetic_average_renamed = {}
-        magpiedata_max_renamed = {}
-        magpiedata_min_renamed = {}
-        magpiedata_difference_renamed = {}
-        for key in magpiedata_composition_average:
-            magpiedata_composition_average_renamed[key+"_composition_average"] = magpiedata_composition_average[key]
-        for key in magpiedata_arithmetic_average:
-            magpiedata_arithmetic_average_renamed[key+"_arithmetic_average"] = magpiedata_arithmetic_average[key]
-        for key in magpiedata_max:
-            magpiedata_max_renamed[key+"_max_value"] = magpiedata_max[key]
-        for key in magpiedata_min:
-            magpiedata_min_renamed[key+"_min_value"] = magpiedata_min[key]
-        for key in magpiedata_difference:
-            magpiedata_difference_renamed[key+"_difference"] = magpiedata_difference[key]
-
-        return magpiedata_composition_average_renamed, magpiedata_arithmetic_average_renamed, magpiedata_max_renamed, magpiedata_min_renamed, magpiedata_difference_renamed
-
-    def _get_atomic_magpie_features(self, composition, data_path):
-        # Get .table files containing feature values for each element, assign file names as feature names
-        magpie_feature_names = []
-        for f in os.listdir(data_path):
-            if '.table' in f:
-                magpie_feature_names.append(f[:-6])
-
-        composition = Composition(composition)
-        element_list, atoms_per_formula_unit = self._get_element_list(composition=composition)
-
-        element_dict = {}
-        for element in element_list:
-            element_dict[element] = Element(element).Z
-
-        magpiedata_atomic = {}
-        for k, v in element_dict.items():
-            atomic_values = {}
-            for feature_name in magpie_feature_names:
-                f = open(data_path + '/' + feature_name + '.table', 'r')
-                # Get Magpie data of relevant atomic numbers for this composition
-                for line, feature_value in enumerate(f.readlines()):
-                    if line + 1 == v:
-                        if "Missing" not in feature_value and "NA" not in feature_value:
-                            if feature_name != "OxidationStates":
-                                atomic_values[feature_name] = float(feature_value.strip())
-                        if "Missing" in feature_value:
-                            atomic_values[feature_name] = 'NaN'
-                        if "NA" in feature_value:
-                            atomic_values[feature_name] = 'NaN'
-                f.close()
-            magpiedata_atomic[k] = atomic_values
-
-        return magpiedata_atomic
-
-    def _get_element_list(self, composition):
-        element_amounts = composition.get_el_amt_dict()
-        atoms_per_formula_unit = 0
-        for v in element_amounts.values():
-            atoms_per_formula_unit += v
-
-        # Get list of unique elements present
-        element_list = []
-        for k in element_amounts:
-            if k not in element_list:
-                element_list.append(k)
-
-        return element_list, atoms_per_formula_unit
+        if self.properties is None:
+            property_names = table.property_names
+        else:
+            unknown = set(as_list(self.properties)) - set(table.property_names)
+            if unknown:
+                raise utils.InvalidConfParameters(
+                    f"Unknown Magpie properties {sorted(unknown)}, choose from {table.property_names}")
+            property_names = [name for name in table.property_names if name in as_list(self.properties)]
+
+        if self.statistics is None:
+            statistics = MAGPIE_STATISTICS
+        else:
+            requested = ['_' + name.lstrip('_') for name in as_list(self.statistics)]
+            unknown = set(requested) - set(MAGPIE_STATISTICS)
+            if unknown:
+                raise utils.InvalidConfParameters(
+                    f"Unknown Magpie statistics {sorted(name[1:] for name in unknown)}, choose from "
+                    f"{[name[1:] for name in MAGPIE_STATISTICS]}")
+            statistics = [suffix for suffix in MAGPIE_STATISTICS if suffix in requested]
+
+        return property_names, statistics
+
+    def _get_cached_computed_magpie_features(self, compositions, table, property_names, statistics):
+        " _get_computed_magpie_features for compositions, using and filling the on-disk cache if there is one "
+        if self.cache_dir is None:
+            values = self._compute_magpie_features(compositions, table, property_names, statistics)
+        else:
+            columns = [name + suffix for suffix in statistics for name in property_names]
+            cache = MagpieFeatureCache(self.cache_dir, table, columns)
+            keys = [composition.formula for composition in compositions]
+            values, found = cache.lookup(keys)
+            missing = np.flatnonzero(~found)
+            log.info(f'Magpie feature cache has {found.sum()}/{len(keys)} compositions, computing {len(missing)}')
+            if len(missing) > 0:
+                computed = self._compute_magpie_features([compositions[i] for i in missing], table,
+                                                         property_names, statistics)
+                values[missing] = computed
+                cache.append([keys[i] for i in missing], computed)
+        return list(zip(statistics, np.hsplit(values, len(statistics)))) if statistics else []
+
+    def _compute_magpie_features(self, compositions, table, property_names, statistics):
+        """
+        Computed features for compositions as one (n x len(statistics)*len(property_names)) array.
+        Chunks go to self.n_jobs processes, which read the element table the parent process already
+        loaded, and come back in order, so the result doesn't depend on the number of processes.
+        """
+        if self.n_jobs <= 1 or len(compositions) <= self.chunk_size:
+            return _compute_magpie_features_chunk(compositions, table.data_path, property_names, statistics)
+        chunks = [compositions[start:start+self.chunk_size] for start in range(0, len(compositions), self.chunk_size)]
+        log.info(f'Computing Magpie features for {len(compositions)} compositions in {len(chunks)} chunks '
+                 f'using {self.n_jobs} processes')
+        with multiprocessing.Pool(processes=min(self.n_jobs, len(chunks))) as pool:
+            results = pool.starmap(_compute_magpie_features_chunk,
+                                   [(chunk, table.data_path, property_names, statistics) for chunk in chunks])
+        return np.vstack(results)
+
+    @staticmethod
+    def _get_sites(compositions, min_sites=0):
+        """
+        (n x max number of elements) element row indices of n ParsedCompositions in order of
+        appearance, padded with -1, and at least min_sites wide
+        """
+        n_sites = np.array([len(composition.elements) for composition in compositions], dtype=int)
+        sites = np.full((len(compositions), max(n_sites.max(initial=0), min_sites)), -1, dtype=int)
+        # boolean mask assignment fills row by row, so elements land in order of appearance
+        sites[np.arange(sites.shape[1]) < n_sites[:, np.newaxis]] = np.fromiter(
+            itertools.chain.from_iterable(composition.elements for composition in compositions),
+            dtype=int, count=n_sites.sum())
+        return sites
+
+    @staticmethod
+    def _get_composition_matrices(compositions, n_elements):
+        """
+        Builds, for n ParsedCompositions:
+            fractions: sparse (n x n_elements) atomic fraction of each element
+            presence: sparse (n x n_elements) 1/(number of elements) for each element present
+            sites: (n x max number of elements) element row indices in order of appearance, padded with -1
+        """
+        sites = MagpieFeatureGeneration._get_sites(compositions, min_sites=1)
+        n_sites = (sites >= 0).sum(axis=1)
+        row_indices = np.repeat(np.arange(len(compositions)), n_sites)
+        column_indices = sites[sites >= 0]
+        amounts = np.fromiter(itertools.chain.from_iterable(composition.amounts for composition in compositions),
+                              dtype=float, count=n_sites.sum())
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            atoms_per_formula_unit = np.bincount(row_indices, weights=amounts, minlength=len(compositions))
+            fractions = amounts / atoms_per_formula_unit[row_indices]
+            arithmetic_weights = 1 / n_sites[row_indices]
+        shape = (len(compositions), n_elements)
+        fractions = scipy.sparse.csr_matrix((fractions, (row_indices, column_indices)), shape=shape)
+        presence = scipy.sparse.csr_matrix((arithmetic_weights, (row_indices, column_indices)), shape=shape)
+        return fractions, presence, sites
+
+    @staticmethod
+    def _get_computed_magpie_features(fractions, presence, sites, values, statistics=MAGPIE_STATISTICS):
+        """
+        Returns (suffix, array) pairs, where each array is (n compositions x n properties), for
+        each of statistics (composition average, arithmetic average, max, min and difference) of
+        the columns of values, an (n_elements x n properties) slice of ElementPropertyTable.values.
+        Only the requested statistics are computed.
+        Missing elemental values are left out of every statistic.
+        """
+        computed = dict()
+        if '_composition_average' in statistics or '_arithmetic_average' in statistics:
+            values_or_zero = np.where(np.isnan(values), 0, values)
+            if '_composition_average' in statistics:
+                computed['_composition_average'] = np.asarray(fractions.dot(values_or_zero))
+            if '_arithmetic_average' in statistics:
+                computed['_arithmetic_average'] = np.asarray(presence.dot(values_or_zero))
+
+        # The running max/min start at 0, take the first value they see while still 0, and after
+        # that only move while they are positive. Kept exactly as it has always been computed so
+        # generated features don't change, which means the order of sites matters here.
+        need_max = '_max_value' in statistics or '_difference' in statistics
+        need_min = '_min_value' in statistics or '_difference' in statistics
+        if need_max or need_min:
+            magpie_max = np.zeros((sites.shape[0], values.shape[1]))
+            magpie_min = np.zeros((sites.shape[0], values.shape[1]))
+            for site in sites.T:
+                site_values = values[site]
+                site_values[site < 0] = np.nan
+                valid = ~np.isnan(site_values)
+                if need_max:
+                    magpie_max = np.where(valid & (magpie_max > 0), np.fmax(magpie_max, site_values),
+                                          np.where(valid & (magpie_max == 0), site_values, magpie_max))
+                if need_min:
+                    magpie_min = np.where(valid & (magpie_min > 0), np.fmin(magpie_min, site_values),
+                                          np.where(valid & (magpie_min == 0), site_values, magpie_min))
+            computed['_max_value'] = magpie_max
+            computed['_min_value'] = magpie_min
+            computed['_difference'] = magpie_max - magpie_min
+
+        computed = [(suffix, computed[suffix]) for suffix in statistics]
+        # Compositions without any elements (empty cells) get no features at all
+        empty = sites[:, 0] < 0
+        for _, array in computed:
+            array[empty] = np.nan
+
+        return computed
+
+def _compute_magpie_features_chunk(compositions, data_path, property_names, statistics):
+    " Module level so multiprocessing can send it to worker processes "
+    table = ElementPropertyTable.load(data_path)
+    values = table.values[:, table.property_index(property_names)]
+    matrices = MagpieFeatureGeneration._get_composition_matrices(compositions, table.n_elements)
+    computed = MagpieFeatureGeneration._get_computed_magpie_features(*matrices, values, statistics)
+    return np.hstack([array for _, array in computed] or [np.empty((len(compositions), 0))])
 
 class MaterialsProjectFeatureGeneration(object):
     """
@@ -384,6 +797,14 @@ class MaterialsProjectFeatureGeneration(object):
         configdict (dict) : MASTML configfile object as dict
         dataframe (pandas dataframe) : dataframe containing x and y data and feature names
         mapi_key (str) : your Materials Project API key
+        n_jobs (int) : how many compositions to query at once, all through one MPRester
+        endpoint (str) : Materials Project REST url to use instead of the default one
+        cache_dir (str) : directory of the response cache, None to always query
+        cache_ttl (float) : seconds cached responses stay valid, None for forever
+        offline (bool) : only use cached responses, and fail if any are missing
+        mirror (str) : path of a local MaterialsProjectMirror to use instead of querying Materials Project
+        rate_limit (float) : most queries to start per second, None for no limit
+        max_retries (int) : how many times to retry failed queries, with exponential backoff
 
     Methods:
         generate_materialsproject_features : generates materials project feature set based on compositions in dataframe
@@ -394,47 +815,66 @@ class MaterialsProjectFeatureGeneration(object):
             Returns:
                 pandas dataframe : dataframe containing magpie feature set
     """
-    def __init__(self, dataframe, mapi_key, composition_feature):
+    # Properties of the most stable structure to make features from
+    property_list = ["G_Voigt_Reuss_Hill", "G_Reuss", "K_Voigt_Reuss_Hill", "K_Reuss", "K_Voigt", "G_Voigt", "G_VRH",
+                     "homogeneous_poisson", "poisson_ratio", "universal_anisotropy", "K_VRH", "elastic_anisotropy",
+                     "band_gap", "e_above_hull", "formation_energy_per_atom", "nelements", "energy_per_atom", "volume",
+                     "density", "total_magnetization", "number"]
+    elastic_property_list = ["G_Voigt_Reuss_Hill", "G_Reuss", "K_Voigt_Reuss_Hill", "K_Reuss", "K_Voigt", "G_Voigt",
+                             "G_VRH", "homogeneous_poisson", "poisson_ratio", "universal_anisotropy", "K_VRH", "elastic_anisotropy"]
+
+    def __init__(self, dataframe, mapi_key, composition_feature, n_jobs=8, endpoint=None,
+                 cache_dir=None, cache_ttl=None, offline=False, mirror=None, rate_limit=None, max_retries=3):
         self.dataframe = dataframe
         self.mapi_key = mapi_key
         self.composition_feature = composition_feature
-
-    def generate_materialsproject_features(self):
+        self.n_jobs = n_jobs
+        self.endpoint = endpoint
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.offline = offline
+        self.mirror = mirror
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.mprester = None
+
+    def generate_materialsproject_features(self, dtype='float64'):
+        " Returns a dataframe of just the generated features, with the same index as self.dataframe "
         try:
             compositions = self.dataframe[self.composition_feature]
         except KeyError as e:
             raise utils.MissingColumnError(f'No column named {self.composition_feature} in csv file')
 
-        mpdata_dict_composition = {}
-
-        # before: 11 hits for a total of ~6 seconds
-        #for composition in compositions:
-        #    composition_data_mp = self._get_data_from_materials_project(composition=composition)
-        #    mpdata_dict_composition[composition] = composition_data_mp
-        # after: 2.5 seconds!!!
-        pool = multiprocessing.Pool(processes=20)
-        #comp_data_mp = pool.map(self._get_data_from_materials_project, compositions)
-        comp_data_mp = map(self._get_data_from_materials_project, compositions)
-
-        mpdata_dict_composition.update(dict(zip(compositions, comp_data_mp)))
-
-        dataframe = self.dataframe
-        dataframe_mp = pd.DataFrame.from_dict(data=mpdata_dict_composition, orient='index')
-        # Need to reorder compositions in new dataframe to match input dataframe
-        dataframe_mp = dataframe_mp.reindex(self.dataframe[self.composition_feature].tolist())
-        # Need to make compositions the first column, instead of the row names
-        dataframe_mp.index.name = self.composition_feature
-        dataframe_mp.reset_index(inplace=True)
-        # Need to delete duplicate column before merging dataframes
-        del dataframe_mp[self.composition_feature]
-        # Merge magpie feature dataframe with originally supplied dataframe
-        dataframe = DataframeUtilities().merge_dataframe_columns(dataframe1=dataframe, dataframe2=dataframe_mp)
-
-        return dataframe
+        # Only query each distinct composition once (e.g. Fe2O3 and O3Fe2 are one query)
+        composition_index = CompositionIndex(compositions)
+        # Queries spend their time waiting on the network, so threads sharing one client (and
+        # its http session) are enough. Results stay in the order of the compositions.
+        # A local mirror has the same get_data() as MPRester.
+        retry_on = (OSError,)
+        provider, cache_dir, offline = 'MaterialsProject', self.cache_dir, self.offline
+        if self.mirror is not None:
+            # the mirror is already local, and its responses mustn't be cached as live ones
+            self.mprester = MaterialsProjectMirror(self.mirror)
+            provider, cache_dir, offline = 'MaterialsProjectMirror', None, False
+        elif not self.offline:
+            # pymatgen's rest client is slow to import, so only when it's used
+            from pymatgen.ext.matproj import MPRester, MPRestError
+            self.mprester = MPRester(self.mapi_key, endpoint=self.endpoint)
+            retry_on = (OSError, MPRestError)
+        log.info(f'Getting Materials Project data for {len(composition_index)} compositions, {self.n_jobs} at a time')
+        comp_data_mp = fetch_responses(self._get_data_from_materials_project, composition_index.formulas,
+                                       [composition.formula for composition in composition_index.compositions],
+                                       provider, self.property_list, cache_dir=cache_dir,
+                                       cache_ttl=self.cache_ttl, offline=offline, n_jobs=self.n_jobs,
+                                       rate_limit=self.rate_limit, max_retries=self.max_retries,
+                                       retry_on=retry_on)
+
+        builder = FeatureFrameBuilder(self.dataframe.index, dtype)
+        builder.add_records(comp_data_mp, rows=composition_index.row_to_unique)
+        return builder.build()
 
     def _get_data_from_materials_project(self, composition):
-        mprester = MPRester(self.mapi_key)
-        structure_data_list = mprester.get_data(chemsys_formula_id=composition)
+        structure_data_list = self.mprester.get_data(chemsys_formula_id=composition)
 
         # Sort structures by stability (i.e. E above hull), and only return most stable compound data
         if len(structure_data_list) > 0:
@@ -445,15 +885,9 @@ class MaterialsProjectFeatureGeneration(object):
 
         # Trim down the full Materials Project data dict to include only quantities relevant to make features
         structure_data_dict_condensed = {}
-        property_list = ["G_Voigt_Reuss_Hill", "G_Reuss", "K_Voigt_Reuss_Hill", "K_Reuss", "K_Voigt", "G_Voigt", "G_VRH",
-                         "homogeneous_poisson", "poisson_ratio", "universal_anisotropy", "K_VRH", "elastic_anisotropy",
-                         "band_gap", "e_above_hull", "formation_energy_per_atom", "nelements", "energy_per_atom", "volume",
-                         "density", "total_magnetization", "number"]
-        elastic_property_list = ["G_Voigt_Reuss_Hill", "G_Reuss", "K_Voigt_Reuss_Hill", "K_Reuss", "K_Voigt", "G_Voigt",
-                                 "G_VRH", "homogeneous_poisson", "poisson_ratio", "universal_anisotropy", "K_VRH", "elastic_anisotropy"]
         if len(structure_data_list) > 0:
-            for prop in property_list:
-                if prop in elastic_property_list:
+            for prop in self.property_list:
+                if prop in self.elastic_property_list:
                     try:
                         structure_data_dict_condensed[prop] = structure_data_most_stable["elasticity"][prop]
                     except TypeError:
@@ -469,7 +903,7 @@ class MaterialsProjectFeatureGeneration(object):
                     except TypeError:
                         structure_data_dict_condensed[prop] = ''
         else:
-            for prop in property_list:
+            for prop in self.property_list:
                 if prop == "number":
                     structure_data_dict_condensed["Spacegroup_"+prop] = ''
                 else:
@@ -490,6 +924,15 @@ class CitrineFeatureGeneration(object):
         configdict (dict) : MASTML configfile object as dict
         dataframe (pandas dataframe) : dataframe containing x and y data and feature names
         api_key (str) : your Citrination API key
+        n_jobs (int) : how many compositions to search at once, all through one client
+        cache_dir (str) : directory of the response cache, None to always search
+        cache_ttl (float) : seconds cached responses stay valid, None for forever
+        offline (bool) : only use cached responses, and fail if any are missing
+        rate_limit (float) : most searches to start per second, None for no limit
+        max_retries (int) : how many times to retry failed searches, with exponential backoff
+        client (CitrinationClient) : client to search with instead of a new one for api_key,
+            e.g. a stub for testing. A new one is only made once a search needs it, so not
+            offline or when every response is cached
 
     Methods:
         generate_citrine_features : generates Citrine feature set based on compositions in dataframe
@@ -500,13 +943,39 @@ class CitrineFeatureGeneration(object):
             Returns:
                 pandas dataframe : dataframe containing magpie feature set
     """
-    def __init__(self, dataframe, api_key, composition_feature):
+    # Only properties with one of these in their name are used
+    accepted_properties_list = [
+        'mass', 'space group', 'band', 'Band', 'energy', 'volume', 'density', 'dielectric',
+        'Dielectric', 'Enthalpy', 'Convex', 'Magnetization', 'Elements', 'Modulus', 'Shear',
+        "Poisson's", 'Elastic', 'Energy'
+    ]
+
+    def __init__(self, dataframe, api_key, composition_feature, n_jobs=8, cache_dir=None, cache_ttl=None,
+                 offline=False, rate_limit=None, max_retries=3, client=None):
         self.dataframe = dataframe
         self.api_key = api_key
-        self.client = CitrinationClient(api_key, 'https://citrination.com')
+        self._client = client
+        self._client_lock = threading.Lock()
         self.composition_feature = composition_feature
-
-    def generate_citrine_features(self):
+        self.n_jobs = n_jobs
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.offline = offline
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+
+    @property
+    def client(self):
+        " The client to search with, made on first use (searches run in several threads) "
+        with self._client_lock:
+            if self._client is None:
+                # trouble? try: `pip install citrination_client=="2.1.0"`
+                from citrination_client import CitrinationClient
+                self._client = CitrinationClient(self.api_key, 'https://citrination.com')
+            return self._client
+
+    def generate_citrine_features(self, dtype='float64'):
+        " Returns a dataframe of just the generated features, with the same index as self.dataframe "
         log.warning('WARNING: You have specified generation of features from Citrine. Based on which'
               ' materials you are interested in, there may be many records to parse through, thus'
               ' this routine may take a long time to complete!')
@@ -516,38 +985,19 @@ class CitrineFeatureGeneration(object):
             log.error(f'original python error: {str(e)}')
             raise utils.MissingColumnError('Error! No column named {self.composition_feature} found in your input data file. '
                     'To use this feature generation routine, you must supply a material composition for each data point')
-        citrine_dict_property_min = dict()
-        citrine_dict_property_max = dict()
-        citrine_dict_property_avg = dict()
-
-        # before: ~11 seconds
-        # made into a func so we can do requests in parallel
-
-        # now like 1.8 secs!
-        pool = multiprocessing.Pool(processes=20)
-        #result_tuples = pool.map(self._load_composition, compositions)
-        result_tuples = map(self._load_composition, compositions)
-
-        for comp, (prop_min, prop_max, prop_avg) in zip(compositions, result_tuples):
-            citrine_dict_property_min[comp] = prop_min
-            citrine_dict_property_max[comp] = prop_max
-            citrine_dict_property_avg[comp] = prop_avg
-
-        dataframe = self.dataframe
-        citrine_dict_list = [citrine_dict_property_min, citrine_dict_property_max, citrine_dict_property_avg]
-        for citrine_dict in citrine_dict_list:
-            dataframe_citrine = pd.DataFrame.from_dict(data=citrine_dict, orient='index')
-            # Need to reorder compositions in new dataframe to match input dataframe
-            dataframe_citrine = dataframe_citrine.reindex(self.dataframe[self.composition_feature].tolist())
-            # Need to make compositions the first column, instead of the row names
-            dataframe_citrine.index.name = self.composition_feature
-            dataframe_citrine.reset_index(inplace=True)
-            # Need to delete duplicate column before merging dataframes
-            del dataframe_citrine[self.composition_feature]
-            # Merge magpie feature dataframe with originally supplied dataframe
-            dataframe = DataframeUtilities().merge_dataframe_columns(dataframe1=dataframe, dataframe2=dataframe_citrine)
-
-        return dataframe
+        # One search per distinct composition, n_jobs at a time through the one client
+        composition_index = CompositionIndex(compositions)
+        result_tuples = fetch_responses(self._load_composition, composition_index.formulas,
+                                        [composition.formula for composition in composition_index.compositions],
+                                        'Citrine', self.accepted_properties_list, cache_dir=self.cache_dir,
+                                        cache_ttl=self.cache_ttl, offline=self.offline, n_jobs=self.n_jobs,
+                                        rate_limit=self.rate_limit, max_retries=self.max_retries)
+
+        # one block each of the _min, _max and _avg features
+        builder = FeatureFrameBuilder(self.dataframe.index, dtype)
+        for citrine_dicts in zip(*result_tuples):
+            builder.add_records(citrine_dicts, rows=composition_index.row_to_unique)
+        return builder.build()
 
     def _load_composition(self, composition):
         pifquery = self._get_pifquery(composition=composition)
@@ -559,27 +1009,23 @@ class CitrineFeatureGeneration(object):
     def _get_pifquery(self, composition):
         # TODO: does this stop csv generation on first invalid composition?
         # TODO: Is there a way to send many compositions in one call to citrine?
+        from citrination_client import PifQuery, SystemQuery, ChemicalFieldQuery, ChemicalFilter
         pif_query = PifQuery(system=SystemQuery(chemical_formula=ChemicalFieldQuery(filter=ChemicalFilter(equal=composition))))
+        results = self.client.search(pif_query).as_dictionary()
         # Check if any results found
-        if 'hits' not in self.client.search(pif_query).as_dictionary():
+        if 'hits' not in results:
             raise KeyError('No results found!')
-        pifquery = self.client.search(pif_query).as_dictionary()['hits']
-        return pifquery
+        return results['hits']
 
     def _get_pifquery_property_list(self, pifquery):
         property_name_list = list()
         property_value_list = list()
-        accepted_properties_list = [
-            'mass', 'space group', 'band', 'Band', 'energy', 'volume', 'density', 'dielectric',
-            'Dielectric', 'Enthalpy', 'Convex', 'Magnetization', 'Elements', 'Modulus', 'Shear',
-            "Poisson's", 'Elastic', 'Energy'
-        ]
 
         for result_number, results in enumerate(pifquery):
             for i, dictionary in enumerate(results['system']['properties']):
                 if 'name' not in dictionary or dictionary['name'] == "CIF File": continue
                 value = dictionary['name']
-                for entry in accepted_properties_list:
+                for entry in self.accepted_properties_list:
                     if entry not in value: continue
                     property_name_list.append(value)
                     try:
@@ -608,34 +1054,18 @@ class CitrineFeatureGeneration(object):
         return property_name_list, property_value_list
 
     def _parse_pifquery_property_list(self, property_name_list, property_value_list):
-        parsed_property_max = dict()
-        parsed_property_min = dict()
-        parsed_property_avg = dict()
-        property_names_unique = list()
         if len(property_name_list) != len(property_value_list):
             print('Error! Length of property name and property value lists are not the same. There must be a bug in the _get_pifquerey_property_list method')
             raise IndexError("property_name_list and property_value_list are not the same size.")
-        else:
-            # Get unique property names
-            for name in property_name_list:
-                if name not in property_names_unique:
-                    property_names_unique.append(name)
-            for unique_name in property_names_unique:
-                unique_property = list()
-                unique_property_avg = 0
-                count = 0
-                for i, name in enumerate(property_name_list):
-                    # Only include property values whose name are same as those in unique_name list
-                    if name == unique_name:
-                        count += 1 # count how many instances of the same property occur
-                        unique_property_avg += property_value_list[i]
-                        unique_property.append(property_value_list[i])
-                unique_property_min = min(entry for entry in unique_property)
-                unique_property_max = max(entry for entry in unique_property)
-                unique_property_avg = unique_property_avg/count
-                parsed_property_min[str(unique_name)+"_min"] = unique_property_min
-                parsed_property_max[str(unique_name) + "_max"] = unique_property_max
-                parsed_property_avg[str(unique_name) + "_avg"] = unique_property_avg
+
+        # min, max and average of the values of each property, in order of first appearance
+        values = pd.Series(property_value_list, index=property_name_list, dtype=float)
+        grouped = values.groupby(level=0, sort=False)
+        stats = pd.DataFrame({'min': grouped.min(), 'max': grouped.max(), 'avg': grouped.sum() / grouped.count()})
+        property_names_unique = list(stats.index)
+        parsed_property_min = {str(name) + "_min": value for name, value in stats['min'].items()}
+        parsed_property_max = {str(name) + "_max": value for name, value in stats['max'].items()}
+        parsed_property_avg = {str(name) + "_avg": value for name, value in stats['avg'].items()}
 
         return property_names_unique, parsed_property_min, parsed_property_max, parsed_property_avg
 
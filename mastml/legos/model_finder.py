@@ -3,18 +3,56 @@ Provides a name_to_constructor dict for all the models in sklearn,
 and the check_models_mixed function
 """
 import warnings
+import importlib
+from collections.abc import Mapping
 
 import sklearn.base
-import sklearn.utils.testing
 import numpy as np
 
 #from . import keras_models
 from .. import utils
 
-with warnings.catch_warnings():
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-    name_to_constructor = dict(sklearn.utils.testing.all_estimators())
+# sklearn modules searched for a model by name, before falling back to all_estimators(),
+# which imports every module in sklearn
+ESTIMATOR_MODULES = ['sklearn.linear_model', 'sklearn.ensemble', 'sklearn.svm', 'sklearn.tree',
+                     'sklearn.kernel_ridge', 'sklearn.neighbors', 'sklearn.gaussian_process',
+                     'sklearn.neural_network', 'sklearn.naive_bayes', 'sklearn.discriminant_analysis',
+                     'sklearn.dummy']
 
+class EstimatorLookup(Mapping):
+    """
+    Read-only dict of name -> constructor for every sklearn estimator, plus custom models.
+    Looking a model up only imports the sklearn module it is in; listing them all imports all of sklearn.
+    """
+    def __init__(self, custom=None):
+        self._found = dict(custom or {})
+        self._custom = dict(self._found)
+        self._all = None
+
+    def __getitem__(self, name):
+        if name not in self._found:
+            for module_name in ESTIMATOR_MODULES:
+                constructor = getattr(importlib.import_module(module_name), name, None)
+                if isinstance(constructor, type) and issubclass(constructor, sklearn.base.BaseEstimator):
+                    break
+            else:
+                constructor = self._all_estimators()[name]
+            self._found[name] = constructor
+        return self._found[name]
+
+    def __iter__(self):
+        return iter({**self._all_estimators(), **self._custom})
+
+    def __len__(self):
+        return len({**self._all_estimators(), **self._custom})
+
+    def _all_estimators(self):
+        if self._all is None:
+            import sklearn.utils.testing
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", category=DeprecationWarning)
+                self._all = dict(sklearn.utils.testing.all_estimators())
+        return self._all
 
 class AlwaysFive(sklearn.base.RegressorMixin):
     def __init__(self, constant = 5):
@@ -39,7 +77,7 @@ custom_models = {
     #'DNNClassifier': keras_models.DNNClassifier
 }
 
-name_to_constructor.update(custom_models)
+name_to_constructor = EstimatorLookup(custom_models)
 
 def find_model(model_name):
     """ looks up model name using sklearn """
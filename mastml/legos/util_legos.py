@@ -1,24 +1,46 @@
 """
 Collection of classes for debugging and control flow
 """
+import os
 import logging
+import concurrent.futures
 
 import pandas as pd
 from sklearn.base import BaseEstimator, TransformerMixin
 
 log = logging.getLogger('mastml')
 
+# Kinds of work a lego can declare in its `bound` class attribute:
+# 'io' legos mostly wait on the network or disk, so run in threads of this process;
+# 'cpu' legos compute in python, so run in processes of their own when there is more than one.
+# Legos which don't declare a kind run in threads, which never need them to be picklable.
+IO_BOUND = 'io'
+CPU_BOUND = 'cpu'
+
 class DataFrameFeatureUnion(BaseEstimator, TransformerMixin):
-    " For unioning dataframe generators (sklearn.pipeline.FeatureUnion always puts out arrays) "
-    def __init__(self, transforms):
+    """
+    For unioning dataframe generators (sklearn.pipeline.FeatureUnion always puts out arrays).
+    Transforms run concurrently, up to n_jobs at a time (all of them at once by default), in
+    threads or processes depending on the kind of work each declares (see IO_BOUND, CPU_BOUND).
+    Their dataframes are always concatenated in the order of self.transforms.
+    """
+    def __init__(self, transforms, n_jobs=None):
         self.transforms = transforms
+        self.n_jobs = n_jobs
     def fit(self, X, y=None):
-        for transform in self.transforms:
-            transform.fit(X, y)
+        # fitting in another process fits a copy, so keep the copies that come back
+        self.transforms = _run_concurrently(_fit, self.transforms, (X, y), self.n_jobs)
         return self
     def transform(self, X):
-        dataframes = [transform.transform(X) for transform in self.transforms]
+        dataframes = _run_concurrently(_transform, self.transforms, (X,), self.n_jobs)
         return pd.concat(dataframes, axis=1)
+    def transform_each(self, X):
+        " The dataframe of each transform, in the order of self.transforms, not concatenated "
+        return _run_concurrently(_transform, self.transforms, (X,), self.n_jobs)
+    def fit_transform(self, X, y=None):
+        results = _run_concurrently(_fit_transform, self.transforms, (X, y), self.n_jobs)
+        self.transforms = [transform for transform, _ in results]
+        return pd.concat([dataframe for _, dataframe in results], axis=1)
 
 class DoNothing(BaseEstimator, TransformerMixin):
     " Returns same input "
@@ -28,3 +50,53 @@ class DoNothing(BaseEstimator, TransformerMixin):
         return self
     def transform(self, X):
         return X
+
+def _fit(transform, X, y):
+    return transform.fit(X, y)
+
+def _transform(transform, X):
+    return transform.transform(X)
+
+def _fit_transform(transform, X, y):
+    dataframe = transform.fit_transform(X, y)
+    return transform, dataframe
+
+def _run_concurrently(function, transforms, args, n_jobs=None):
+    """
+    Returns [function(transform, *args) for transform in transforms], computed concurrently.
+    CPU bound transforms go to a process pool when there are at least two of them (a single one
+    gains nothing from a process and runs in a thread), everything else goes to a thread pool.
+    The first exception raised by any of them is raised again here.
+    """
+    if n_jobs is None or n_jobs == -1:
+        n_jobs = len(transforms)
+    if n_jobs <= 1 or len(transforms) <= 1:
+        return [function(transform, *args) for transform in transforms]
+
+    cpu_bound = [i for i, transform in enumerate(transforms)
+                 if getattr(transform, 'bound', IO_BOUND) == CPU_BOUND]
+    if len(cpu_bound) < 2:
+        cpu_bound = list()
+    n_processes = min(len(cpu_bound), n_jobs, os.cpu_count() or 1)
+    n_threads = min(len(transforms) - len(cpu_bound), n_jobs)
+    log.debug(f'Running {len(transforms)} transforms in {n_threads} threads and {n_processes} processes')
+
+    futures = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(n_threads, 1)) as threads:
+        processes = concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) if n_processes else None
+        try:
+            # processes are started before any thread is, so they aren't forked mid-request
+            for i in cpu_bound:
+                futures[i] = processes.submit(function, transforms[i], *args)
+            for i, transform in enumerate(transforms):
+                if i not in futures:
+                    futures[i] = threads.submit(function, transform, *args)
+            # in the order of transforms, whichever finishes first
+            return [futures[i].result() for i in range(len(transforms))]
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            raise
+        finally:
+            if processes is not None:
+                processes.shutdown(wait=True)
@@ -0,0 +1,206 @@
+"""
+Module for loading the magpie elemental property tables (magpie/*.table) into memory.
+Every table is parsed once per process into one dense array that all Magpie
+feature generation shares.
+
+The parsed array is also shipped as a compiled bundle next to the tables (magpie_tables.npy,
+plus magpie_tables.json describing it), which is memory-mapped instead of parsing the text
+tables. The bundle is a build artifact, compiled whenever the tables are changed with
+
+    python -m mastml.magpie_data
+
+and never written at runtime, since the tables may be installed read-only or shared. If it is
+missing or doesn't match the tables, they are parsed and compiled into USER_CACHE_PATH instead.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+
+import mastml
+
+log = logging.getLogger('mastml')
+
+# locate path to directory containing AtomicNumber.table, AtomicRadii.table AtomicVolume.table, etc
+# (needs to do it the hard way becuase python -m sets cwd to wherever python is ran from)
+MAGPIE_DATA_PATH = os.path.join(mastml.__path__[0], '../magpie/')
+
+# Tables which don't hold one scalar per element, so can't be used as features
+NON_SCALAR_TABLES = ['OxidationStates']
+
+# Compiled bundle of all the tables, kept in the magpie data directory
+BUNDLE_NAME = 'magpie_tables'
+BUNDLE_VERSION = 1 # bump when the bundle layout changes
+
+# where bundles of tables without an up to date one are compiled to
+USER_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                               'mastml', 'magpie')
+
+class ElementPropertyTable(object):
+    """
+    Dense (n_elements x n_properties) array of elemental properties from the magpie tables.
+
+    Row i of self.values is the element with atomic number self.atomic_numbers[i] (so Z-1),
+    and column j is the property self.property_names[j] (table file name without .table).
+    Entries marked "Missing"/"NA" (or not parseable) in the tables are NaN in self.values
+    and True in self.missing.
+
+    Use ElementPropertyTable.load() to get the table shared by the whole process instead of
+    constructing a new one.
+
+    If the compiled bundle in data_path, or else one in cache_path, matches the text tables,
+    self.values is a read-only memory-map of it. Otherwise the tables are parsed and, unless
+    use_bundle is False, compiled into cache_path for next time (skipped with a debug message if
+    it isn't writable). Nothing is ever written to data_path.
+    """
+
+    _loaded = dict() # data_path -> ElementPropertyTable, filled by load()
+
+    def __init__(self, data_path=MAGPIE_DATA_PATH, use_bundle=True, cache_path=USER_CACHE_PATH):
+        self.data_path = os.path.abspath(data_path)
+        self.cache_path = cache_path
+        self.property_names = sorted(f[:-len('.table')] for f in os.listdir(self.data_path)
+                                     if f.endswith('.table') and f[:-len('.table')] not in NON_SCALAR_TABLES)
+
+        self.values = None
+        if use_bundle:
+            file_digest = self._file_digest()
+            self.values = self._load_bundle(self.bundle_path, file_digest)
+            if self.values is None:
+                log.warning(f'The compiled magpie tables in {self.data_path} are missing or out of date, '
+                            f'recompile them with python -m mastml.magpie_data')
+                self.values = self._load_bundle(self.cache_bundle_path(file_digest), file_digest)
+        if self.values is None:
+            self.values = self._parse_tables()
+            if use_bundle:
+                self.save_bundle(self.cache_bundle_path(file_digest))
+        self.missing = np.isnan(self.values)
+        n_elements = self.values.shape[0]
+        self.atomic_numbers = np.arange(1, n_elements + 1)
+        self._property_index = {name: j for j, name in enumerate(self.property_names)}
+
+    @classmethod
+    def load(cls, data_path=MAGPIE_DATA_PATH):
+        " Returns the table for data_path, loading it only the first time it is asked for "
+        key = os.path.abspath(data_path)
+        if key not in cls._loaded:
+            log.debug(f'Loading magpie tables from {key}')
+            cls._loaded[key] = cls(key)
+        return cls._loaded[key]
+
+    @property
+    def n_elements(self):
+        return self.values.shape[0]
+
+    @property
+    def n_properties(self):
+        return self.values.shape[1]
+
+    @property
+    def digest(self):
+        " Short hash of the table contents, changes whenever any table file does "
+        sha = hashlib.sha1('\n'.join(self.property_names).encode())
+        sha.update(np.ascontiguousarray(self.values).tobytes())
+        return sha.hexdigest()[:16]
+
+    def element_index(self, atomic_numbers):
+        " Row indices into self.values for the given atomic number(s) "
+        return np.asarray(atomic_numbers) - 1
+
+    def property_index(self, property_names):
+        " Column indices into self.values for the given property names "
+        return np.array([self._property_index[name] for name in property_names], dtype=int)
+
+    def rows(self, atomic_numbers):
+        " Property values for the given atomic numbers, shape (len(atomic_numbers), n_properties) "
+        return self.values[self.element_index(atomic_numbers)]
+
+    @property
+    def bundle_path(self):
+        " Path of the shipped bundle, without the .npy/.json extension "
+        return os.path.join(self.data_path, BUNDLE_NAME)
+
+    def cache_bundle_path(self, file_digest):
+        " Path of the bundle compiled into cache_path for tables with file_digest "
+        return os.path.join(self.cache_path, f'{BUNDLE_NAME}_{file_digest[:16]}')
+
+    def save_bundle(self, bundle_path=None):
+        " Writes self.values and a description of the text tables they came from to bundle_path "
+        bundle_path = bundle_path or self.bundle_path
+        try:
+            os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+            # the .json is written last and checked first, so a half written bundle never matches
+            self._save_atomic(bundle_path + '.npy', lambda f: np.save(f, np.ascontiguousarray(self.values)), 'wb')
+            header = {'version': BUNDLE_VERSION,
+                      'property_names': self.property_names,
+                      'file_digest': self._file_digest()}
+            self._save_atomic(bundle_path + '.json', lambda f: json.dump(header, f, indent=1), 'w')
+            log.debug(f'Wrote compiled magpie tables to {bundle_path}.npy')
+        except OSError as e:
+            log.debug(f'Could not write compiled magpie tables to {bundle_path}.npy: {e}')
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    @staticmethod
+    def _save_atomic(path, write, mode):
+        temp_path = path + f'.{os.getpid()}.tmp'
+        with open(temp_path, mode) as f:
+            write(f)
+        os.replace(temp_path, path)
+
+    def _load_bundle(self, bundle_path, file_digest):
+        " Memory-mapped values from bundle_path, or None if it doesn't match the text tables "
+        # hashing the tables takes about a millisecond, so their contents are always compared
+        header = self._read_json(bundle_path + '.json')
+        if (header.get('version') != BUNDLE_VERSION or header.get('property_names') != self.property_names
+                or header.get('file_digest') != file_digest):
+            return None
+        try:
+            values = np.load(bundle_path + '.npy', mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if values.ndim != 2 or values.shape[1] != len(self.property_names):
+            return None
+        return values
+
+    def _file_paths(self):
+        return [os.path.join(self.data_path, name + '.table') for name in self.property_names]
+
+    def _file_digest(self):
+        sha = hashlib.sha1()
+        for path in self._file_paths():
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+        return sha.hexdigest()
+
+    def _parse_tables(self):
+        columns = [self._read_table(name) for name in self.property_names]
+        n_elements = max(len(column) for column in columns)
+        values = np.full((n_elements, len(columns)), np.nan)
+        for j, column in enumerate(columns):
+            values[:len(column), j] = column
+        return values
+
+    def _read_table(self, name):
+        column = list()
+        with open(os.path.join(self.data_path, name + '.table')) as f:
+            for line in f:
+                try:
+                    column.append(float(line))
+                except ValueError: # "Missing", "NA", blank lines, etc.
+                    column.append(np.nan)
+        return column
+
+if __name__ == '__main__':
+    # python -m mastml.magpie_data [data_path] recompiles the shipped bundle, after changing the tables
+    import sys
+    logging.basicConfig(level=logging.DEBUG)
+    ElementPropertyTable(sys.argv[1] if len(sys.argv) > 1 else MAGPIE_DATA_PATH, use_bundle=False).save_bundle()
@@ -5,30 +5,42 @@ Module for getting a mastml system call and calling all the appropriate subrouti
 import argparse
 import inspect
 import os
+import copy
+import json
+import pickle
+import hashlib
 import shutil
 import logging
 import warnings
+import sys
+import multiprocessing
 from datetime import datetime
 from collections import OrderedDict
 from os.path import join # We use join tons
-from functools import reduce
+from functools import reduce, partial
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 from sklearn.externals import joblib
+from sklearn.base import clone
 from sklearn.exceptions import UndefinedMetricWarning
 from sklearn.model_selection import LeaveOneGroupOut
 
-from . import conf_parser, data_loader, html_helper, plot_helper, utils, learning_curve, data_cleaner
+from . import (conf_parser, data_loader, html_helper, plot_helper, utils, learning_curve, data_cleaner,
+               column_screening, data_plane, stage_cache)
 from .legos import (data_splitters, feature_generators, feature_normalizers,
                     feature_selectors, model_finder, util_legos)
 from .legos import clusterers as legos_clusterers
 
 log = logging.getLogger('mastml')
 
-def main(conf_path, data_path, outdir, verbosity=0):
-    " Sets up logger and error catching, then starts the run "
-    conf_path, data_path, outdir = check_paths(conf_path, data_path, outdir)
+def main(conf_path, data_path, outdir, verbosity=0, resume=False):
+    """
+    Sets up logger and error catching, then starts the run. With resume, a run which already
+    has outdir picks up where it stopped, instead of starting over in a new directory
+    """
+    conf_path, data_path, outdir = check_paths(conf_path, data_path, outdir, resume)
 
     utils.activate_logging(outdir, (conf_path, data_path, outdir), verbosity=verbosity)
 
@@ -38,7 +50,7 @@ def main(conf_path, data_path, outdir, verbosity=0):
         warnings.simplefilter('ignore') # ignore warnings
 
     try:
-        mastml_run(conf_path, data_path, outdir)
+        mastml_run(conf_path, data_path, outdir, resume)
     except utils.MastError as e:
         # catch user errors, log and print, but don't raise and show them that nasty stack
         log.error(str(e))
@@ -50,18 +62,26 @@ def main(conf_path, data_path, outdir, verbosity=0):
         raise e
     return outdir # so a calling program can know where we actually saved it
 
-def mastml_run(conf_path, data_path, outdir):
-    " Runs operations specifed in conf_path on data_path and puts results in outdir "
+def mastml_run(conf_path, data_path, outdir, resume=False):
+    """
+    Runs operations specifed in conf_path on data_path and puts results in outdir. With resume,
+    splits already checkpointed in outdir are loaded rather than fitted again
+    """
 
     # Copy the original input files to the output directory for easy reference
     log.info("Copying input files to output directory...")
     shutil.copy2(conf_path, outdir)
     shutil.copy2(data_path, outdir)
+    # so the run can be resumed with the same files, and only those
+    with open(join(outdir, FINGERPRINT_FILE), 'w') as f:
+        json.dump(_fingerprint(conf_path, data_path), f, indent=4)
 
     # Load in and parse the configuration and data files:
     conf = conf_parser.parse_conf_file(conf_path)
     PlotSettings = conf['PlotSettings']
     is_classification = conf['is_classification']
+    # stage outputs of earlier runs, so only stages whose inputs changed are redone
+    cache = stage_cache.StageCache(conf['GeneralSetup']['cache_dir'], conf['GeneralSetup']['cache_max_size'])
     # The df is used by feature generators, clusterers, and grouping_column to 
     # create more features for x.
     # X is model input, y is target feature for model
@@ -79,10 +99,8 @@ def mastml_run(conf_path, data_path, outdir):
                     "result in removal of that target data point.")
         dc['cleaning_method'] = 'remove'
     if dc['cleaning_method'] == 'remove':
-        df = data_cleaner.remove(df, axis=1)
-        X = data_cleaner.remove(X, axis=1)
-        X_noinput = data_cleaner.remove(X_noinput, axis=1)
-        X_grouped = data_cleaner.remove(X_grouped, axis=1)
+        # X, X_noinput and X_grouped are all columns of df, so df is screened once for all of them
+        df, X, X_noinput, X_grouped = data_cleaner.remove_columns(df, X, X_noinput, X_grouped)
         # TODO: have method to first remove rows of missing target data, then do columns for features
         #y = data_cleaner.remove(y, axis=0)
     elif dc['cleaning_method'] == 'imputation':
@@ -219,8 +237,9 @@ def mastml_run(conf_path, data_path, outdir):
 
         def generate_features():
             log.info("Doing feature generation...")
-            dataframes = [instance.fit_transform(df, y) for _, instance in generators]
-            dataframe = pd.concat(dataframes, 1)
+            # generators run concurrently, and their columns are concatenated in conf order
+            union = util_legos.DataFrameFeatureUnion([instance for _, instance in generators])
+            dataframe, _ = cache.run('generation', union, union.fit_transform, df, y)
             log.info("Saving generated data to csv...")
             log.debug(f'generated cols: {dataframe.columns}')
             filename = join(outdir, "generated_features.csv")
@@ -228,29 +247,25 @@ def mastml_run(conf_path, data_path, outdir):
             return dataframe
         generated_df = generate_features()
 
-        def remove_constants():
-            dataframe = _remove_constant_features(generated_df)
+        def screen_generated():
+            # one pass over the input and generated features: generated columns which are
+            # constant or repeat another column (by name or by values) are thrown away
+            log.info("Removing constant and repeated features, regardless of feature selectors.")
+            X_generated = pd.concat([X, generated_df], axis=1)
+            screen = column_screening.ColumnScreen(X_generated, coerce=False)
+            keep = screen.keep_columns(missing=True, constant=True, duplicates=True, exempt=X.columns)
+            screen.log_dropped(keep, 'columns')
+            log.debug(f'Screened columns:\n{screen.report(keep)}')
+            dataframe = generated_df.iloc[:, np.flatnonzero(keep[X.shape[1]:])]
             log.info("Saving generated data without constant columns to csv...")
             filename = join(outdir, "generated_features_no_constant_columns.csv")
             pd.concat([dataframe, X_noinput, y], 1).to_csv(filename, index=False)
-            return dataframe
-        generated_df = remove_constants()
+            return screen.frame(keep), dataframe
+        X, generated_df = screen_generated()
 
-        # add in generated features
-        X = pd.concat([X, generated_df], axis=1)
         # add in generated features to full dataframe
         df = pd.concat([df, generated_df], axis=1)
 
-        # remove repeat columns (keep the first one)
-        def remove_repeats(X):
-            repeated_columns = X.loc[:, X.columns.duplicated()].columns
-            if not repeated_columns.empty:
-                log.warning(f"Throwing away {len(repeated_columns)} because they are repeats.")
-                log.debug(f"Throwing away columns because they are repeats: {repeated_columns}")
-                X = X.loc[:,~X.columns.duplicated()]
-            return X
-        X = remove_repeats(X)
-
         def make_clustered_df():
             log.info("Doing clustering...")
             clustered_df = pd.DataFrame()
@@ -285,10 +300,11 @@ def mastml_run(conf_path, data_path, outdir):
             triples = []
             for normalizer_name, normalizer_instance in normalizers:
                 log.info(f"Running normalizer {normalizer_name} ...")
-                X_normalized = normalizer_instance.fit_transform(X, y)
+                X_normalized, normalizer_key = cache.run('normalizer', normalizer_instance,
+                                                         normalizer_instance.fit_transform, X, y)
                 log.info("Saving normalized data to csv...")
                 dirname = join(outdir, normalizer_name)
-                os.mkdir(dirname)
+                os.makedirs(dirname, exist_ok=resume)
                 pd.concat([X_normalized, X_noinput, y], 1).to_csv(join(dirname, "normalized.csv"), index=False)
 
                 # Put learning curve here??
@@ -327,20 +343,28 @@ def mastml_run(conf_path, data_path, outdir):
 
 
                 log.info("Running selectors...")
-                for selector_name, selector_instance in selectors:
+                for selector_name, selector in selectors:
                     log.info(f"    Running selector {selector_name} ...")
+                    # a fresh one for every normalizer, so nothing it kept from fitting the last
+                    # one (some change their own arguments) affects this fit or its cache key
+                    selector_instance = copy.deepcopy(selector)
                     # NOTE: Changed from .fit_transform to .fit.transform
                     # because PCA.fit_transform doesn't call PCA.transform
                     if selector_instance.__class__.__name__ == 'MASTMLFeatureSelector':
-                        X_selected = selector_instance.fit(X_normalized, y, X_grouped).transform(X_normalized)
+                        select = lambda X_, y_, groups: selector_instance.fit(X_, y_, groups).transform(X_)
+                        inputs = (X_normalized, y, X_grouped)
                     else:
-                        X_selected = selector_instance.fit(X_normalized, y).transform(X_normalized)
+                        select = lambda X_, y_: selector_instance.fit(X_, y_).transform(X_)
+                        inputs = (X_normalized, y)
+                    X_selected, selected_keys[(normalizer_name, selector_name)] = cache.run(
+                            'selector', selector_instance, select, *inputs, upstream=[normalizer_key])
                     log.info("    Saving selected features to csv...")
                     dirname = join(outdir, normalizer_name, selector_name)
-                    os.mkdir(dirname)
+                    os.makedirs(dirname, exist_ok=resume)
                     pd.concat([X_selected, X_noinput, y], 1).to_csv(join(dirname, "selected.csv"), index=False)
                     triples.append((normalizer_name, selector_name, X_selected))
             return triples
+        selected_keys = dict() # (normalizer name, selector name) -> key of the selector's output
         normalizer_selector_dataframe_triples = make_normalizer_selector_dataframe_triples()
 
         ## DataSplits (cross-product)
@@ -438,49 +462,75 @@ def mastml_run(conf_path, data_path, outdir):
 
         def do_models_splits():
             all_results = []
-            for normalizer_name, selector_name, X in normalizer_selector_dataframe_triples:
-                subdir = join(outdir, normalizer_name, selector_name)
-
-                if PlotSettings['feature_vs_target']:
-                    #if selector_name == 'DoNothing': continue
-                    # for each selector/normalizer, plot y against each x column
-                    for column in X:
-                        filename = f'{column}_vs_target.png'
-                        plot_helper.plot_scatter(X[column], y, join(subdir, filename),
-                                                 xlabel=column, ylabel='target_feature', label=y.name)
-                for model_name, model_instance in models:
-                    for splitter_name, trains_tests in splittername_splitlist_pairs:
-                        grouping_data = splitter_to_group_column[splitter_name]
-                        subdir = join(normalizer_name, selector_name, model_name, splitter_name)
-                        log.info(f"    Running splits for {subdir}")
-                        subsubdir = join(outdir, subdir)
-                        os.makedirs(subsubdir)
-                        # NOTE: do_one_splitter is a big old function, does lots
-                        runs = do_one_splitter(X, y, model_instance, subsubdir, trains_tests, grouping_data)
-                        all_results.extend(runs)
+            combos = [] # (name, function doing its splits)
+            # one budget of processes, for combos first and then the splits of each combo
+            n_combos = len(normalizer_selector_dataframe_triples) * len(models) * len(splittername_splitlist_pairs)
+            combo_jobs, split_jobs = _share_jobs(conf['GeneralSetup']['n_jobs'], n_combos)
+            # run serially, there are no processes to share the data with
+            with data_plane.DataPlane(shared=combo_jobs > 1 or split_jobs > 1) as plane:
+                # the data is published once, and combos and splits get handles to it, so nothing
+                # but index arrays and models goes to the processes running them
+                y_handle = plane.publish('y', y)
+                noinput_handle = plane.publish('X_noinput', X_noinput)
+                groups_handles = {name: plane.publish(f'groups/{name}', groups)
+                                  for name, groups in splitter_to_group_column.items() if groups is not None}
+                for normalizer_name, selector_name, X in normalizer_selector_dataframe_triples:
+                    subdir = join(outdir, normalizer_name, selector_name)
+
+                    if PlotSettings['feature_vs_target']:
+                        #if selector_name == 'DoNothing': continue
+                        # for each selector/normalizer, plot y against each x column
+                        for column in X:
+                            filename = f'{column}_vs_target.png'
+                            plot_helper.plot_scatter(X[column], y, join(subdir, filename),
+                                                     xlabel=column, ylabel='target_feature', label=y.name)
+                    X_handle = plane.publish(f'X/{normalizer_name}/{selector_name}', X)
+                    for model_name, model_instance in models:
+                        for splitter_name, trains_tests in splittername_splitlist_pairs:
+                            subdir = join(normalizer_name, selector_name, model_name, splitter_name)
+                            subsubdir = join(outdir, subdir)
+                            os.makedirs(subsubdir, exist_ok=resume)
+                            # NOTE: do_one_splitter is a big old function, does lots
+                            combos.append((subdir, partial(do_one_splitter, X_handle, y_handle, noinput_handle,
+                                                           model_instance, subsubdir, trains_tests,
+                                                           groups_handles.get(splitter_name), split_jobs,
+                                                           selected_keys[(normalizer_name, selector_name)])))
+
+                # combos are independent, so can run in any order, but their runs are kept in this one
+                for runs in _run_combos(combos, combo_jobs):
+                    all_results.extend(runs)
             return all_results
 
         return do_models_splits()
 
-    def do_one_splitter(X, y, model, main_path, trains_tests, grouping_data):
+    def do_one_splitter(X_handle, y_handle, noinput_handle, model, main_path, trains_tests, groups_handle,
+                        n_jobs=1, X_key=None):
+        # FrameHandles into the data plane, whole frames here are views of it
+        X, y = X_handle.frame(), y_handle.frame()
+        grouping_data = groups_handle.frame() if groups_handle is not None else None
 
         def one_fit(split_num, train_indices, test_indices):
+            # a fresh copy for every split, so splits never see each other's fits
+            split_model = clone(model, safe=False)
 
             log.info(f"        Doing split number {split_num}")
-            train_X, train_y = X.loc[train_indices], y.loc[train_indices]
-            test_X,  test_y  = X.loc[test_indices],  y.loc[test_indices]
+            train_X, train_y = X_handle.loc(train_indices), y_handle.loc(train_indices)
+            test_X,  test_y  = X_handle.loc(test_indices),  y_handle.loc(test_indices)
 
             # split up groups into train and test as well
-            if grouping_data is not None:
-                train_groups, test_groups = grouping_data[train_indices], grouping_data[test_indices]
+            if groups_handle is not None:
+                train_groups, test_groups = groups_handle.take(train_indices), groups_handle.take(test_indices)
             else:
                 train_groups, test_groups = None, None
 
             path = join(main_path, f"split_{split_num}")
-            os.mkdir(path)
+            os.makedirs(path, exist_ok=resume)
 
             log.info("             Fitting model and making predictions...")
-            model.fit(train_X, train_y)
+            def fit(X_, y_):
+                split_model.fit(X_, y_)
+                return split_model
+            split_model, _ = cache.run('model', split_model, fit, train_X, train_y, upstream=[X_key])
             #joblib.dump(model, join(path, "trained_model.pkl"))
             if is_classification:
                 # For classification, need probabilty of prediction to make accurate ROC curve (and other predictions??).
@@ -492,18 +542,18 @@ def mastml_run(conf_path, data_path, outdir):
                 #params = model.get_params()
                 #if params['probability'] == True:
                 try:
-                    train_pred_proba = model.predict_proba(train_X)
-                    test_pred_proba = model.predict_proba(test_X)
+                    train_pred_proba = split_model.predict_proba(train_X)
+                    test_pred_proba = split_model.predict_proba(test_X)
                 except:
                     log.error('You need to perform classification with model param probability=True enabled for accurate'
                                 ' predictions, if your model has the probability param (e.g. RandomForestClassifier does not. '
                               'Please reset this parameter as applicable and re-run MASTML')
                     exit()
-                train_pred = model.predict(train_X)
-                test_pred = model.predict(test_X)
+                train_pred = split_model.predict(train_X)
+                test_pred = split_model.predict(test_X)
             else:
-                train_pred = model.predict(train_X)
-                test_pred  = model.predict(test_X)
+                train_pred = split_model.predict(train_X)
+                test_pred  = split_model.predict(test_X)
 
             # here is where we need to collect validation stats
             if is_validation:
@@ -513,7 +563,7 @@ def mastml_run(conf_path, data_path, outdir):
                     validation_X_forpred = _only_validation(X, validation_columns[validation_column_name])
                     validation_y_forpred = _only_validation(y, validation_columns[validation_column_name])
                     log.info("             Making predictions on prediction_only data...")
-                    validation_predictions = model.predict(validation_X_forpred)
+                    validation_predictions = split_model.predict(validation_X_forpred)
                     validation_predictions_list.append(validation_predictions)
                     validation_y_forpred_list.append(validation_y_forpred)
 
@@ -529,11 +579,11 @@ def mastml_run(conf_path, data_path, outdir):
             # Save train and test data and results to csv:
             log.info("             Saving train/test data and predictions to csv...")
             train_pred_series = pd.DataFrame(train_pred, columns=['train_pred'], index=train_indices)
-            train_noinput_series = pd.DataFrame(X_noinput, index=train_indices)
+            train_noinput_series = noinput_handle.reindex(train_indices)
             pd.concat([train_X, train_y, train_pred_series, train_noinput_series], 1)\
                     .to_csv(join(path, 'train.csv'), index=False)
             test_pred_series = pd.DataFrame(test_pred,   columns=['test_pred'],  index=test_indices)
-            test_noinput_series = pd.DataFrame(X_noinput, index=test_indices)
+            test_noinput_series = noinput_handle.reindex(test_indices)
             pd.concat([test_X,  test_y,  test_pred_series, test_noinput_series],  1)\
                     .to_csv(join(path, 'test.csv'),  index=False)
 
@@ -600,24 +650,48 @@ def mastml_run(conf_path, data_path, outdir):
             if PlotSettings['train_test_plots']:
                 plot_helper.make_train_test_plots(
                         split_result, path, is_classification, 
-                        label=y.name, model=model, train_X=train_X, test_X=test_X, groups=grouping_data)
-
-            if is_validation:
-                _write_stats(split_result['train_metrics'],
-                         split_result['test_metrics'],
-                         main_path,
-                         split_result['prediction_metrics'],
-                         validation_column_names,)
-            else:
-                _write_stats(split_result['train_metrics'],
-                             split_result['test_metrics'],
-                             main_path)
+                        label=y.name, model=split_model, train_X=train_X, test_X=test_X, groups=grouping_data)
 
+            # last, so a split only counts as done once everything in its directory is
+            _save_checkpoint(path, split_result)
             return split_result
 
-        split_results = []
-        for split_num, (train_indices, test_indices) in enumerate(trains_tests):
-            split_results.append(one_fit(split_num, train_indices, test_indices))
+        if len(trains_tests) == 0:
+            log.warning(f"    {main_path} has no splits, so there is nothing to fit or plot")
+            return []
+
+        split_results = [None] * len(trains_tests)
+        if resume:
+            for split_num, (train_indices, test_indices) in enumerate(trains_tests):
+                split_results[split_num] = _load_checkpoint(join(main_path, f"split_{split_num}"),
+                                                            train_indices, test_indices)
+            n_done = sum(split_result is not None for split_result in split_results)
+            if n_done == len(split_results):
+                log.info(f"    All {n_done} splits already done, only remaking the plots")
+            elif n_done:
+                log.info(f"    Resuming after {n_done} of {len(split_results)} splits already done")
+        todo = [split_num for split_num, split_result in enumerate(split_results) if split_result is None]
+        fits = [partial(one_fit, split_num, *trains_tests[split_num]) for split_num in todo]
+        if min(n_jobs, len(fits)) > 1:
+            log.info(f"        Fitting {len(fits)} splits in {min(n_jobs, len(fits))} processes...")
+            fitted = _run_forked(fits, min(n_jobs, len(fits)))
+        else:
+            fitted = [fit() for fit in fits]
+        for split_num, split_result in zip(todo, fitted):
+            split_results[split_num] = split_result
+
+        # stats.txt has always been left with the last split's stats, whichever split finishes last
+        split_result = split_results[-1]
+        if is_validation:
+            _write_stats(split_result['train_metrics'],
+                     split_result['test_metrics'],
+                     main_path,
+                     split_result['prediction_metrics'],
+                     validation_column_names,)
+        else:
+            _write_stats(split_result['train_metrics'],
+                         split_result['test_metrics'],
+                         main_path)
 
         log.info("    Calculating mean and stdev of scores...")
         def make_train_test_average_and_std_stats():
@@ -683,6 +757,86 @@ def mastml_run(conf_path, data_path, outdir):
     log.info("Making html file of all runs stats...")
     _save_all_runs(runs, outdir)
 
+def _share_jobs(n_jobs, n_combos):
+    """
+    Shares a budget of n_jobs processes between n_combos combos and the splits in each of them:
+    returns (processes running combos, processes running the splits of each combo), which never
+    use more than n_jobs between them. Combos come first, since they share nothing.
+    """
+    if n_jobs > 1 and not _can_fork():
+        # combos and splits are closures, which only forked processes can share
+        log.warning('Running combos and splits one at a time, processes can not be forked on this platform')
+        n_jobs = 1
+    combo_jobs = max(1, min(n_jobs, n_combos))
+    return combo_jobs, max(1, n_jobs // combo_jobs)
+
+def _can_fork():
+    if sys.version_info < (3, 7):
+        # ProcessPoolExecutor can only use the default start method before 3.7
+        return multiprocessing.get_start_method(allow_none=True) in (None, 'fork') and \
+            'fork' in multiprocessing.get_all_start_methods()
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+def _run_combos(combos, n_jobs=1):
+    """
+    Runs every (name, function) in combos, n_jobs at a time in forked worker processes, and
+    returns their results in the order of combos. Errors are raised with the combo's name on
+    them: MastErrors as the same type, anything else as a ComboError.
+    """
+    n_jobs = min(n_jobs, len(combos))
+    if n_jobs <= 1:
+        return [_run_combo(name, function) for name, function in combos]
+
+    log.info(f"Running {len(combos)} combos in {n_jobs} processes...")
+    return _run_forked([partial(_run_forked_combo, name, function) for name, function in combos], n_jobs)
+
+# functions for worker processes to find once they are forked
+_forked_functions = None
+
+def _run_forked(functions, n_jobs):
+    """
+    Calls every function in functions, n_jobs at a time in forked worker processes, and returns
+    their results in order, raising the first (in that order) error. Workers can run their own
+    _run_forked, unlike multiprocessing.Pool's.
+    """
+    global _forked_functions
+    previous = _forked_functions # a worker's own, when called in a worker
+    _forked_functions = functions
+    try:
+        with _fork_pool(n_jobs) as pool:
+            return list(pool.map(_call_forked, range(len(functions))))
+    finally:
+        _forked_functions = previous
+
+def _fork_pool(n_jobs):
+    if sys.version_info < (3, 7):
+        # no mp_context before 3.7, but the default start method forks on posix (see _can_fork)
+        return ProcessPoolExecutor(n_jobs)
+    return ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context('fork'))
+
+def _call_forked(i):
+    return _forked_functions[i]()
+
+def _run_forked_combo(name, function):
+    try:
+        return _run_combo(name, function)
+    except utils.ComboError:
+        # the traceback doesn't survive being sent back to the main process, so log it here
+        log.exception(f'Error in combo {name}')
+        raise
+    except SystemExit:
+        # a combo exiting would only take its worker with it, and break the pool
+        raise utils.ComboError(f'{name}: exited')
+
+def _run_combo(name, function):
+    log.info(f"    Running splits for {name}")
+    try:
+        return function()
+    except utils.MastError as e:
+        raise type(e)(f'{name}: {e}') from e
+    except Exception as e:
+        raise utils.ComboError(f'{name}: {type(e).__name__}: {e}') from e
+
 def _instantiate(kwargs_dict, name_to_constructor, category, X_grouped=None, X_indices=None):
     """
     Uses name_to_constructor to instantiate every item in kwargs_dict and return
@@ -767,16 +921,6 @@ def _extract_grouping_column_names(splitter_to_kwargs):
             splitter_to_group_names[splitter_name] = column_name
     return splitter_to_group_names
 
-def _remove_constant_features(df):
-    log.info("Removing constant features, regardless of feature selectors.")
-    before = set(df.columns)
-    df = df.loc[:, (df != df.iloc[0]).any()]
-    removed = list(before - set(df.columns))
-    if removed != []:
-        log.warning(f'Removed {len(removed)}/{len(before)} constant columns.')
-        log.debug("Removed the following constant columns: " + str(removed))
-    return df
-
 def _save_all_runs(runs, outdir):
     """
     Produces a giant html table of all stats for all runs
@@ -811,13 +955,50 @@ def _write_stats(train_metrics, test_metrics, outdir, prediction_metrics=None, p
                 for name, score in prediction_metric.items():
                     f.write(f"{name}: {'%.3f'%float(score)}\n")
 
+CHECKPOINT_FILE = 'split_result.pkl'
+FINGERPRINT_FILE = 'fingerprint.json'
+
+def _save_checkpoint(split_dir, split_result):
+    " Saves the split_result of a split (predictions, metrics, indices) in its directory "
+    path = join(split_dir, CHECKPOINT_FILE)
+    temp_path = path + f'.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(split_result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path) # so there is either a whole checkpoint or none
+
+def _load_checkpoint(split_dir, train_indices, test_indices):
+    " The checkpointed split_result in split_dir, or None if there isn't one for these indices "
+    path = join(split_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            split_result = pickle.load(f)
+    except Exception as e: # truncated, or pickled with other versions of mastml or its libraries
+        log.warning(f'Fitting {split_dir} again, its checkpoint can not be loaded: {type(e).__name__}: {e}')
+        return None
+    # splitters which shuffle without a random_state split differently every run
+    if not (np.array_equal(split_result['train_indices'], train_indices)
+            and np.array_equal(split_result['test_indices'], test_indices)):
+        log.warning(f'Fitting {split_dir} again, it was split differently before')
+        return None
+    return split_result
+
+def _fingerprint(conf_path, data_path):
+    " Hashes of the conf and data files "
+    fingerprint = OrderedDict()
+    for name, path in [('conf', conf_path), ('data', data_path)]:
+        with open(path, 'rb') as f:
+            fingerprint[name] = hashlib.sha1(f.read()).hexdigest()
+    return fingerprint
+
 def _exclude_validation(df, validation_column):
     return df.loc[validation_column != 1]
 
 def _only_validation(df, validation_column):
     return df.loc[validation_column == 1]
 
-def check_paths(conf_path, data_path, outdir):
+def check_paths(conf_path, data_path, outdir, resume=False):
     # Check conf path:
     if os.path.splitext(conf_path)[1] != '.conf':
         raise utils.FiletypeError(f"Conf file does not end in .conf: '{conf_path}'")
@@ -832,6 +1013,19 @@ def check_paths(conf_path, data_path, outdir):
 
     # Check output directory:
 
+    if resume and os.path.isdir(outdir):
+        try:
+            with open(join(outdir, FINGERPRINT_FILE)) as f:
+                fingerprint = json.load(f)
+        except (OSError, ValueError):
+            raise utils.ResumeError(f"{outdir} has no {FINGERPRINT_FILE}, so it can't be resumed")
+        for name, digest in _fingerprint(conf_path, data_path).items():
+            if fingerprint.get(name) != digest:
+                raise utils.ResumeError(f"The {name} file has changed since the run in {outdir}, so it "
+                                        f"can't be resumed. Run without --resume to start over")
+        log.info(f"Resuming in directory '{outdir}'")
+        return conf_path, data_path, outdir
+
     if os.path.exists(outdir):
         try:
             os.rmdir(outdir) # succeeds if empty
@@ -858,6 +1052,8 @@ def get_commandline_args():
                         help="include this flag for more verbose output")
     parser.add_argument('-q', '--quietness', action="count",
                        help="include this flag to hide [DEBUG] printouts, or twice to hide [INFO]")
+    parser.add_argument('--resume', action="store_true",
+                        help="carry on a run which stopped, in the same output folder, skipping the splits it finished")
 
     args = parser.parse_args()
     verbosity = (args.verbosity if args.verbosity else 0)\
@@ -866,8 +1062,9 @@ def get_commandline_args():
     return (os.path.abspath(args.conf_path),
             os.path.abspath(args.data_path),
             os.path.abspath(args.outdir),
-            verbosity)
+            verbosity,
+            args.resume)
 
 if __name__ == '__main__':
-    conf_path, data_path, outdir, verbosity = get_commandline_args()
-    main(conf_path, data_path, outdir, verbosity)
+    conf_path, data_path, outdir, verbosity, resume = get_commandline_args()
+    main(conf_path, data_path, outdir, verbosity, resume)
@@ -0,0 +1,128 @@
+"""
+Module for a local mirror of Materials Project data, so MaterialsProject feature generation
+can run on large sets of compositions without querying Materials Project for each one.
+
+A bulk dump of Materials Project entries (a .json list, or .jsonl with one entry per line)
+is imported once into an indexed SQLite file:
+
+    python -m mastml.materials_project_mirror mp_dump.jsonl mp_mirror.sqlite
+
+which the MaterialsProject lego then reads with `mirror = mp_mirror.sqlite` in its conf section.
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+import logging
+import threading
+from functools import lru_cache
+
+from mastml import utils
+
+log = logging.getLogger('mastml')
+
+# Fields of each entry kept in the mirror, the ones MaterialsProject feature generation uses
+DEFAULT_FIELDS = ["material_id", "pretty_formula", "e_above_hull", "elasticity", "spacegroup", "band_gap",
+                  "formation_energy_per_atom", "nelements", "energy_per_atom", "volume", "density",
+                  "total_magnetization"]
+
+@lru_cache(maxsize=2**16)
+def reduced_formula(formula):
+    " Reduced formula used as the mirror key, so Fe4O6 and O3Fe2 both find Fe2O3 "
+    from pymatgen import Composition
+    return Composition(formula).reduced_formula
+
+class MaterialsProjectMirror(object):
+    """
+    Read access to an imported mirror, with the same get_data() as pymatgen's MPRester so it
+    can be used in its place.
+
+    Args:
+        path (str) : SQLite file made by MaterialsProjectMirror.import_dump
+    """
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise utils.FileNotFoundError(f'No Materials Project mirror at {path}, '
+                                          f'make one with `python -m mastml.materials_project_mirror`')
+        self.path = os.path.abspath(path)
+        self._local = threading.local() # sqlite connections can't be shared between threads
+
+    @property
+    def connection(self):
+        if not hasattr(self._local, 'connection'):
+            self._local.connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        return self._local.connection
+
+    def get_data(self, chemsys_formula_id):
+        " Entries for a formula, most stable (lowest e_above_hull) first "
+        rows = self.connection.execute('SELECT entry FROM entries WHERE formula = ? '
+                                       'ORDER BY e_above_hull IS NULL, e_above_hull',
+                                       (reduced_formula(chemsys_formula_id),))
+        return [json.loads(entry) for entry, in rows]
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    @classmethod
+    def import_dump(cls, dump_path, path, fields=DEFAULT_FIELDS):
+        """
+        Imports the entries in dump_path (a json list of entries, or a dict with the list under
+        'response', or jsonl with one entry per line) into a new mirror at path, keeping only
+        fields (all of them if None). Returns the mirror.
+        """
+        temp_path = path + f'.{os.getpid()}.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.execute('CREATE TABLE entries (formula TEXT, e_above_hull REAL, entry TEXT)')
+            count = 0
+            batch = list()
+            for entry in cls._read_dump(dump_path):
+                formula = entry.get('pretty_formula') or entry.get('full_formula') or entry.get('formula')
+                if fields is not None:
+                    entry = {field: entry[field] for field in fields if field in entry}
+                batch.append((reduced_formula(formula), entry.get('e_above_hull'), json.dumps(entry)))
+                if len(batch) >= 10000:
+                    connection.executemany('INSERT INTO entries VALUES (?, ?, ?)', batch)
+                    count += len(batch)
+                    batch = list()
+            connection.executemany('INSERT INTO entries VALUES (?, ?, ?)', batch)
+            count += len(batch)
+            connection.execute('CREATE INDEX formula_stability ON entries (formula, e_above_hull)')
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temp_path, path)
+        log.info(f'Imported {count} Materials Project entries from {dump_path} into {path}')
+        return cls(path)
+
+    @staticmethod
+    def _read_dump(dump_path):
+        with open(dump_path) as f:
+            if dump_path.endswith('.jsonl'):
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+                return
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = entries['response']
+        yield from entries
+
+def get_commandline_args():
+    parser = argparse.ArgumentParser(description='Import a Materials Project dump into a local mirror '
+                                                 'for MaterialsProject feature generation')
+    parser.add_argument('dump_path', type=str, help='.json or .jsonl file of Materials Project entries')
+    parser.add_argument('mirror_path', type=str, help='SQLite file to create')
+    parser.add_argument('--all-fields', action='store_true',
+                        help='keep every field of the entries, not just the ones feature generation uses')
+    args = parser.parse_args()
+    return args.dump_path, args.mirror_path, (None if args.all_fields else DEFAULT_FIELDS)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    dump_path, mirror_path, fields = get_commandline_args()
+    MaterialsProjectMirror.import_dump(dump_path, mirror_path, fields)
@@ -27,15 +27,14 @@ import numpy as np
 from sklearn.metrics import confusion_matrix, roc_curve, auc, precision_recall_curve
 
 import matplotlib
-from matplotlib import pyplot as plt
+from matplotlib import cm
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure, figaspect
-from matplotlib.animation import FuncAnimation
+from matplotlib.gridspec import GridSpec
 from matplotlib.font_manager import FontProperties
 import matplotlib.mlab as mlab
-from scipy.stats import gaussian_kde
-from mpl_toolkits.axes_grid1.inset_locator import mark_inset
-from mpl_toolkits.axes_grid1.inset_locator import zoomed_inset_axes
+# scipy.stats, matplotlib.animation and mpl_toolkits are slow to import, so the few plots
+# which use them import them themselves
 
 from .utils import nice_range # TODO include this in ipynb_helper
 
@@ -112,7 +111,7 @@ def make_train_test_plots(run, path, is_classification, label, model, train_X, t
 
 @ipynb_maker
 def plot_confusion_matrix(y_true, y_pred, savepath, stats, normalize=False,
-                          title='Confusion matrix', cmap=plt.cm.Blues):
+                          title='Confusion matrix', cmap=cm.Blues):
     """
     This function prints and plots the confusion matrix.
     Normalization can be applied by setting `normalize=True`.
@@ -597,6 +596,7 @@ def plot_normalized_error(y_true, y_pred, savepath, model, X=None, avg_stats=Non
     fig, ax = make_fig_ax(x_align=x_align)
     mu = 0
     sigma = 1
+    from scipy.stats import gaussian_kde
     residuals = (y_true_-y_pred_)/np.std(y_true_-y_pred_)
     density_residuals = gaussian_kde(residuals)
     x = np.linspace(mu - 5 * sigma, mu + 5 * sigma, y_true_.shape[0])
@@ -726,6 +726,7 @@ def plot_cumulative_normalized_error(y_true, y_pred, savepath, model, X=None, av
     ax.legend(loc=0, fontsize=14, frameon=False)
     xlabels = np.linspace(2, 3, 3)
     ylabels = np.linspace(0.9, 1, 2)
+    from mpl_toolkits.axes_grid1.inset_locator import mark_inset, zoomed_inset_axes
     axin = zoomed_inset_axes(ax, 2.5, loc=7)
     axin.step(X_residuals, n_residuals, linewidth=3, color='green', label="Model Residuals")
     axin.step(X_analytic, n_analytic, linewidth=3, color='blue', label="Analytical Gaussian")
@@ -807,6 +808,7 @@ def plot_3d_heatmap(xs, ys, zs, heats, savepath,
     def animate(i):
         ax.view_init(elev=10., azim=i)
         return [fig]
+    from matplotlib.animation import FuncAnimation
     anim = FuncAnimation(fig, animate, frames=range(0,90,5), blit=True)
     #anim.save(savepath+'.mp4', fps=5, extra_args=['-vcodec', 'libx264'])
     anim.save(savepath+'.gif', fps=5, dpi=80, writer='imagemagick')
@@ -817,7 +819,7 @@ def plot_learning_curve(train_sizes, train_mean, test_mean, train_stdev, test_st
     w, h = figaspect(0.75)
     fig = Figure(figsize=(w,h))
     FigureCanvas(fig)
-    gs = plt.GridSpec(1, 1)
+    gs = GridSpec(1, 1)
     ax = fig.add_subplot(gs[0:, 0:])
 
     max_x = max(train_sizes)
@@ -885,7 +887,7 @@ def plot_learning_curve_convergence(train_sizes, test_mean, score_name, learning
     w, h = figaspect(0.75)
     fig = Figure(figsize=(w,h))
     FigureCanvas(fig)
-    gs = plt.GridSpec(1, 1)
+    gs = GridSpec(1, 1)
     ax = fig.add_subplot(gs[0:, 0:])
 
     max_x = max(steps)
@@ -177,7 +177,7 @@ def do_run(conf_path, data_path, outdir):
     print("Done!")
 
 if __name__ == '__main__':
-    conf_path, data_path, outdir, verbosity = mastml.get_commandline_args() # argparse stuff
+    conf_path, data_path, outdir, verbosity, _ = mastml.get_commandline_args() # argparse stuff
     conf_path, data_path, outdir = mastml.check_paths(conf_path, data_path, outdir)
     utils.activate_logging(outdir, (conf_path, data_path, outdir), verbosity=verbosity)
 
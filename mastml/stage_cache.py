@@ -0,0 +1,191 @@
+"""
+Module for caching the output of each stage of a run (feature generation, normalizers, selectors
+and the model fitted to each split) on disk, so rerunning a conf only redoes the stages whose
+inputs changed.
+
+Every output is stored under a key which hashes the stage's input data, the class and
+get_params() of the lego doing it, and the keys of the stages upstream of it:
+
+    cache = StageCache('stage_cache')
+    X_normalized, key = cache.run('normalizer', normalizer, normalizer.fit_transform, X, y)
+
+The cache directory is kept under max_size bytes by removing the least recently used outputs.
+"""
+
+import os
+import glob
+import pickle
+import inspect
+import hashlib
+import logging
+import numbers
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger('mastml')
+
+DEFAULT_MAX_SIZE = 10 * 2**30 # bytes
+
+class StageCache(object):
+    """
+    Directory of stage outputs, pickled one per file and named by their keys.
+
+    Args:
+        path (str) : directory to keep outputs in, created if needed. If None nothing is cached,
+            and run() just runs every stage.
+        max_size (int) : bytes the outputs may take up, least recently used ones are removed
+            once there are more
+    """
+
+    version = 1 # bump when the way keys are made changes
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = os.path.abspath(path) if path is not None else None
+        self.max_size = max_size
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def key(self, stage, instance, *inputs, upstream=()):
+        " Key of stage being done by instance to inputs, after the stages with keys upstream "
+        digest = hashlib.sha1(f'{self.version} {stage}'.encode())
+        digest.update(token(instance).encode())
+        for data in inputs:
+            digest.update(token(data).encode())
+        for key in upstream:
+            digest.update(str(key).encode())
+        return f'{stage}_{digest.hexdigest()}'
+
+    def run(self, stage, instance, function, *inputs, upstream=()):
+        """
+        Returns (output, key) of stage, either cached or by calling function(*inputs) and caching
+        what it returns. key is None if the cache is disabled.
+        """
+        if not self.enabled:
+            return function(*inputs), None
+        key = self.key(stage, instance, *inputs, upstream=upstream)
+        found, output = self.get(key)
+        if found:
+            log.info(f"    Using cached {stage} output {key}")
+            return output, key
+        output = function(*inputs)
+        self.put(key, output)
+        return output, key
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        " Returns (found, output) for key "
+        try:
+            with open(self._file(key), 'rb') as f:
+                output = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # not cached, or removed or half written by another process
+            return False, None
+        try:
+            os.utime(self._file(key)) # recently used, so evicted last
+        except OSError:
+            pass
+        return True, output
+
+    def put(self, key, output):
+        " Caches output under key, unless it can't be pickled "
+        temp_path = self._file(key) + f'.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e: # pickle raises all sorts for objects it can't handle
+            log.debug(f'Not caching {key}, it can not be pickled: {e}')
+            os.remove(temp_path)
+            return
+        os.replace(temp_path, self._file(key))
+        self.evict()
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in glob.glob(os.path.join(self.path, '*.pkl')))
+
+    def evict(self):
+        " Removes the least recently used outputs until they take up at most max_size bytes "
+        files = list()
+        for path in glob.glob(os.path.join(self.path, '*.pkl')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                log.debug(f'Evicted {path} from the stage cache')
+            except OSError:
+                pass
+            total -= size
+
+def token(value, depth=0):
+    """
+    String identifying value by its contents, which stays the same between runs: data is hashed,
+    legos are their class and get_params() (or constructor arguments), and functions and classes
+    their qualified names.
+    """
+    if depth > 8:
+        return '...'
+    recurse = lambda item: token(item, depth + 1)
+    if value is None or isinstance(value, (bool, numbers.Number, str, bytes)):
+        return repr(value)
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        return _data_token(value)
+    if isinstance(value, np.ndarray):
+        return _data_token(pd.DataFrame(value.reshape(len(value), -1)) if value.ndim else pd.Series([value.item()]))
+    if isinstance(value, dict):
+        return '{' + ', '.join(f'{recurse(key)}: {recurse(item)}' for key, item in sorted(value.items(), key=lambda pair: str(pair[0]))) + '}'
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = sorted(value, key=str) if isinstance(value, (set, frozenset)) else value
+        return type(value).__name__ + '[' + ', '.join(recurse(item) for item in items) + ']'
+    if inspect.isfunction(value) or inspect.isclass(value) or inspect.isbuiltin(value):
+        return f'{getattr(value, "__module__", "")}.{getattr(value, "__qualname__", value.__name__)}'
+    name = f'{type(value).__module__}.{type(value).__qualname__}'
+    if hasattr(value, 'get_params'):
+        try:
+            return name + recurse(value.get_params(deep=False))
+        except Exception:
+            pass # legos which don't keep their parameters the way sklearn expects
+    if hasattr(value, '__dict__'):
+        return name + recurse(_init_arguments(value))
+    return name + repr(value)
+
+def _init_arguments(value):
+    """
+    The constructor arguments value keeps as attributes of the same name, not whatever it picked
+    up fitting since. Objects whose class takes no arguments of its own are all of vars(value).
+    """
+    if type(value).__init__ is object.__init__:
+        return vars(value)
+    try:
+        parameters = inspect.signature(type(value).__init__).parameters.values()
+    except (TypeError, ValueError):
+        return vars(value)
+    return {parameter.name: getattr(value, parameter.name, None) for parameter in list(parameters)[1:]
+            if parameter.kind not in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD)}
+
+def _data_token(data):
+    " Hash of a dataframe/series/index, including its index, column names and dtypes "
+    digest = hashlib.sha1()
+    try:
+        digest.update(pd.util.hash_pandas_object(data, index=not isinstance(data, pd.Index)).values.tobytes())
+    except TypeError:
+        # cells pandas can't hash, like lists
+        digest.update(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+    if isinstance(data, pd.DataFrame):
+        digest.update(repr(list(data.columns)).encode())
+        digest.update(repr(list(data.dtypes.astype(str))).encode())
+    else:
+        digest.update(repr((data.name, str(data.dtype))).encode())
+    return f'{type(data).__name__}{data.shape}:{digest.hexdigest()}'
@@ -140,6 +140,21 @@ class FileNotFoundError(MastError): # sorry for re-using builtin name
 class InvalidValue(MastError):
     pass
 
+class OfflineCacheMiss(MastError):
+    """ running offline, but the response cache doesn't have everything needed """
+    pass
+
+class ResumeError(MastError):
+    """ the output directory can't be resumed, it's from another conf or data file """
+    pass
+
+class ComboError(Exception):
+    """
+    a normalizer/selector/model/splitter combo failed, the message starts with the combo.
+    Not a MastError, since it's usually a bug (or bad model parameters) rather than a bad conf
+    """
+    pass
+
 
 ## Magic math stuff for plot_helper to make ranges
 
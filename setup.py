@@ -39,6 +39,9 @@ except EnvironmentError:
 setup(
     name="mastml", # TODO  should this be MAST-ML?
     packages=find_packages(),
+    # the magpie tables sit next to the mastml package, with their compiled bundle
+    # (python -m mastml.magpie_data) shipped alongside so it is never built on an install
+    package_data={'mastml': ['../magpie/*.table', '../magpie/magpie_tables.npy', '../magpie/magpie_tables.json']},
     version=verstr,
     install_requires=[
         "certifi==2018.4.16",
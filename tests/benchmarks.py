@@ -0,0 +1,84 @@
+"""
+Rough timing benchmarks for the slow parts of mastml.
+Run from the repo root with `python -m tests.benchmarks`
+"""
+
+import builtins
+import time
+import threading
+
+import pandas as pd
+
+from mastml.legos import feature_generators
+
+def count_opens(func, *args, **kwargs):
+    " Call func and return (seconds taken, number of files it opened) "
+    opened = [0]
+    real_open = builtins.open
+    def counting_open(*a, **k):
+        opened[0] += 1
+        return real_open(*a, **k)
+    builtins.open = counting_open
+    try:
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        return time.perf_counter() - start, opened[0]
+    finally:
+        builtins.open = real_open
+
+def benchmark_magpie(row_counts=(10, 100, 1000)):
+    " Magpie featurization time and file opens vs row count, should be linear in rows and constant in opens "
+    base = pd.read_csv('tests/csv/feature_generation.csv')
+    for n_rows in row_counts:
+        df = pd.concat([base] * (n_rows // len(base) + 1), ignore_index=True).iloc[:n_rows]
+        magpie = feature_generators.Magpie('MaterialComp').fit(df)
+        seconds, opens = count_opens(magpie.transform, df)
+        print(f'magpie: {n_rows:>7} rows {seconds:8.3f} s {n_rows/seconds:10.0f} rows/s {opens:>5} files opened')
+
+class StubCitrinationClient(object):
+    """
+    Stands in for citrination_client.CitrinationClient, answering every search with n_hits
+    made up records after waiting latency seconds, so Citrine feature generation can be
+    tested and benchmarked without the network. Searched formulas are kept in self.searches.
+    """
+    def __init__(self, n_hits=20, latency=0.05):
+        self.n_hits = n_hits
+        self.latency = latency
+        self.searches = list()
+        self._lock = threading.Lock()
+
+    def search(self, pif_query):
+        chemical_filter = pif_query.system.chemical_formula.filter
+        formula = (chemical_filter[0] if isinstance(chemical_filter, list) else chemical_filter).equal
+        with self._lock:
+            self.searches.append(formula)
+        time.sleep(self.latency)
+        hits = [{'system': {'properties': [
+                    {'name': 'Band gap', 'scalars': [{'value': len(formula) + hit}]},
+                    {'name': 'Total energy', 'scalars': [{'value': str(hit % 3)}]},
+                    {'name': 'Color', 'scalars': [{'value': 'red'}]},
+                    {'name': 'CIF File'}]}}
+                for hit in range(self.n_hits)]
+        return StubSearchResult({'hits': hits})
+
+class StubSearchResult(object):
+    def __init__(self, results):
+        self.results = results
+
+    def as_dictionary(self):
+        return self.results
+
+def benchmark_citrine(row_counts=(10, 100, 1000), n_jobs=(1, 8)):
+    " Citrine featurization time against a stub client with 50ms latency, vs rows and concurrency "
+    base = pd.read_csv('tests/csv/feature_generation.csv')
+    for n_rows in row_counts:
+        df = pd.concat([base] * (n_rows // len(base) + 1), ignore_index=True).iloc[:n_rows]
+        for jobs in n_jobs:
+            client = StubCitrinationClient()
+            cfg = feature_generators.CitrineFeatureGeneration(df, None, 'MaterialComp', n_jobs=jobs, client=client)
+            seconds, _ = count_opens(cfg.generate_citrine_features)
+            print(f'citrine: {n_rows:>7} rows {jobs:>3} jobs {seconds:8.3f} s {len(client.searches):>5} searches')
+
+if __name__ == '__main__':
+    benchmark_magpie()
+    benchmark_citrine()
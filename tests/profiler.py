@@ -1,5 +1,74 @@
+"""
+Import-time benchmark for mastml, since every run and every worker process pays it.
 
-import cProfile
-import re
+    python tests/profiler.py [--budget SECONDS] [--repeats N] [--profile]
 
-cProfile.run('from mastml import mastml')
+Imports mastml.mastml in fresh interpreters, and fails (exit code 1) if the fastest import
+takes longer than the budget, or if any of LAZY_MODULES was imported, which should only be
+loaded once a conf section uses them. --profile prints the slowest imports as well, which
+needs python 3.7 or newer (for python -X importtime).
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+MODULE = 'mastml.mastml'
+
+# seconds, for the fastest of the repeats
+DEFAULT_BUDGET = 3.0
+
+# heavy dependencies only some conf sections use
+LAZY_MODULES = ['pymatgen.ext.matproj', 'citrination_client', 'nbformat', 'matplotlib.animation',
+                'mpl_toolkits.axes_grid1', 'sklearn.utils.testing', 'matplotlib.pyplot']
+
+def import_time(module=MODULE):
+    " Seconds to import module in a fresh interpreter "
+    start = time.time()
+    subprocess.run([sys.executable, '-c', f'import {module}'], check=True)
+    return time.time() - start
+
+def loaded_modules(module=MODULE):
+    " Names of every module imported along with module, in a fresh interpreter "
+    output = subprocess.run([sys.executable, '-c', f'import sys, {module}; print("\\n".join(sys.modules))'],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return set(output.split())
+
+def slowest_imports(module=MODULE, n=25):
+    " (cumulative microseconds, name) of the n slowest imports, from python -X importtime "
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            check=True, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    times = list()
+    for line in output.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times.append((int(cumulative), name.rstrip()))
+    return sorted(times, reverse=True)[:n]
+
+def main(budget=DEFAULT_BUDGET, repeats=3, profile=False):
+    best = min(import_time() for _ in range(repeats))
+    print(f'import {MODULE}: {best:.2f}s (budget {budget:.2f}s)')
+    eager = sorted(name for name in LAZY_MODULES if name in loaded_modules())
+    if eager:
+        print(f'imported eagerly: {", ".join(eager)}')
+    if profile and sys.version_info < (3, 7):
+        print('--profile needs python 3.7 or newer, for python -X importtime')
+    elif profile:
+        for cumulative, name in slowest_imports():
+            print(f'{cumulative / 1e6:8.3f}s {name}')
+    return best <= budget and not eager
+
+def get_commandline_args():
+    parser = argparse.ArgumentParser(description='Benchmark the import time of mastml')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                        help=f'seconds the import may take, defaults to {DEFAULT_BUDGET}')
+    parser.add_argument('--repeats', type=int, default=3, help='imports to time, the fastest counts')
+    parser.add_argument('--profile', action='store_true', help='also print the slowest imports (python 3.7+)')
+    args = parser.parse_args()
+    return args.budget, args.repeats, args.profile
+
+if __name__ == '__main__':
+    budget, repeats, profile = get_commandline_args()
+    sys.exit(0 if main(budget, repeats, profile) else 1)
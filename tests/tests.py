@@ -1,22 +1,39 @@
 import unittest
+from unittest import mock
 import random
 import warnings
 import logging
 import textwrap
 import nbformat
 import inspect
+import json
+import time
+import threading
+import subprocess
+import sys
+import signal
+import concurrent.futures
+import socketserver
+import http.server
 from io import StringIO
+from functools import partial
 from pprint import pprint
-from tempfile import NamedTemporaryFile
+import os
+import shutil
+from os.path import join
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 import numpy as np
 import pandas as pd
 
-from mastml import plot_helper, conf_parser, metrics
+from mastml import plot_helper, conf_parser, metrics, magpie_data, compositions, feature_cache, featurize
+from mastml import materials_project_mirror, column_screening, data_cleaner, data_plane, stage_cache
 import mastml.utils
-from mastml.legos import feature_generators
+import mastml.mastml
+from mastml.legos import feature_generators, feature_selectors, util_legos
 from mastml.legos.randomizers import Randomizer
 from mastml.legos.feature_normalizers import MeanStdevScaler
+from tests.benchmarks import StubCitrinationClient
 
 #mastml.utils.activate_logging()
 
@@ -144,6 +161,21 @@ class TestPlotToPython(unittest.TestCase):
         nb['cells'] = cells
         nbformat.write(nb, 'test.ipynb')
 
+class SleepyGenerator(feature_generators.BaseEstimator, feature_generators.TransformerMixin):
+    " Generator which waits like a remote query before returning one column "
+    bound = util_legos.IO_BOUND
+    def __init__(self, name, seconds, fail=False):
+        self.name = name
+        self.seconds = seconds
+        self.fail = fail
+    def fit(self, df, y=None):
+        return self
+    def transform(self, df):
+        time.sleep(self.seconds)
+        if self.fail:
+            1 / 0
+        return pd.DataFrame({self.name: np.arange(len(df))}, index=df.index)
+
 class TestGeneration(unittest.TestCase):
     # TODO test for bad api key using pymatgen.ext.matproj.MPRestError
     def test_magpie(self):
@@ -154,6 +186,110 @@ class TestGeneration(unittest.TestCase):
         df = magpie.transform(df)
         df.to_csv('magpie_test.csv')
 
+    def test_magpie_statistics(self):
+        df = pd.DataFrame({'MaterialComp': ['Fe2O3', 'NaCl', 'Fe2O3']})
+        df = feature_generators.Magpie('MaterialComp').fit(df).transform(df)
+        fe2o3 = df.iloc[0]
+        self.assertAlmostEqual(fe2o3['AtomicNumber_composition_average'], (2*26 + 3*8) / 5)
+        self.assertAlmostEqual(fe2o3['AtomicNumber_arithmetic_average'], (26 + 8) / 2)
+        self.assertEqual(fe2o3['AtomicNumber_max_value'], 26)
+        self.assertEqual(fe2o3['AtomicNumber_min_value'], 8)
+        self.assertEqual(fe2o3['AtomicNumber_difference'], 18)
+        self.assertTrue(df.iloc[0].equals(df.iloc[2]))
+
+    def test_magpie_selection(self):
+        df = pd.read_csv('tests/csv/feature_generation.csv')
+        full = feature_generators.Magpie('MaterialComp').fit(df).transform(df)
+        selected = feature_generators.Magpie('MaterialComp', properties=['AtomicNumber', 'Electronegativity'],
+                                             statistics=['max_value', '_composition_average'],
+                                             site_features=False).fit(df).transform(df)
+        self.assertEqual(set(selected.columns), {'AtomicNumber_composition_average', 'AtomicNumber_max_value',
+                                                 'Electronegativity_composition_average', 'Electronegativity_max_value'})
+        self.assertTrue(np.allclose(selected.values, full[selected.columns].values))
+        with self.assertRaises(mastml.utils.InvalidConfParameters):
+            feature_generators.Magpie('MaterialComp', properties='Colour').fit(df).transform(df)
+
+    def test_magpie_site_features(self):
+        df = pd.DataFrame({'MaterialComp': ['NaCl', 'O3Fe2Al', 'NaCl']})
+        df = feature_generators.MagpieFeatureGeneration(df, 'MaterialComp', properties=['AtomicNumber'],
+                                                        statistics=[]).generate_magpie_features()
+        self.assertEqual(list(df.columns), ['Site1_AtomicNumber', 'Site2_AtomicNumber', 'Site3_AtomicNumber'])
+        self.assertEqual(list(df.iloc[1]), [8, 26, 13])
+        self.assertEqual(list(df.iloc[0, :2]), [11, 17])
+        self.assertTrue(np.isnan(df.iloc[2, 2]))
+
+    def test_polynomial_features(self):
+        df = pd.DataFrame({'a': [1., 2, 3, 4, 5], 'b': [0., 0, 1, 0, 2], 'c': [3., 3, 3, 3, 3]}, index=[5, 6, 7, 8, 9])
+        whole = feature_generators.PolynomialFeatures().fit(df).transform(df)
+        self.assertEqual(list(whole.index), list(df.index))
+        self.assertEqual(list(whole['a b']), list(df['a'] * df['b']))
+
+        chunked = feature_generators.PolynomialFeatures(chunk_size=2, dtype='float32').fit(df).transform(df)
+        self.assertTrue((chunked.dtypes == np.float32).all())
+        self.assertTrue(np.allclose(chunked.values, whole.values))
+
+        sparse = feature_generators.PolynomialFeatures(chunk_size=2, sparse=True).fit(df).transform(df)
+        self.assertTrue(np.allclose(np.asarray(sparse.values, dtype=float), whole.values))
+
+        pruned = feature_generators.PolynomialFeatures(chunk_size=2, variance_threshold=0).fit(df).transform(df)
+        self.assertEqual(list(pruned.columns), [name for name in whole.columns if whole[name].var() > 0])
+        self.assertNotIn('1', pruned.columns)
+        self.assertNotIn('c^2', pruned.columns)
+        self.assertTrue(np.allclose(pruned.values, whole[pruned.columns].values))
+
+    def test_contains_all_elements(self):
+        df = pd.DataFrame({'MaterialComp': ['NaCl', 'Fe2O3', 'ClNa', '']})
+        dense = feature_generators.ContainsElement('MaterialComp', 'Na', 'has_Na', all_elements=True).transform(df)
+        # elements in the order they are first written, like pymatgen compositions had them
+        self.assertEqual(list(dense.columns), ['has_Na', 'has_Cl', 'has_Fe', 'has_O'])
+        self.assertEqual(list(dense.sum()), [2, 2, 1, 1])
+        generated = feature_generators.ContainsElement('MaterialComp', 'Na', 'has_Na', all_elements=True).transform(
+                pd.read_csv('tests/csv/feature_generation.csv'))
+        self.assertEqual(list(generated.columns), ['has_Ba', 'has_Zn', 'has_Co', 'has_O', 'has_Fe', 'has_Mn', 'has_Ni', 'has_La'])
+        self.assertEqual(list(dense.iloc[3]), [0, 0, 0, 0])
+        sparse = feature_generators.ContainsElement('MaterialComp', 'Na', 'has_Na', all_elements=True,
+                                                    sparse=True).transform(df)
+        self.assertTrue((np.asarray(sparse.values, dtype=int) == dense.values).all())
+
+    def test_feature_frame_builder(self):
+        builder = feature_generators.FeatureFrameBuilder(pd.Index([10, 11, 12]), dtype='float32')
+        builder.add(np.array([[1, 2], [3, 4]]), ['a', 'b'], rows=[1, 0, 1])
+        builder.add_records([{'c': 5}, {'c': ''}, {'c': '7', 'd': 8}])
+        df = builder.build()
+        self.assertEqual(list(df.columns), ['a', 'b', 'c', 'd'])
+        self.assertEqual(list(df.index), [10, 11, 12])
+        self.assertTrue((df.dtypes == np.float32).all())
+        self.assertEqual(list(df['a']), [3, 1, 3])
+        self.assertEqual(list(df.loc[12]), [3, 4, 7, 8])
+        self.assertTrue(np.isnan(df.loc[11, 'c']))
+
+    def test_feature_union(self):
+        df = pd.read_csv('tests/csv/feature_generation.csv')
+        generators = [SleepyGenerator('first', 0.3), feature_generators.Magpie('MaterialComp'),
+                      SleepyGenerator('second', 0.3),
+                      feature_generators.ContainsElement('MaterialComp', 'Al', 'has_Al')]
+        serial = pd.concat([generator.fit_transform(df) for generator in generators], axis=1)
+
+        start = time.time()
+        union = util_legos.DataFrameFeatureUnion(generators)
+        concurrent = union.fit_transform(df)
+        self.assertLess(time.time() - start, 0.55) # the two sleeps overlap
+        self.assertEqual(list(concurrent.columns), list(serial.columns))
+        self.assertTrue(concurrent.equals(serial))
+        # Magpie and ContainsElement were fit in other processes, the union keeps the fit copies
+        self.assertIsNot(union.transforms[1], generators[1])
+        self.assertEqual(list(union.transforms[1].original_features), list(df.columns))
+        self.assertTrue(union.transform(df).equals(serial))
+
+        with self.assertRaises(ZeroDivisionError):
+            util_legos.DataFrameFeatureUnion([SleepyGenerator('ok', 0), SleepyGenerator('bad', 0, fail=True)]).fit_transform(df)
+
+    def test_magpie_parallel(self):
+        df = pd.read_csv('tests/csv/feature_generation.csv')
+        serial = feature_generators.Magpie('MaterialComp').fit(df).transform(df)
+        parallel = feature_generators.Magpie('MaterialComp', n_jobs=2, chunk_size=3).fit(df).transform(df)
+        self.assertTrue(serial.equals(parallel))
+
     def test_materials_project(self):
         df = pd.read_csv('tests/csv/common_materials.csv')
         materials_project = feature_generators.MaterialsProject(
@@ -163,6 +299,69 @@ class TestGeneration(unittest.TestCase):
         df = materials_project.transform(df)
         df.to_csv('materials_project.csv')
 
+    def test_materials_project_stub_server(self):
+        server, endpoint, queried = serve_stub_materials_project()
+        try:
+            df = pd.DataFrame({'Material': ['NaCl', 'Fe2O3', 'ClNa', 'Al2O3', 'O3Fe2']})
+            materials_project = feature_generators.MaterialsProject('Material', 'key', n_jobs=3, endpoint=endpoint)
+            generated = materials_project.fit(df).transform(df)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(sorted(queried), ['Al2O3', 'Fe2O3', 'NaCl'])
+        self.assertEqual(list(generated['band_gap']), [4, 5, 4, 5, 5])
+        self.assertEqual(list(generated['Spacegroup_number']), [225] * 5)
+
+    def test_materials_project_response_cache(self):
+        server, endpoint, queried = serve_stub_materials_project()
+        df = pd.DataFrame({'Material': ['NaCl', 'Fe2O3', 'ClNa']})
+        with TemporaryDirectory() as cache_dir:
+            try:
+                first = feature_generators.MaterialsProject('Material', 'key', endpoint=endpoint,
+                                                            cache_dir=cache_dir).fit(df).transform(df)
+                self.assertEqual(len(queried), 2)
+                feature_generators.MaterialsProject('Material', 'key', endpoint=endpoint,
+                                                    cache_dir=cache_dir).fit(df).transform(df)
+                self.assertEqual(len(queried), 2)
+                feature_generators.MaterialsProject('Material', 'key', endpoint=endpoint, cache_dir=cache_dir,
+                                                    cache_ttl=0).fit(df).transform(df)
+                self.assertEqual(len(queried), 4)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+            offline = feature_generators.MaterialsProject('Material', 'key', cache_dir=cache_dir, offline=True)
+            self.assertTrue(offline.fit(df).transform(df).equals(first))
+            with self.assertRaises(mastml.utils.OfflineCacheMiss):
+                offline.transform(pd.DataFrame({'Material': ['NaCl', 'Al2O3']}))
+
+    def test_materials_project_mirror(self):
+        def entry(formula, e_above_hull, band_gap):
+            entry = {prop: 1.0 for prop in ['formation_energy_per_atom', 'nelements', 'energy_per_atom',
+                                            'volume', 'density', 'total_magnetization']}
+            entry.update(pretty_formula=formula, e_above_hull=e_above_hull, band_gap=band_gap,
+                         elasticity=None, spacegroup={'number': 167}, structure='not kept')
+            return entry
+        with TemporaryDirectory() as temp_dir:
+            dump_path = join(temp_dir, 'dump.jsonl')
+            with open(dump_path, 'w') as f:
+                for e in [entry('Fe2O3', 0.1, 1.0), entry('NaCl', 0, 5.0), entry('Fe2O3', 0, 2.0)]:
+                    f.write(json.dumps(e) + '\n')
+            mirror_path = join(temp_dir, 'mirror.sqlite')
+            mirror = materials_project_mirror.MaterialsProjectMirror.import_dump(dump_path, mirror_path)
+            self.assertEqual(len(mirror), 3)
+            self.assertEqual([e['band_gap'] for e in mirror.get_data('O6Fe4')], [2.0, 1.0])
+            self.assertNotIn('structure', mirror.get_data('NaCl')[0])
+
+            df = pd.DataFrame({'Material': ['NaCl', 'Fe2O3', 'Fe4O6', 'Al2O3']})
+            generated = feature_generators.MaterialsProject('Material', mirror=mirror_path,
+                                                            cache_dir=temp_dir).fit(df).transform(df)
+            # mirror responses aren't cached like live ones
+            self.assertFalse(os.path.exists(join(temp_dir, 'remote_responses.sqlite')))
+        self.assertEqual(list(generated.index), [0, 1, 2])
+        self.assertEqual(list(generated['band_gap']), [5.0, 2.0, 2.0])
+        self.assertEqual(list(generated['Spacegroup_number']), [167] * 3)
+
     def test_citrine(self):
         df = pd.read_csv('tests/csv/feature_generation.csv')
         citrine = feature_generators.Citrine(
@@ -172,6 +371,79 @@ class TestGeneration(unittest.TestCase):
         df = citrine.transform(df)
         df.to_csv('citrine.csv')
 
+    def test_citrine_stub_client(self):
+        df = pd.DataFrame({'MaterialComp': ['NaCl', 'Fe2O3', 'ClNa', 'Al2O3']})
+        client = StubCitrinationClient(n_hits=3, latency=0)
+        cfg = feature_generators.CitrineFeatureGeneration(df, None, 'MaterialComp', n_jobs=2, client=client)
+        generated = cfg.generate_citrine_features()
+        self.assertEqual(sorted(client.searches), ['Al2O3', 'Fe2O3', 'NaCl'])
+        self.assertEqual(list(generated.columns), ['Band gap_min', 'Total energy_min', 'Band gap_max', 'Total energy_max',
+                                                   'Band gap_avg', 'Total energy_avg'])
+        self.assertEqual(list(generated['Band gap_min']), [4, 5, 4, 5])
+        self.assertEqual(list(generated['Band gap_max']), [6, 7, 6, 7])
+        self.assertEqual(list(generated['Total energy_avg']), [1, 1, 1, 1])
+
+    def test_citrine_cached_without_client(self):
+        df = pd.DataFrame({'MaterialComp': ['NaCl', 'Fe2O3', 'ClNa']})
+        with TemporaryDirectory() as cache_dir:
+            first = feature_generators.CitrineFeatureGeneration(
+                df, None, 'MaterialComp', cache_dir=cache_dir,
+                client=StubCitrinationClient(n_hits=3, latency=0)).generate_citrine_features()
+            # with every response cached, no client is made (nor citrination_client imported)
+            with mock.patch.dict(sys.modules, {'citrination_client': None}):
+                for offline in [False, True]:
+                    cfg = feature_generators.CitrineFeatureGeneration(df, 'key', 'MaterialComp',
+                                                                      cache_dir=cache_dir, offline=offline)
+                    pd.testing.assert_frame_equal(cfg.generate_citrine_features(), first)
+                    self.assertIsNone(cfg._client)
+
+    def test_request_scheduler(self):
+        scheduler = feature_generators.RequestScheduler('stub', max_concurrency=2, max_retries=2, backoff=0.01)
+        in_flight = [0, 0] # current, most
+        lock = threading.Lock()
+        def fetch(formula):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight[0] -= 1
+            return formula.lower()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+            results = list(executor.map(lambda formula: scheduler.request(formula, fetch, formula),
+                                        ['NaCl', 'NaCl', 'NaCl', 'Fe2O3', 'Al2O3', 'NaCl']))
+        self.assertEqual(results, ['nacl', 'nacl', 'nacl', 'fe2o3', 'al2o3', 'nacl'])
+        self.assertLessEqual(in_flight[1], 2)
+        self.assertEqual(scheduler.stats['requests'] + scheduler.stats['coalesced'], 6)
+
+        failures = [ConnectionError('throttled'), ConnectionError('throttled')]
+        def flaky(formula):
+            if failures:
+                raise failures.pop()
+            return formula
+        self.assertEqual(scheduler.request('CuO', flaky, 'CuO'), 'CuO')
+        self.assertEqual(scheduler.stats['retries'], 2)
+        failures = [ConnectionError('throttled')] * 3
+        with self.assertRaises(ConnectionError):
+            scheduler.request('CuO', flaky, 'CuO')
+        with self.assertRaises(KeyError): # not retried
+            scheduler.request('CuO', {}.__getitem__, 'CuO')
+        self.assertEqual(scheduler.stats['retries'], 4)
+
+        limited = feature_generators.RequestScheduler('stub', rate_limit=50)
+        start = time.perf_counter()
+        for i in range(6):
+            limited.request(i, int, i)
+        self.assertGreater(time.perf_counter() - start, 0.09)
+        self.assertIs(feature_generators.get_scheduler('stub', rate_limit=50),
+                      feature_generators.get_scheduler('stub', rate_limit=50))
+        self.assertIs(feature_generators.get_scheduler('stub', rate_limit=50, max_concurrency=8),
+                      feature_generators.get_scheduler('stub', rate_limit=50))
+        # other settings don't replace the first scheduler, they get one of their own
+        slow = feature_generators.get_scheduler('stub', rate_limit=5)
+        self.assertIsNot(slow, feature_generators.get_scheduler('stub', rate_limit=50))
+        self.assertIs(slow, feature_generators.get_scheduler('stub', rate_limit=5))
+
     def test_clean_data(self):
         good = pd.DataFrame([
             [10,20,30,40],
@@ -198,6 +470,447 @@ class TestGeneration(unittest.TestCase):
             print('aftere:\n', feature_generators.clean_dataframe(df), sep='')
             print()
 
+class TestMagpieData(unittest.TestCase):
+
+    def test_element_property_table(self):
+        table = magpie_data.ElementPropertyTable.load()
+        self.assertIs(table, magpie_data.ElementPropertyTable.load())
+        self.assertEqual(table.values.shape, (table.n_elements, len(table.property_names)))
+        self.assertNotIn('OxidationStates', table.property_names)
+        atomic_number = table.values[:, table.property_index(['AtomicNumber'])[0]]
+        self.assertTrue((atomic_number[:100] == table.atomic_numbers[:100]).all())
+        self.assertTrue((np.isnan(table.values) == table.missing).all())
+
+    def test_compiled_bundle(self):
+        parsed = magpie_data.ElementPropertyTable(use_bundle=False)
+        with TemporaryDirectory() as temp_dir:
+            data_path, cache_path = join(temp_dir, 'magpie'), join(temp_dir, 'cache')
+            shutil.copytree(magpie_data.MAGPIE_DATA_PATH, data_path)
+            files = sorted(os.listdir(data_path))
+            table = magpie_data.ElementPropertyTable(data_path, cache_path=cache_path)
+            self.assertIsInstance(table.values, np.memmap)
+            self.assertTrue(np.allclose(table.values, parsed.values, equal_nan=True))
+
+            with open(join(data_path, 'AtomicNumber.table'), 'w') as f:
+                f.write('\n'.join(['42'] * table.n_elements))
+            changed = magpie_data.ElementPropertyTable(data_path, cache_path=cache_path)
+            self.assertNotIsInstance(changed.values, np.memmap)
+            self.assertTrue((changed.values[:, changed.property_index(['AtomicNumber'])] == 42).all())
+            # compiled into the cache rather than the (possibly read-only) data directory
+            self.assertIsInstance(magpie_data.ElementPropertyTable(data_path, cache_path=cache_path).values, np.memmap)
+            self.assertEqual(sorted(os.listdir(data_path)), files)
+            self.assertEqual(len(os.listdir(cache_path)), 2)
+            self.assertNotEqual(table.digest, changed.digest)
+
+    def test_magpie_feature_cache(self):
+        table = magpie_data.ElementPropertyTable.load()
+        with TemporaryDirectory() as cache_dir:
+            cache = feature_cache.MagpieFeatureCache(cache_dir, table, ['a', 'b', 'c'], max_chunks=1)
+            cache.append(['Fe2O3', 'Na1Cl1'], np.arange(6.).reshape(2, 3))
+            cache.append(['Cu1'], np.ones((1, 3)))
+            cache = feature_cache.MagpieFeatureCache(cache_dir, table, ['a', 'b', 'c'])
+            self.assertEqual(len(cache.chunks), 1)
+            values, found = cache.lookup(['Cu1', 'Xe1', 'Fe2O3'])
+            self.assertEqual(list(found), [True, False, True])
+            self.assertEqual(list(values[0]), [1, 1, 1])
+            self.assertEqual(list(values[2]), [0, 1, 2])
+            self.assertTrue(np.isnan(values[1]).all())
+
+            df = pd.read_csv('tests/csv/feature_generation.csv')
+            uncached = feature_generators.Magpie('MaterialComp').fit(df).transform(df)
+            feature_generators.Magpie('MaterialComp', cache_dir=cache_dir).fit(df).transform(df)
+            cached = feature_generators.Magpie('MaterialComp', cache_dir=cache_dir).fit(df).transform(df)
+            self.assertTrue(np.allclose(uncached.values, cached[uncached.columns].values))
+
+class TestCompositions(unittest.TestCase):
+
+    def test_canonical_formula(self):
+        fe2o3 = compositions.parse_composition('Fe2O3')
+        self.assertIs(fe2o3, compositions.parse_composition('O3Fe2'))
+        self.assertIs(fe2o3, compositions.parse_composition(' Fe2 O3'))
+        self.assertEqual(fe2o3.elements, (7, 25))
+        self.assertEqual(fe2o3.amounts, (3.0, 2.0))
+        self.assertEqual(compositions.parse_composition('Fe2O3', ordered=True).elements, (25, 7))
+        self.assertEqual(compositions.parse_composition('Ca(OH)2').amounts, (2.0, 2.0, 1.0))
+
+    def test_composition_index(self):
+        index = compositions.CompositionIndex(['Fe2O3', 'NaCl', 'O3Fe2', np.nan, 'NaCl'])
+        self.assertEqual(index.formulas, ['Fe2O3', 'NaCl', ''])
+        self.assertEqual(list(index.row_to_unique), [0, 1, 0, 2, 1])
+
+class TestColumnScreening(unittest.TestCase):
+
+    def test_screen(self):
+        df = pd.DataFrame([[1, 2., 'x', 5, 1, np.nan, 2.],
+                           [1, 3., '7', 5, 2, np.nan, 3.],
+                           [1, 4., '8', 5, 3, np.nan, 4.]],
+                          columns=['const', 'a', 'text', 'const2', 'b', 'empty', 'a_again'])
+        df['a_named_twice'] = df['b'] * 2
+        df.columns = list(df.columns[:-1]) + ['a']
+        screen = column_screening.ColumnScreen(df, chunk_size=3)
+        self.assertEqual(list(screen.n_missing), [0, 0, 1, 0, 0, 3, 0, 0])
+        self.assertEqual(list(screen.constant), [True, False, False, True, False, True, False, False])
+        self.assertEqual(list(screen.duplicate_of), [-1, -1, -1, -1, -1, -1, 1, 1])
+        self.assertFalse(screen.empty_rows.any())
+
+        keep = screen.keep_columns()
+        self.assertEqual(list(df.columns[keep]), ['a', 'b'])
+        report = screen.report(keep)
+        self.assertEqual(report['duplicate_of'].iloc[6], 'a')
+        self.assertEqual(list(screen.keep_columns(missing=False, constant=False, duplicates=False)), [True] * 8)
+        self.assertEqual(list(screen.keep_columns(missing=False, constant=False)), [True] * 6 + [False] * 2)
+        self.assertEqual(list(df.columns[screen.keep_columns(exempt=['const', 'a_again'])]),
+                         ['const', 'a', 'b', 'a_again'])
+
+        # the coerced column comes out as numbers
+        coerced = screen.frame(screen.keep_columns(missing=False, constant=False, duplicates=False))
+        self.assertTrue(np.isnan(coerced['text'].iloc[0]))
+        self.assertEqual(list(coerced['text'].iloc[1:]), [7, 8])
+
+        raw = column_screening.ColumnScreen(df, coerce=False)
+        self.assertFalse(raw.numeric[2])
+        self.assertEqual(raw.n_missing[2], 0)
+        self.assertEqual(list(raw.frame(raw.keep_columns(constant=False, duplicates=False))['text']), ['x', '7', '8'])
+
+    def test_empty_rows(self):
+        df = pd.DataFrame([[1, 2], ['', np.nan], [3, np.nan]], columns=['a', 'b'])
+        cleaned = feature_generators.clean_dataframe(df)
+        self.assertEqual(list(cleaned.index), [0, 2])
+        self.assertEqual(list(cleaned.columns), ['a'])
+        self.assertEqual(list(cleaned['a']), [1, 3])
+        # only numbers, like select_dtypes('number')
+        flagged = pd.DataFrame({'a': [1, 2], 'flag': [True, False]})
+        self.assertEqual(list(feature_generators.clean_dataframe(flagged).columns), ['a'])
+
+    def test_remove_columns(self):
+        df = pd.DataFrame([[1, 2, np.nan, 4], [5, 6, 7, 8]], columns=['a', 'b', 'c', 'c'])
+        X = df[['b', 'c']]
+        removed, X_removed, none = data_cleaner.remove_columns(df, X, None)
+        # repeated names are columns like any other, and only the one with a NaN goes
+        self.assertEqual(list(removed.columns), ['a', 'b', 'c'])
+        self.assertEqual(list(removed['c']), [4, 8])
+        self.assertEqual(list(X_removed.columns), ['b', 'c'])
+        self.assertEqual(list(X_removed['c']), [4, 8])
+        self.assertIsNone(none)
+        pd.testing.assert_frame_equal(data_cleaner.remove(df, axis=1), df.dropna(axis=1))
+
+class TestFeaturize(unittest.TestCase):
+    conf = '''
+        [FeatureGeneration]
+            [[PolynomialFeatures]]
+                features = width, height
+            [[Magpie]]
+                composition_feature = MaterialComp
+    '''
+
+    def test_chunks_match_whole_file(self):
+        conf_path = string_to_filename(self.conf)
+        with TemporaryDirectory() as outdir:
+            chunked_path, whole_path = join(outdir, 'chunked.csv'), join(outdir, 'whole.csv')
+            n_rows = featurize.featurize(conf_path, 'tests/csv/feature_generation.csv', chunked_path, chunksize=3)
+            featurize.featurize(conf_path, 'tests/csv/feature_generation.csv', whole_path)
+            chunked, whole = pd.read_csv(chunked_path), pd.read_csv(whole_path)
+            self.assertEqual(n_rows, 10)
+            self.assertEqual(list(chunked.columns), list(whole.columns))
+            self.assertTrue(np.allclose(chunked.select_dtypes('number').values,
+                                        whole.select_dtypes('number').values))
+
+    def test_missing_data_in_later_chunk(self):
+        # UO2 is missing some magpie data, which must drop those columns for every chunk, and
+        # not blank the rest of its chunk
+        conf_path = string_to_filename(self.conf)
+        with TemporaryDirectory() as outdir:
+            data_path = join(outdir, 'data.csv')
+            pd.DataFrame({'MaterialComp': ['Ba7Zn1Co8O24', 'La7Zn1Fe8O24', 'SrTiO3', 'MgO',
+                                           'NaCl', 'Fe2O3', 'UO2', 'KCl', 'LiF'],
+                          'width': np.arange(9), 'height': np.arange(9) % 4}).to_csv(data_path, index=False)
+            whole = pd.read_csv(featurize.main(conf_path, data_path, join(outdir, 'whole.csv')))
+            for chunksize in [1, 4]:
+                chunked = pd.read_csv(featurize.main(conf_path, data_path, join(outdir, f'{chunksize}.csv'),
+                                                     chunksize=chunksize))
+                pd.testing.assert_frame_equal(chunked, whole)
+            self.assertFalse(whole.isna().any().any())
+
+class TestCombos(unittest.TestCase):
+
+    def test_run_combos(self):
+        combos = [(f'combo_{i}', partial(pow, 2, i)) for i in range(6)]
+        self.assertEqual(mastml.mastml._run_combos(combos, n_jobs=1), [1, 2, 4, 8, 16, 32])
+        self.assertEqual(mastml.mastml._run_combos(combos, n_jobs=3), [1, 2, 4, 8, 16, 32])
+
+    def test_combo_errors(self):
+        def bad_model():
+            raise ValueError('bad alpha')
+        def bad_conf():
+            raise mastml.utils.MissingColumnError('no column foo')
+        for n_jobs in [1, 2]:
+            with self.assertRaisesRegex(mastml.utils.ComboError, 'DoNothing/Ridge/KFold: ValueError: bad alpha'):
+                mastml.mastml._run_combos([('DoNothing/LinearRegression/KFold', partial(abs, 1)),
+                                           ('DoNothing/Ridge/KFold', bad_model)], n_jobs)
+            with self.assertRaisesRegex(mastml.utils.MissingColumnError, 'DoNothing/Ridge/KFold: no column foo'):
+                mastml.mastml._run_combos([('DoNothing/Ridge/KFold', bad_conf)], n_jobs)
+
+    def test_share_jobs(self):
+        self.assertEqual(mastml.mastml._share_jobs(1, 8), (1, 1))
+        self.assertEqual(mastml.mastml._share_jobs(8, 8), (8, 1))
+        self.assertEqual(mastml.mastml._share_jobs(8, 3), (3, 2))
+        self.assertEqual(mastml.mastml._share_jobs(8, 1), (1, 8))
+
+    def test_run_forked(self):
+        functions = [partial(pow, 2, i) for i in range(4)]
+        self.assertEqual(mastml.mastml._run_forked(functions, 2), [1, 2, 4, 8])
+        # python 3.6 has no mp_context, so its pool takes the default start method
+        with mock.patch.object(mastml.mastml.sys, 'version_info', (3, 6, 6)):
+            self.assertEqual(mastml.mastml._run_forked(functions, 2), [1, 2, 4, 8])
+
+    def test_forked_splits(self):
+        # combos running their splits in processes of their own, as with few combos of many splits
+        splits = lambda i: mastml.mastml._run_forked([partial(pow, i, j) for j in range(4)], 2)
+        combos = [(f'combo_{i}', partial(splits, i)) for i in range(3)]
+        self.assertEqual(mastml.mastml._run_combos(combos, n_jobs=2),
+                         [[1, 0, 0, 0], [1, 1, 1, 1], [1, 2, 4, 8]])
+
+    def test_parallel_run_matches_serial(self):
+        conf = '''
+            [GeneralSetup]
+                n_jobs = {}
+            [DataSplits]
+                [[KFold]]
+                    n_splits = 3
+            [Models]
+                [[LinearRegression]]
+                [[Ridge]]
+            [PlotSettings]
+                target_histogram = False
+                train_test_plots = False
+                predicted_vs_true = False
+                predicted_vs_true_bars = False
+                best_worst_per_point = False
+        '''
+        with TemporaryDirectory() as temp_dir:
+            outputs = list()
+            # serially, two combos each fitting their splits in two processes, and one combo at
+            # a time fitting its splits in three processes
+            for n_jobs, shares in [(1, (1, 1)), (4, (2, 2)), (3, (1, 3))]:
+                conf_path, outdir = join(temp_dir, f'{n_jobs}.conf'), join(temp_dir, str(n_jobs))
+                with open(conf_path, 'w') as f:
+                    f.write(textwrap.dedent(conf.format(n_jobs)))
+                with mock.patch.object(mastml.mastml, '_share_jobs', return_value=shares):
+                    mastml.mastml.main(conf_path, 'tests/csv/boston_housing.csv', outdir)
+                files = dict()
+                for directory, _, names in os.walk(outdir):
+                    for name in names:
+                        if name in ['stats.txt', 'train.csv', 'test.csv']:
+                            with open(join(directory, name)) as f:
+                                files[os.path.relpath(join(directory, name), outdir)] = f.read()
+                outputs.append(files)
+        self.assertEqual(len(outputs[0]), 2 * (1 + 3 * 2))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+class TestDataPlane(unittest.TestCase):
+
+    def test_publish(self):
+        X = pd.DataFrame(np.random.RandomState(0).rand(6, 3), columns=['a', 'b', 'c'], index=range(10, 16))
+        noinput = pd.DataFrame({'formula': ['Fe2O3', None, 'NaCl', 'Al', np.nan, 'Cu'], 'n': range(6)})
+        with data_plane.DataPlane() as plane:
+            X_handle = plane.publish('X', X)
+            y_handle = plane.publish('y', pd.Series(np.arange(6.), name='target'))
+            noinput_handle = plane.publish('X_noinput', noinput)
+            groups_handle = plane.publish('groups', np.array(['x', 'y', 'x', 'y', 'z', 'z']))
+
+            # the whole frame is a view of the published block
+            pd.testing.assert_frame_equal(X_handle.frame(), X)
+            values = X_handle.frame().values
+            while not isinstance(values, np.memmap) and values.base is not None:
+                values = values.base
+            self.assertIsInstance(values, np.memmap)
+            pd.testing.assert_frame_equal(X_handle.loc([15, 11]), X.loc[[15, 11]])
+            pd.testing.assert_series_equal(y_handle.take([1, 2]), pd.Series([1., 2.], index=[1, 2], name='target'))
+            pd.testing.assert_frame_equal(noinput_handle.frame(), noinput)
+            self.assertTrue(noinput_handle.loc([1, 4])['formula'].isna().all())
+            self.assertEqual(list(groups_handle.take([0, 5])), ['x', 'z'])
+            self.assertEqual(len(noinput_handle.reindex([5, 6])), 2)
+            with self.assertRaises(KeyError):
+                X_handle.loc([16])
+
+            # workers only need the handle, and index arrays to slice with
+            takes = [partial(X_handle.take, rows) for rows in [[0, 1], [4, 5]]]
+            for rows, taken in zip([[0, 1], [4, 5]], mastml.mastml._run_forked(takes, 2)):
+                pd.testing.assert_frame_equal(taken, X.iloc[rows])
+            path = plane.path
+        self.assertFalse(os.path.exists(path))
+
+    def test_not_shared(self):
+        X = pd.DataFrame(np.random.RandomState(0).rand(6, 3), columns=['a', 'b', 'c'], index=range(10, 16))
+        with data_plane.DataPlane(shared=False) as plane:
+            X_handle = plane.publish('X', X)
+            groups_handle = plane.publish('groups', ['x', 'y', 'x', 'y', 'z', 'z'])
+            self.assertIsNone(plane.path)
+            self.assertIs(X_handle.frame(), X)
+            pd.testing.assert_frame_equal(X_handle.loc([15, 11]), X.loc[[15, 11]])
+            self.assertEqual(list(groups_handle.take([0, 5])), ['x', 'z'])
+            self.assertEqual(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+    def test_sigterm(self):
+        # blocks are removed on SIGTERM only while a plane is open, then SIGTERM is as it was
+        self.assertEqual(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+        with data_plane.DataPlane():
+            self.assertIs(signal.getsignal(signal.SIGTERM), data_plane._sigterm_exit)
+        self.assertEqual(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+    def test_mixed_objects(self):
+        # grouping and noinput columns can hold anything, which must come back as it was
+        mixed = pd.DataFrame({'group': [1, 'a', 2.5, True, None], 'n': range(5)}, index=list('vwxyz'))
+        with data_plane.DataPlane() as plane:
+            handle = plane.publish('X_grouped', mixed)
+            pd.testing.assert_frame_equal(handle.frame(), mixed)
+            self.assertEqual([type(value) for value in handle.loc(['v', 'x', 'y'])['group']], [int, float, bool])
+            series = plane.publish('groups', mixed['group'])
+            pd.testing.assert_series_equal(mastml.mastml._run_forked([series.frame], 1)[0], mixed['group'])
+
+    def test_stale_blocks(self):
+        with TemporaryDirectory() as directory:
+            # a process which is gone, and one (this one) which isn't
+            dead = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                                  stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout.strip()
+            os.makedirs(join(directory, f'mastml_data_{dead}_abc'))
+            os.makedirs(join(directory, f'mastml_data_{os.getpid()}_abc'))
+            plane = data_plane.DataPlane(directory)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted([f'mastml_data_{os.getpid()}_abc', os.path.basename(plane.path)]))
+            plane.close()
+            # and a run which exits without closing still removes its blocks
+            script = (f'import sys; sys.path.insert(0, {os.getcwd()!r}); from mastml import data_plane; '
+                      f'data_plane.DataPlane({directory!r}).publish("X", [1, 2])')
+            subprocess.run([sys.executable, '-c', script], check=True)
+            self.assertEqual(os.listdir(directory), [f'mastml_data_{os.getpid()}_abc'])
+
+class TestStageCache(unittest.TestCase):
+
+    def test_run(self):
+        X = pd.DataFrame(np.random.RandomState(0).rand(20, 4), columns=list('abcd'))
+        y = pd.Series(np.arange(20.), name='target')
+        calls = list()
+        def fit_transform(normalizer, X, y):
+            calls.append(normalizer)
+            return normalizer.fit_transform(X, y)
+        with TemporaryDirectory() as directory:
+            cache = stage_cache.StageCache(directory)
+            run = lambda normalizer, X, upstream=(): cache.run('normalizer', normalizer, partial(fit_transform, normalizer),
+                                                               X, y, upstream=upstream)
+            scaled, key = run(MeanStdevScaler(), X)
+            # a fresh instance with the same parameters, on the same data, is a hit
+            cached, cached_key = run(MeanStdevScaler(), X.copy())
+            self.assertEqual((len(calls), key), (1, cached_key))
+            pd.testing.assert_frame_equal(scaled, cached)
+            # but other parameters, data, or upstream stages aren't
+            run(MeanStdevScaler(mean=1), X)
+            run(MeanStdevScaler(), X.assign(d=X['d'] + 1))
+            run(MeanStdevScaler(), X, upstream=['selector_0123'])
+            self.assertEqual(len(calls), 4)
+
+        # no cache_dir, nothing cached
+        self.assertEqual(stage_cache.StageCache(None).run('normalizer', None, abs, -1), (1, None))
+
+    def test_selector_rerun(self):
+        conf = '''
+            [GeneralSetup]
+                cache_dir = {}
+            [FeatureNormalization]
+                [[DoNothing]]
+                [[MinMaxScaler]]
+            [FeatureSelection]
+                [[MASTMLFeatureSelector]]
+                    estimator = LinearRegression_select
+                    n_features_to_select = 20
+                    cv = KFold_select
+            [DataSplits]
+                [[KFold_select]]
+                    n_splits = 2
+                [[KFold]]
+                    n_splits = 2
+            [Models]
+                [[LinearRegression_select]]
+                [[LinearRegression]]
+            [PlotSettings]
+                target_histogram = False
+                train_test_plots = False
+                predicted_vs_true = False
+                predicted_vs_true_bars = False
+                best_worst_per_point = False
+        '''
+        selector = feature_selectors.MASTMLFeatureSelector
+        with TemporaryDirectory() as temp_dir:
+            conf_path = join(temp_dir, 'selector.conf')
+            with open(conf_path, 'w') as f:
+                f.write(textwrap.dedent(conf.format(join(temp_dir, 'cache'))))
+            fits = list()
+            for run in range(2):
+                with mock.patch.object(selector, 'fit', autospec=True, side_effect=selector.fit) as fit:
+                    mastml.mastml.main(conf_path, 'tests/csv/boston_housing.csv', join(temp_dir, str(run)))
+                fits.append(fit.call_count)
+        # fitting (which clamps n_features_to_select to the 13 columns) doesn't change the next key
+        self.assertEqual(fits, [2, 0])
+
+    def test_evict(self):
+        with TemporaryDirectory() as directory:
+            cache = stage_cache.StageCache(directory, max_size=3 * 8200)
+            for i in range(3):
+                cache.put(f'model_{i}', np.zeros(1000))
+                os.utime(join(directory, f'model_{i}.pkl'), (i, i))
+            self.assertTrue(cache.get('model_0')[0]) # so model_1 is now the least recently used
+            cache.put('model_3', np.zeros(1000))
+            self.assertEqual([cache.get(f'model_{i}')[0] for i in range(4)], [True, False, True, True])
+            self.assertLessEqual(cache.size(), cache.max_size)
+
+class TestResume(unittest.TestCase):
+
+    def test_checkpoints(self):
+        split_result = dict(train_indices=np.arange(8), test_indices=np.arange(8, 10), test_metrics=dict(R2=0.5))
+        with TemporaryDirectory() as directory:
+            self.assertIsNone(mastml.mastml._load_checkpoint(directory, np.arange(8), np.arange(8, 10)))
+            mastml.mastml._save_checkpoint(directory, split_result)
+            self.assertEqual(os.listdir(directory), [mastml.mastml.CHECKPOINT_FILE])
+            loaded = mastml.mastml._load_checkpoint(directory, np.arange(8), np.arange(8, 10))
+            self.assertEqual(loaded['test_metrics'], split_result['test_metrics'])
+            # split differently this time, so it has to be fitted again
+            self.assertIsNone(mastml.mastml._load_checkpoint(directory, np.arange(2, 10), np.arange(2)))
+            # and so does a split whose checkpoint can't be loaded, whatever pickle raises
+            path = join(directory, mastml.mastml.CHECKPOINT_FILE)
+            with open(path, 'rb') as f:
+                pickled = f.read()
+            for broken in [pickled[:len(pickled) // 2], pickled.replace(b'numpy', b'nompy'), b'not a pickle']:
+                with open(path, 'wb') as f:
+                    f.write(broken)
+                self.assertIsNone(mastml.mastml._load_checkpoint(directory, np.arange(8), np.arange(8, 10)))
+
+    def test_check_paths(self):
+        with TemporaryDirectory() as directory:
+            conf_path, data_path, outdir = join(directory, 'a.conf'), join(directory, 'a.csv'), join(directory, 'out')
+            for path in conf_path, data_path:
+                with open(path, 'w') as f:
+                    f.write(path)
+            os.makedirs(outdir)
+            with open(join(outdir, 'log.log'), 'w') as f:
+                f.write('partly done')
+            # a directory without a fingerprint wasn't made by a run it can carry on
+            self.assertRaises(mastml.utils.ResumeError, mastml.mastml.check_paths, conf_path, data_path, outdir, resume=True)
+            with open(join(outdir, mastml.mastml.FINGERPRINT_FILE), 'w') as f:
+                json.dump(mastml.mastml._fingerprint(conf_path, data_path), f)
+            self.assertEqual(mastml.mastml.check_paths(conf_path, data_path, outdir, resume=True)[2], outdir)
+            with open(data_path, 'a') as f:
+                f.write('more data')
+            self.assertRaises(mastml.utils.ResumeError, mastml.mastml.check_paths, conf_path, data_path, outdir, resume=True)
+
+class TestImportTime(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        from tests import profiler
+        loaded = profiler.loaded_modules()
+        self.assertIn('mastml.mastml', loaded)
+        self.assertEqual([name for name in profiler.LAZY_MODULES if name in loaded], [])
+
 class TestPlots(unittest.TestCase):
 
     def setUp(self):
@@ -366,6 +1079,32 @@ class TestNormalization(unittest.TestCase):
         self.assertTrue(set(d1.columns) == set(d3.columns))
         self.assertTrue((abs(d3 - d1) < .001).all().all())
 
+def serve_stub_materials_project():
+    """
+    Starts a local server answering /materials/<formula>/vasp like the Materials Project REST
+    api, and returns (server, its url, list of formulas it was asked for)
+    """
+    queried = list()
+    class StubMaterialsProject(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            formula = self.path.split('/')[-2]
+            queried.append(formula)
+            entry = {prop: len(formula) for prop in ['band_gap', 'e_above_hull', 'formation_energy_per_atom',
+                     'nelements', 'energy_per_atom', 'volume', 'density', 'total_magnetization']}
+            entry.update(elasticity=None, spacegroup={'number': 225})
+            body = json.dumps({'valid_response': True, 'response': [entry]}).encode()
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = ThreadingServer(('127.0.0.1', 0), StubMaterialsProject)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}', queried
+
 def string_to_filename(st):
     f = NamedTemporaryFile(mode='w', delete=False)
     f.write(st)